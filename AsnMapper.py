@@ -0,0 +1,188 @@
+import logging
+import gzip
+import os
+import numpy as np
+from ip_utils import ip_to_int, prefix_to_range, sorted_contains
+
+
+class AsnMapper(object):
+    """
+    Maps arrays of integer IPs to ASNs with a binary search over the prefixes of a pyasn database. Nested prefixes
+    are flattened to non-overlapping intervals that carry the ASN of the most specific prefix, so the longest prefix
+    match of a whole array of IPs is a single numpy.searchsorted call. The IPs of IXP peering LANs are mapped to the
+    ASN of the IXP member that uses them.
+    """
+
+    # ASN value used for addresses that are not covered by any prefix
+    UNKNOWN_ASN = 0
+
+    def __init__(self, starts, asns):
+        logging.basicConfig()
+        self.logger = logging.getLogger("AsnMapper")
+        # interval i covers the addresses from starts[i] to starts[i+1] - 1 and is originated by asns[i]
+        self.starts = starts
+        self.asns = asns
+        self.ixp_ips = np.zeros(0, dtype=np.uint32)
+        self.ixp_asns = np.zeros(0, dtype=np.uint32)
+        self.siblings = dict()
+
+    @classmethod
+    def from_ipasn_file(cls, ipasn_file):
+        """
+        Loads the prefixes of a pyasn database file (IP-ASN32-DAT format, optionally gzip-compressed). The flattened
+        intervals are cached in `<ipasn_file>.npz` and reused as long as the database file does not change.
+        :param ipasn_file: the path to the pyasn database file
+        :return: an AsnMapper object
+        """
+        cache_file = ipasn_file + ".npz"
+        if os.path.isfile(cache_file) and os.path.getmtime(cache_file) >= os.path.getmtime(ipasn_file):
+            try:
+                cached = np.load(cache_file)
+                return cls(cached["starts"], cached["asns"])
+            except (IOError, ValueError, KeyError):
+                pass
+
+        prefixes = list()
+        open_file = gzip.open if ipasn_file.endswith(".gz") else open
+        with open_file(ipasn_file) as fin:
+            for line in fin:
+                if line.startswith(";"):
+                    continue
+                lf = line.split()
+                if len(lf) < 2:
+                    continue
+                try:
+                    first, last = prefix_to_range(lf[0])
+                    prefixes.append((first, last, int(lf[1])))
+                except (ValueError, IOError):
+                    continue
+
+        starts, asns = cls.flatten_prefixes(prefixes)
+        try:
+            with open(cache_file, "wb") as fout:
+                np.savez(fout, starts=starts, asns=asns)
+        except IOError:
+            pass
+        return cls(starts, asns)
+
+    @classmethod
+    def flatten_prefixes(cls, prefixes):
+        """
+        Converts possibly nested prefixes to non-overlapping intervals, where each address takes the ASN of the most
+        specific prefix that covers it
+        :param prefixes: a list of (first address, last address, ASN) tuples
+        :return: a tuple with the sorted numpy array of the first address of each interval and the numpy array of the
+        corresponding ASNs
+        """
+        starts = list()
+        asns = list()
+
+        def add_interval(start, asn):
+            if start > 0xFFFFFFFF:
+                return
+            if len(starts) > 0 and starts[-1] == start:
+                asns[-1] = asn
+            elif len(asns) == 0 or asns[-1] != asn:
+                starts.append(start)
+                asns.append(asn)
+
+        # Enclosing prefixes come before the prefixes they contain
+        prefixes.sort(key=lambda prefix: (prefix[0], -prefix[1]))
+        enclosing = list()
+        for first, last, asn in prefixes:
+            # Return to the ASN of the parent prefix after the end of each enclosing prefix that ends before this one
+            while len(enclosing) > 0 and enclosing[-1][0] < first:
+                end, enclosing_asn = enclosing.pop()
+                add_interval(end + 1, enclosing[-1][1] if len(enclosing) > 0 else cls.UNKNOWN_ASN)
+            add_interval(first, asn)
+            enclosing.append((last, asn))
+        while len(enclosing) > 0:
+            end, enclosing_asn = enclosing.pop()
+            add_interval(end + 1, enclosing[-1][1] if len(enclosing) > 0 else cls.UNKNOWN_ASN)
+
+        if len(starts) == 0 or starts[0] != 0:
+            starts.insert(0, 0)
+            asns.insert(0, cls.UNKNOWN_ASN)
+        return np.array(starts, dtype=np.uint32), np.array(asns, dtype=np.uint32)
+
+    def set_ixp_addresses(self, ixp_ips, ixp_asns):
+        """
+        Sets the IPs of the IXP peering LANs, which are mapped to the ASN of the IXP member instead of the ASN that
+        originates the peering LAN prefix
+        :param ixp_ips: a numpy array of integer IPs
+        :param ixp_asns: a numpy array with the ASN of the member that uses each IP
+        """
+        ixp_ips = np.asarray(ixp_ips, dtype=np.uint32)
+        ixp_asns = np.asarray(ixp_asns, dtype=np.uint32)
+        # Tables that are already sorted (e.g. memory-mapped from the IXP LAN table) are used without a copy
+        if len(ixp_ips) > 1 and np.any(ixp_ips[1:] < ixp_ips[:-1]):
+            order = np.argsort(ixp_ips, kind="mergesort")
+            ixp_ips = ixp_ips[order]
+            ixp_asns = ixp_asns[order]
+        self.ixp_ips = ixp_ips
+        self.ixp_asns = ixp_asns
+
+    def set_siblings(self, siblings):
+        """
+        Sets the ASNs that should be grouped together with a sibling ASN
+        :param siblings: a dictionary that maps ASNs to the sibling ASN under which their targets are grouped
+        """
+        self.siblings = dict(siblings)
+
+    def map_asns(self, ips):
+        """
+        Maps an array of IPs to the ASNs that originate them
+        :param ips: a numpy array of integer IPs
+        :return: a numpy uint32 array with the ASN of each IP, or UNKNOWN_ASN for IPs that are not covered
+        """
+        ips = np.asarray(ips, dtype=np.uint32)
+        asns = self.asns[np.searchsorted(self.starts, ips, side="right") - 1]
+        if len(self.ixp_ips) > 0:
+            positions = np.searchsorted(self.ixp_ips, ips)
+            positions[positions == len(self.ixp_ips)] = 0
+            is_ixp_ip = self.ixp_ips[positions] == ips
+            asns[is_ixp_ip] = self.ixp_asns[positions[is_ixp_ip]]
+        return asns
+
+    def group_by_asn(self, ips, asns=None):
+        """
+        Groups an array of IPs per ASN, after mapping sibling ASNs together
+        :param ips: a numpy array of integer IPs
+        :param asns: the ASNs of the IPs as returned by :map_asns (computed if not given)
+        :return: a dictionary that maps each ASN to the numpy array of its IPs
+        """
+        ips = np.asarray(ips, dtype=np.uint32)
+        if asns is None:
+            asns = self.map_asns(ips)
+        asns = asns.copy()
+        for asn, sibling_asn in self.siblings.iteritems():
+            asns[asns == asn] = sibling_asn
+        order = np.argsort(asns, kind="mergesort")
+        sorted_asns = asns[order]
+        group_asns, group_starts = np.unique(sorted_asns, return_index=True)
+        group_ends = np.append(group_starts[1:], len(sorted_asns))
+        asn_targets = dict()
+        for asn, start, end in zip(group_asns.tolist(), group_starts.tolist(), group_ends.tolist()):
+            asn_targets[asn] = ips[order[start:end]]
+        return asn_targets
+
+    def lookup(self, ip):
+        """
+        Maps a single IP to its ASN, with the same interface as pyasn
+        :param ip: the IP as a dotted string or integer
+        :return: a tuple with the ASN (or None if the IP is not covered) and None in place of the prefix
+        """
+        if not isinstance(ip, (int, long, np.integer)):
+            ip = ip_to_int(ip)
+        asn = int(self.map_asns(np.array([ip], dtype=np.uint32))[0])
+        if asn == self.UNKNOWN_ASN:
+            return None, None
+        return asn, None
+
+    def is_ixp_ip(self, ips):
+        """
+        Tests which IPs belong to IXP peering LANs
+        :param ips: a numpy array of integer IPs
+        :return: a boolean numpy array
+        """
+        return sorted_contains(self.ixp_ips, np.asarray(ips, dtype=np.uint32))
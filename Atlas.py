@@ -7,6 +7,7 @@ from datetime import datetime
 from ripe.atlas.cousteau import ProbeRequest
 from ripe.atlas.cousteau import (
   Ping,
+  Traceroute,
   AtlasCreateRequest,
   AtlasSource,
   AtlasStream,
@@ -18,6 +19,8 @@ from geopy import geocoders
 from ripe.atlas.cousteau.source import MalFormattedSource
 from ripe.atlas.cousteau.exceptions import  APIResponseError
 import requests.packages.urllib3
+from Metrics import METRICS
+from RttAggregator import RttAggregator
 requests.packages.urllib3.disable_warnings()
 reload(sys)
 sys.setdefaultencoding('utf-8')
@@ -34,11 +37,14 @@ class Probe:
 
 class Atlas:
 
-    def __init__(self, atlas_key):
+    def __init__(self, atlas_key, cassette_store=None):
         logging.basicConfig()
         self.logger = logging.getLogger("Atlas")
         self.ATLAS_API_KEY = atlas_key
-        self.ping_rtts = dict()
+        # Records and replays the probe listings, the measurements always go to the network
+        self.cassette_store = cassette_store
+        # The RTT statistics of the in-flight measurements, which can run concurrently on the same client
+        self.rtt_aggregator = RttAggregator()
         self.asn_probes = dict()
         self.country_probes = dict()
         self.city_probes = dict()
@@ -48,13 +54,7 @@ class Atlas:
         Function that will be called every time we receive a new result.
         :param args: a tuple, so you should use args[0] to access the real message.
         """
-        result = args[0]['result']
-        for reply in result:
-            if "rtt" in reply:
-                rtt = reply["rtt"]
-                if args[0]["prb_id"] not in self.ping_rtts:
-                    self.ping_rtts[args[0]["prb_id"]] = list()
-                self.ping_rtts[args[0]["prb_id"]].append(rtt)
+        self.rtt_aggregator.add_result(args[0])
 
     def parse_results(self, result):
         """
@@ -63,12 +63,64 @@ class Atlas:
         """
         for reply in result:
             if "result" in reply:
-                for packet in reply["result"]:
-                    if "rtt" in packet:
-                        rtt = packet["rtt"]
-                        if reply["prb_id"] not in self.ping_rtts:
-                            self.ping_rtts[reply["prb_id"]] = list()
-                        self.ping_rtts[reply["prb_id"]].append(rtt)
+                self.rtt_aggregator.add_result(reply)
+
+    def request_probes(self, **filters):
+        """
+        Requests the probes that match the filters from the RIPE Atlas API
+        :param filters: the filters of the probes API, e.g. status, asn_v4, country_code
+        :return: an iterable of probe dictionaries
+        """
+        if self.cassette_store is not None:
+            return self.cassette_store.call("atlas_probes", filters, lambda: list(ProbeRequest(**filters)))
+        return ProbeRequest(**filters)
+
+    def create_ping(self, ping, source):
+        """
+        Creates a one-off measurement with the RIPE Atlas API
+        :param ping: the Ping measurement definition
+        :param source: the AtlasSource with the probes
+        :return: a tuple with the success status and the API response
+        """
+        return self.create_measurement(ping, source)
+
+    def create_measurement(self, measurement, source):
+        """
+        Creates a one-off measurement with the RIPE Atlas API
+        :param measurement: the Ping or Traceroute measurement definition
+        :param source: the AtlasSource with the probes
+        :return: a tuple with the success status and the API response
+        """
+        atlas_request = AtlasCreateRequest(
+            start_time=datetime.utcnow(),
+            key=self.ATLAS_API_KEY,
+            measurements=[measurement],
+            sources=[source],
+            is_oneoff=True
+        )
+        return atlas_request.create()
+
+    def stream_results(self, measurement_id, on_result=None):
+        """
+        Receives the results of a measurement from the RIPE Atlas result stream and passes them to
+        :on_result_response
+        :param measurement_id: the ID of the measurement
+        :param on_result: the function that receives the results instead of :on_result_response, or None
+        """
+        atlas_stream = AtlasStream()
+        atlas_stream.connect()
+        # Measurement results
+        channel = "atlas_result"
+        # Bind function we want to run with every result message received
+        atlas_stream.bind_channel(channel, on_result or self.on_result_response)
+        stream_parameters = {"msm": measurement_id}
+        atlas_stream.start_stream(stream_type="result", **stream_parameters)
+
+        # Timeout all subscriptions after 120 secs. Leave seconds empty for no timeout.
+        # Make sure you have this line after you start *all* your streams
+        atlas_stream.timeout(seconds=120)
+        # Shut down everything
+        atlas_stream.disconnect()
 
     def collect_active_probes(self):
         """
@@ -76,7 +128,7 @@ class Atlas:
         :return:
         """
         filters = {"status": 1}
-        probes = ProbeRequest(**filters)
+        probes = self.request_probes(**filters)
         for probe in probes:
             if probe["geometry"] is not None and probe["asn_v4"] is not None:
                 # Compile a set of active probes per ASN
@@ -105,8 +157,7 @@ class Atlas:
                         )
                     )
 
-    @staticmethod
-    def select_probes_in_asn(target_asn):
+    def select_probes_in_asn(self, target_asn):
         """
         Returns a set of Atlas probe IDs in the target ASN
         :param target_asn: the ASN in which the function searches for probes
@@ -114,7 +165,7 @@ class Atlas:
         """
         candidate_probes = set()
         filters = {"asn_v4": target_asn, "status": 1}
-        probes = ProbeRequest(**filters)
+        probes = self.request_probes(**filters)
         for probe in probes:
             if probe["geometry"] is not None:
                 candidate_probes.add(
@@ -130,8 +181,12 @@ class Atlas:
         return candidate_probes
 
     def calculate_points_distance(self, p1_lng, p1_lat, p2_lng, p2_lat):
-        p1 = Point("%s %s" % (p1_lng, p1_lat))
-        p2 = Point("%s %s" % (p2_lng, p2_lat))
+        """
+        :return: the distance in km between the points (p1_lat, p1_lng) and (p2_lat, p2_lng)
+        """
+        # geopy points are (latitude, longitude)
+        p1 = Point(float(p1_lat), float(p1_lng))
+        p2 = Point(float(p2_lat), float(p2_lng))
         result = distance.distance(p1, p2).kilometers
         return result
 
@@ -148,8 +203,8 @@ class Atlas:
 
         if len(self.country_probes) == 0:
             filters = {"country_code": country, "status": 1}
-            probes = ProbeRequest(**filters)
             try:
+                probes = self.request_probes(**filters)
                 for probe in probes:
                     if probe["asn_v4"] is not None and probe["geometry"]["type"] == "Point":
                         probe_lon = probe["geometry"]["coordinates"][0]
@@ -183,11 +238,11 @@ class Atlas:
         :param af: The IP address family (4 or 6)
         :param target_ip: The IP to be queried
         :param description: The description of the measurement
-        :param packets_num:
-        :param probes_list:
-        :return:
+        :param packets_num: The number of packets per probe
+        :param probes_list: The IDs of the probes
+        :return: a dictionary that maps the probes that reported a result to their RttAggregator.RttSummary
         """
-        self.ping_rtts = dict()
+        ping_results = dict()
         ping = Ping(af=af, target=target_ip, description=description, packets=packets_num)
 
         if len(probes_list) > 0:
@@ -197,16 +252,10 @@ class Atlas:
                 type="probes"
             )
 
-            atlas_request = AtlasCreateRequest(
-                start_time=datetime.utcnow(),
-                key=self.ATLAS_API_KEY,
-                measurements=[ping],
-                sources=[source],
-                is_oneoff=True
-            )
-
             try:
-                (is_success, response) = atlas_request.create()
+                with METRICS.timer("atlas_measurement_create"):
+                    (is_success, response) = self.create_ping(ping, source)
+                METRICS.increment("atlas_measurements", result="error" if "error" in response else "created")
 
                 #print response, len(','.join(str(x) for x in probes_list))
                 #print response
@@ -219,20 +268,14 @@ class Atlas:
                 else:
                     measurement_id = response["measurements"][0]
 
-                    atlas_stream = AtlasStream()
-                    atlas_stream.connect()
-                    # Measurement results
-                    channel = "atlas_result"
-                    # Bind function we want to run with every result message received
-                    atlas_stream.bind_channel(channel, self.on_result_response)
-                    stream_parameters = {"msm": measurement_id}
-                    atlas_stream.start_stream(stream_type="result", **stream_parameters)
-
-                    # Timeout all subscriptions after 120 secs. Leave seconds empty for no timeout.
-                    # Make sure you have this line after you start *all* your streams
-                    atlas_stream.timeout(seconds=120)
-                    # Shut down everything
-                    atlas_stream.disconnect()
+                    self.rtt_aggregator.open(measurement_id)
+                    try:
+                        with METRICS.timer("atlas_stream_wait"):
+                            self.stream_results(measurement_id)
+                    finally:
+                        ping_results = self.rtt_aggregator.collect(measurement_id)
+                    METRICS.increment("atlas_replying_probes",
+                                      sum(1 for summary in ping_results.itervalues() if summary.received > 0))
 
 
             except MalFormattedSource, e:
@@ -242,4 +285,39 @@ class Atlas:
                 self.logger.critical("The RIPE Atlas API returned a malformatted measurement reply.")
                 sys.exit(-1)
 
-        return self.ping_rtts
+        return ping_results
+
+    def traceroute_measurement(self, af, target_ip, description, probes_list):
+        """
+        Creates a new ICMP Traceroute measurement and collects its results. Unlike the pings, a failed traceroute
+        doesn't stop the geolocation.
+        :param af: The IP address family (4 or 6)
+        :param target_ip: The IP to be queried
+        :param description: The description of the measurement
+        :param probes_list: The IDs of the probes
+        :return: the list of the traceroute results, in the format of the RIPE Atlas API
+        """
+        results = list()
+        if len(probes_list) == 0:
+            return results
+        traceroute = Traceroute(af=af, target=target_ip, description=description, protocol="ICMP")
+        source = AtlasSource(
+            value=','.join(str(x) for x in probes_list),
+            requested=len(probes_list),
+            type="probes"
+        )
+        try:
+            with METRICS.timer("atlas_measurement_create"):
+                (is_success, response) = self.create_measurement(traceroute, source)
+            METRICS.increment("atlas_traceroutes", result="error" if "error" in response else "created")
+            if "error" in response:
+                self.logger.error("The RIPE Atlas traceroute failed due to `%s` error with message: \"%s\"."
+                                  % (response["error"]["title"], response["error"]["detail"]))
+                return results
+            with METRICS.timer("atlas_stream_wait"):
+                self.stream_results(response["measurements"][0], lambda *args: results.append(args[0]))
+        except MalFormattedSource, e:
+            self.logger.error("Unable to create RIPE Atlas traceroute. Error: %s" % str(e))
+        except KeyError:
+            self.logger.error("The RIPE Atlas API returned a malformatted measurement reply.")
+        return results
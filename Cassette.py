@@ -0,0 +1,161 @@
+import os
+import gzip
+import hashlib
+import logging
+import threading
+from ujson import dumps, loads
+from geopy.location import Location
+from Metrics import METRICS
+
+# The modes of a CassetteStore
+MODE_OFF = "off"
+MODE_RECORD = "record"
+MODE_REPLAY = "replay"
+MODE_AUTO = "auto"
+CASSETTE_MODES = (MODE_OFF, MODE_RECORD, MODE_REPLAY, MODE_AUTO)
+
+
+class CassetteMiss(Exception):
+    """
+    Raised in replay mode when a request has not been recorded
+    """
+    pass
+
+
+class CassetteStore(object):
+    """
+    Records the responses of the external APIs (PeeringDB, Google Maps, the RIPE Atlas probes API) to gzipped JSON
+    files keyed by the service and the request, and serves them again from disk. In record mode every request goes
+    to the network and its response is stored, in replay mode only stored responses are served, and in auto mode
+    stored responses are served and the missing ones are recorded. Every response is written to its own file, so the
+    store can be shared by the threads and the worker processes of a run.
+    """
+
+    def __init__(self, cassette_dir, mode=MODE_AUTO):
+        """
+        :param cassette_dir: the directory of the recorded responses
+        :param mode: one of record, replay or auto
+        """
+        logging.basicConfig()
+        self.logger = logging.getLogger("Cassette")
+        if mode not in CASSETTE_MODES:
+            raise ValueError("Unknown cassette mode `%s`, expected one of %s" % (mode, ", ".join(CASSETTE_MODES)))
+        self.cassette_dir = cassette_dir
+        self.mode = mode
+
+    def request_file(self, service, request):
+        """
+        :return: the path of the file with the response to a request
+        """
+        digest = hashlib.sha1(dumps(request, sort_keys=True)).hexdigest()
+        return os.path.join(self.cassette_dir, service, digest[:2], "%s.json.gz" % digest)
+
+    def load(self, request_file):
+        """
+        :return: the stored response, or None if the request has not been recorded
+        """
+        try:
+            with gzip.open(request_file, "rb") as fin:
+                return loads(fin.read())["response"]
+        except (IOError, ValueError, KeyError):
+            return None
+
+    def store(self, request_file, service, request, response):
+        """
+        Writes a response atomically, so that concurrent readers never see a partial file
+        """
+        request_dir = os.path.dirname(request_file)
+        tmp_file = "%s.%s.%s.tmp" % (request_file, os.getpid(), threading.current_thread().ident)
+        try:
+            if not os.path.isdir(request_dir):
+                os.makedirs(request_dir)
+            with gzip.open(tmp_file, "wb") as fout:
+                fout.write(dumps({"service": service, "request": request, "response": response}))
+            os.rename(tmp_file, request_file)
+        except (IOError, OSError) as e:
+            self.logger.error("Recording the %s request to `%s` failed with error: %s" %
+                              (service, request_file, str(e)))
+
+    def call(self, service, request, fetch, is_valid=None):
+        """
+        Serves the response to a request from the store, or fetches and records it
+        :param service: the name of the external API, e.g. peeringdb
+        :param request: a JSON-serializable description of the request, which is the key of the response
+        :param fetch: a function without arguments that sends the request and returns a JSON-serializable response
+        :param is_valid: a function that tells if a fetched response can be recorded (failed requests are not)
+        :return: the response
+        """
+        request_file = self.request_file(service, request)
+        if self.mode != MODE_RECORD:
+            response = self.load(request_file)
+            if response is not None:
+                METRICS.increment("cassette_requests", service=service, result="replayed")
+                return response
+            if self.mode == MODE_REPLAY:
+                METRICS.increment("cassette_requests", service=service, result="missing")
+                raise CassetteMiss("The %s request %s has not been recorded in `%s`" %
+                                   (service, dumps(request, sort_keys=True), self.cassette_dir))
+        response = fetch()
+        if response is not None and (is_valid is None or is_valid(response)):
+            self.store(request_file, service, request, response)
+            METRICS.increment("cassette_requests", service=service, result="recorded")
+        return response
+
+
+class CassetteGeocoder(object):
+    """
+    Wraps a geopy geocoder so that its geocode and reverse queries go through a CassetteStore. Only the address,
+    the coordinates and the raw response of the results are recorded.
+    """
+
+    def __init__(self, geocoder, cassette_store):
+        self.geocoder = geocoder
+        self.cassette_store = cassette_store
+
+    @staticmethod
+    def location_to_dict(location):
+        if location is None:
+            return {"location": None}
+        latitude = getattr(location, "latitude", None)
+        longitude = getattr(location, "longitude", None)
+        return {
+            "location": {
+                "address": getattr(location, "address", ""),
+                "point": [latitude, longitude] if latitude is not None and longitude is not None else None,
+                "raw": location.raw
+            }
+        }
+
+    @staticmethod
+    def dict_to_location(location_dict):
+        location = location_dict["location"]
+        if location is None:
+            return None
+        return Location(location["address"], location["point"], location["raw"])
+
+    def query(self, method, query, **kwargs):
+        # The timeout doesn't change the response, so it is not part of the key
+        request = dict((key, value) for key, value in kwargs.iteritems() if key != "timeout")
+        request["query"] = query
+        response = self.cassette_store.call(
+            "gmap_%s" % method, request,
+            lambda: self.location_to_dict(getattr(self.geocoder, method)(query, **kwargs)))
+        return self.dict_to_location(response)
+
+    def geocode(self, query, **kwargs):
+        return self.query("geocode", query, **kwargs)
+
+    def reverse(self, query, **kwargs):
+        return self.query("reverse", query, **kwargs)
+
+
+def open_cassette_store(cassette_config):
+    """
+    Creates the CassetteStore of the [Cassettes] configuration section
+    :param cassette_config: the dictionary of the section
+    :return: the CassetteStore, or None if the cassettes are switched off
+    """
+    mode = cassette_config["mode"].strip().lower() or MODE_OFF
+    if mode == MODE_OFF:
+        return None
+    return CassetteStore(cassette_config["directory"], mode)
@@ -1,17 +1,29 @@
 import logging
 import gzip
 import sys
+import time
 import geopy
 import geoip2.database, geoip2.errors
 from maxminddb.errors import InvalidDatabaseError
 
 
+# Reasons for which geocoding a location may fail. Transient failures (timeouts, service errors) are retried sooner
+# than permanent failures, which are retried with an exponential backoff
+FAILURE_NO_RESULT = "no_result"
+FAILURE_NO_COORDINATES = "no_coordinates"
+FAILURE_NO_LOCALITY = "no_locality"
+FAILURE_NO_COUNTRY = "no_country"
+FAILURE_SERVICE_ERROR = "service_error"
+TRANSIENT_FAILURES = frozenset([FAILURE_SERVICE_ERROR])
+
+
 class GeoEncoder(object):
     """
     This class offers geolocation functionality from different APIs and databases
     """
 
-    def __init__(self, gmap_api_key, maxmind_db_file, coordinates_file, probes_locations_file, worldcities_pop):
+    def __init__(self, gmap_api_key, maxmind_db_file, coordinates_file, probes_locations_file, worldcities_pop,
+                 failed_locations_file=None, failed_retry_hours=24, failed_retry_max_hours=720, cassette_store=None):
         logging.basicConfig()
         self.logger = logging.getLogger("GeoEncoder")
         self.maxmind_reader = False
@@ -23,10 +35,18 @@ class GeoEncoder(object):
             self.logger.error("Reading Maxmind DB filed failed with error: %s" % str(e))
 
         self.worldcities_pop = worldcities_pop
+        # The largest city per country is only read when Maxmind returns a country without a city
+        self.country_largest_city = None
         self.coordinates_file = coordinates_file
         self.probes_locations_file = probes_locations_file
+        self.failed_locations_file = failed_locations_file
+        self.failed_retry_seconds = int(float(failed_retry_hours) * 3600)
+        self.failed_retry_max_seconds = int(float(failed_retry_max_hours) * 3600)
         # Create the Google Maps API geolocator
         self.gmap_geolocator = geopy.geocoders.GoogleV3(api_key=self.GMAP_API_KEY)
+        if cassette_store is not None:
+            from Cassette import CassetteGeocoder
+            self.gmap_geolocator = CassetteGeocoder(self.gmap_geolocator, cassette_store)
 
     def write_location_coordinates(self, location_id, location_data):
         """
@@ -130,36 +150,161 @@ class GeoEncoder(object):
 
         return probes_locations
 
-    def query_location_coordinates(self, target_location):
+    def geocode_location(self, target_location):
         """
-        Queries the Google Maps API for the coordinates for the target location
-        :param target_location:
-        :return: a dictionary with the latitude, longitude, city name and country code according to Google Maps API
+        Queries the Google Maps API for the coordinates for the target location and explains why the query failed
+        :param target_location: the location string, in the format of city|country_2-letter_iso_code
+        :return: a tuple with the dictionary of the latitude, longitude, city name and country code according to the
+        Google Maps API (or False if the location could not be resolved), and the failure reason (or None)
         """
         city_coordinates = dict()
         try:
             location = self.gmap_geolocator.geocode(target_location, timeout=30, language='en')
-            if location is not None:
-                if "geometry" in location.raw and "location" in location.raw["geometry"]:
-                    city_coordinates["lat"] = location.raw["geometry"]["location"]["lat"]
-                    city_coordinates["lng"] = location.raw["geometry"]["location"]["lng"]
-                if "address_components" in location.raw:
-                    for address_component in location.raw["address_components"]:
-                        if "types" in address_component:
-                            if "locality" in address_component["types"]:
-                                city_coordinates["city"] = address_component["long_name"]
-                            elif "country" in address_component["types"]:
-                                city_coordinates["country"] = address_component["short_name"]
         except geopy.exc.GeocoderQueryError, e:
             self.logger.critical("The Google Maps API request was denied with message %s\n"
                                  "Make sure you have provided the correct API key in the config/config.ini file." %
                                  str(e))
             sys.exit(-1)
+        except geopy.exc.GeopyError, e:
+            self.logger.error("Geocoding `%s` failed with error: %s" % (target_location, str(e)))
+            return False, FAILURE_SERVICE_ERROR
+
+        if location is None:
+            return False, FAILURE_NO_RESULT
+
+        if "geometry" in location.raw and "location" in location.raw["geometry"]:
+            city_coordinates["lat"] = location.raw["geometry"]["location"]["lat"]
+            city_coordinates["lng"] = location.raw["geometry"]["location"]["lng"]
+        if "address_components" in location.raw:
+            for address_component in location.raw["address_components"]:
+                if "types" in address_component:
+                    if "locality" in address_component["types"]:
+                        city_coordinates["city"] = address_component["long_name"]
+                    elif "country" in address_component["types"]:
+                        city_coordinates["country"] = address_component["short_name"]
+
+        if "lat" not in city_coordinates or "lng" not in city_coordinates:
+            return False, FAILURE_NO_COORDINATES
+        elif "city" not in city_coordinates:
+            return False, FAILURE_NO_LOCALITY
+        elif "country" not in city_coordinates:
+            return False, FAILURE_NO_COUNTRY
+        return city_coordinates, None
 
-        if len(city_coordinates) == 4:
-            return city_coordinates
+    def read_failed_locations(self):
+        """
+        Read the locations that could not be geocoded in past runs. The file is an append-only log, so for locations
+        that failed more than once the last line wins.
+        :return: a dictionary that maps location ids to a dictionary with the failure reason, the number of failed
+        attempts, the timestamps of the first and last failure, and the timestamp after which we can retry
+        """
+        failed_locations = dict()
+        if self.failed_locations_file is None:
+            return failed_locations
+        try:
+            with open(self.failed_locations_file) as fin:
+                for line in fin:
+                    if line.startswith("#"):
+                        continue
+                    lf = line.rstrip("\n").split("\t")
+                    if len(lf) < 6:
+                        continue
+                    failed_locations[lf[0]] = {
+                        "reason": lf[1],
+                        "attempts": int(lf[2]),
+                        "first_failed": int(lf[3]),
+                        "last_failed": int(lf[4]),
+                        "retry_after": int(lf[5])
+                    }
+        except IOError:
+            # The file is only created after the first failed geocoding
+            pass
+        except ValueError:
+            self.logger.error("The failed locations file `%s` is malformatted" % self.failed_locations_file)
+        return failed_locations
+
+    def write_failed_location(self, location_id, failure):
+        """
+        Append a failed geocoding attempt to the failed locations file
+        :param location_id: The location id, in the format of city|country_2-letter_iso_code
+        :param failure: the dictionary with the failure data as returned by :record_failed_location
+        :return: the success status of appending to file (true or false)
+        """
+        success = True
+        if self.failed_locations_file is None:
+            return False
+        try:
+            with open(self.failed_locations_file, "a+") as fout:
+                outline = u'%s\t%s\t%s\t%s\t%s\t%s\n' % (
+                    location_id,
+                    failure["reason"],
+                    failure["attempts"],
+                    failure["first_failed"],
+                    failure["last_failed"],
+                    failure["retry_after"]
+                )
+                fout.write(outline.encode('utf-8'))
+        except (IOError, UnicodeEncodeError, UnicodeDecodeError) as e:
+            self.logger.error("Appending to file `%s` failed with error: %s" % (self.failed_locations_file, str(e)))
+            success = False
+        return success
+
+    def record_failed_location(self, failed_locations, location_id, reason):
+        """
+        Registers a failed geocoding attempt and persists it. Permanent failures are retried after an exponential
+        backoff that starts at `failed_retry_hours` and is capped at `failed_retry_max_hours`; transient failures are
+        always retried after `failed_retry_hours`.
+        :param failed_locations: the dictionary returned by :read_failed_locations, updated in place
+        :param location_id: the location that could not be geocoded
+        :param reason: one of the FAILURE_* reasons
+        :return: the updated failure data for the location
+        """
+        now = int(time.time())
+        previous = failed_locations.get(location_id)
+        attempts = 1 if previous is None else previous["attempts"] + 1
+        if reason in TRANSIENT_FAILURES:
+            backoff = self.failed_retry_seconds
         else:
+            backoff = min(self.failed_retry_seconds * 2 ** (attempts - 1), self.failed_retry_max_seconds)
+        failure = {
+            "reason": reason,
+            "attempts": attempts,
+            "first_failed": now if previous is None else previous["first_failed"],
+            "last_failed": now,
+            "retry_after": now + backoff
+        }
+        failed_locations[location_id] = failure
+        self.write_failed_location(location_id, failure)
+        return failure
+
+    @staticmethod
+    def is_failed_location(failed_locations, location_id, now=None):
+        """
+        Checks if a location has failed to geocode and should not be queried again yet
+        :param failed_locations: the dictionary returned by :read_failed_locations
+        :param location_id: the location to check
+        :param now: the current timestamp (defaults to the current time)
+        :return: True if the location failed and its retry time has not passed yet, False otherwise
+        """
+        if location_id not in failed_locations:
             return False
+        if now is None:
+            now = time.time()
+        return failed_locations[location_id]["retry_after"] > now
+
+    @staticmethod
+    def report_failed_locations(failed_locations, min_attempts=2):
+        """
+        Lists the locations that repeatedly fail to geocode, so that they can be fixed with a manual override
+        in the coordinates file
+        :param failed_locations: the dictionary returned by :read_failed_locations
+        :param min_attempts: the minimum number of failed attempts for a location to be reported
+        :return: a list of (location_id, failure) tuples sorted by decreasing number of attempts
+        """
+        report = [(location_id, failure) for location_id, failure in failed_locations.iteritems()
+                  if failure["attempts"] >= min_attempts]
+        report.sort(key=lambda x: (-x[1]["attempts"], x[0]))
+        return report
 
     def query_coordinates_location(self, lat, lng):
         """
@@ -227,7 +372,6 @@ class GeoEncoder(object):
         :param target_ips: the set IP to geolocate
         :return: a string with the location of the IP
         """
-        country_largest_city = self.get_largest_cities()
         maxmind_locations = dict()
 
         if self.maxmind_reader is not False:
@@ -244,8 +388,10 @@ class GeoEncoder(object):
                         # find the city with the largest population in that country
                         if str(maxmind_city) == "None" and str(maxmind_country) != "None":
                             maxmind_country = maxmind_country.lower()
-                            if maxmind_country in country_largest_city:
-                                maxmind_city = country_largest_city[maxmind_country]
+                            if self.country_largest_city is None:
+                                self.country_largest_city = self.get_largest_cities()
+                            if maxmind_country in self.country_largest_city:
+                                maxmind_city = self.country_largest_city[maxmind_country]
 
                         if str(maxmind_city) != "None" and str(maxmind_country) != "None":
                             maxmind_locations[target_ip] = "%s|%s" % (maxmind_city, maxmind_country)
@@ -0,0 +1,1215 @@
+# coding=latin-1
+import sys, random, atexit, logging, threading
+import numpy as np
+from time import time
+# My modules. The modules that import heavy dependencies (PeeringDB, Atlas, GeoEncoder) are imported when the
+# corresponding resource is first used
+import arg_parser
+import target_reader
+from ip_utils import int_to_ip, ip_to_int
+from PipelineStages import PipelineStage, StagedPipeline
+from ShardedExecution import AtlasBudget, estimate_ping_credits, estimate_traceroute_credits
+from MeasurementPlanner import MeasurementPlanner, PlanWriter
+from target_clusters import read_alias_sets, cluster_targets
+from ProbePool import ProbePool
+from RttStore import haversine_km, max_distance_km, SOURCE_TRACEROUTE
+from Metrics import METRICS, install_signal_handlers
+
+logging.basicConfig()
+logger = logging.getLogger("Main")
+logger.setLevel(logging.INFO)
+
+
+# ASNs whose targets are geolocated together with the targets of a sibling ASN
+SIBLINGS = {
+    #16625: 20940,
+    702: 701
+}
+
+
+def find_neighboring_probes(candidate_probes, target_asn, as_relationships):
+    """
+    Finds the probes in ASes with a visible interdomain link with the AS that owns the target IP address
+    :param candidate_probes: a list of Atlas.Probe objects
+    :param target_asn: the ASN for which we want to find probes in neighboring ASes
+    :param as_relationships: dictionary with the mapping between AS links and AS relationship types
+    :return: a list of probes
+    """
+    neighboring_probes = set()
+
+    for probe in candidate_probes:
+        link_to_test = "%s %s" % (probe.asn, target_asn)
+        if link_to_test in as_relationships:
+            neighboring_probes.add(probe.id)
+
+    return neighboring_probes
+
+
+def slice_selected_probes(selected_probes, n):
+    """
+    Slices the list of selected probes to chunks of 50s to avoid using
+    :param selected_probes: the entire set of selected probes to slice
+    :param n: the size of each chunk
+    :return: the list of chunks
+    """
+    n = max(1, n)
+    return (selected_probes[i:i+n] for i in xrange(0, len(selected_probes), n))
+
+
+def lazy_resource(load):
+    """
+    Turns a method of the GeolocationPipeline into a property which is loaded on first use. The time spent to load
+    each resource is recorded in `load_times`.
+    :param load: the method that loads the resource
+    :return: the property
+    """
+    name = load.__name__
+
+    def get_resource(self):
+        if name not in self.resources:
+            with self.resources_lock:
+                if name not in self.resources:
+                    start = time()
+                    # Resources that load other resources only record the time spent on their own loading
+                    self.loading_resources.append(0.0)
+                    resource = load(self)
+                    dependencies_time = self.loading_resources.pop()
+                    elapsed = time() - start
+                    self.load_times[name] = elapsed - dependencies_time
+                    if len(self.loading_resources) > 0:
+                        self.loading_resources[-1] += elapsed
+                    self.resources[name] = resource
+        return self.resources[name]
+
+    return property(get_resource, doc=load.__doc__)
+
+
+class AsnSearchSpace(object):
+    """
+    The candidate locations of an ASN and the Atlas probes that can be used to geolocate its IPs
+    """
+    def __init__(self, asn, available_locations, target_asn_probes, neighboring_probes, probe_pools=None, rng=None):
+        self.asn = asn
+        self.available_locations = available_locations
+        self.target_asn_probes = target_asn_probes
+        self.neighboring_probes = neighboring_probes
+        # The ProbePool of every available location, in the order of the locations
+        self.probe_pools = probe_pools if probe_pools is not None else list()
+        # The random.Random object that samples the probes of the ASN's targets
+        self.rng = rng if rng is not None else random
+
+
+class GeolocationPipeline(object):
+    """
+    Runs the presence-informed RTT geolocation. Every resource (the geocoding caches, PeeringDB, the IXP LAN table,
+    the pyasn database, the AS relationships, the Atlas probe inventory and the output) is loaded when it is first
+    used, so that a run for a single IP only pays for what it touches.
+    """
+
+    def __init__(self, config, args):
+        """
+        :param config: the configuration dictionary returned by arg_parser.read_config
+        :param args: the command-line arguments returned by arg_parser.parse_arguments
+        """
+        self.config = config
+        self.args = args
+        self.resources = dict()
+        self.resources_lock = threading.RLock()
+        self.load_times = dict()
+        self.loading_resources = list()
+
+        self.probes_num = int(config["PingParameters"]["probes_per_city"])
+        self.packets_num = int(config["PingParameters"]["packets_number"])
+        self.ip_version = int(config["PingParameters"]["ip_version"])
+        self.chunk_size = int(config["PingParameters"]["chunk_size"])
+        # The measurements of a target stop once a probe replies with an RTT below this threshold
+        self.early_stop_rtt = float(config["PingParameters"]["early_stop_rtt"])
+        # The radius around a candidate location in which its probes are searched, in km
+        self.location_radius_km = float(config["PingParameters"]["search_radius_km"])
+        # The seed of the probe sampling, so that runs select the same probes (random if not set)
+        random_seed = config["PingParameters"]["random_seed"].strip()
+        self.random_seed = int(random_seed) if random_seed != "" else None
+        self.rng = random.Random(self.random_seed)
+        self.output_format = config["Output"]["format"]
+        # The compiled results database that is updated at the end of the run, empty to disable
+        self.results_db = config["Output"]["results_db"].strip()
+        self.batch_size = int(config["Input"]["batch_size"])
+        # The global inventory of active probes is only collected once enough ASNs need probes, before that the
+        # probes are requested per country and per ASN
+        self.inventory_min_asns = int(config["Atlas"]["inventory_min_asns"])
+        self.probe_inventory_collected = False
+        self.located_asns = 0
+        # Shared by the worker processes of a sharded run
+        self.atlas_budget = AtlasBudget(config["Atlas"]["measurements_per_minute"], config["Atlas"]["max_credits"])
+        # Targets in the same prefix of this length or in the same alias set are measured as a cluster
+        self.cluster_prefix_length = int(config["Clustering"]["prefix_length"])
+        # The maximum RTT from the representative's closest probes that confirms the location of a cluster member
+        self.verify_max_rtt = float(config["Clustering"]["verify_max_rtt"])
+        # A target is located at a probe of the RTT store whose RTT is below this threshold, without measuring it
+        self.archived_max_rtt = float(config["RttStore"]["max_rtt"])
+        self.archived_max_age = float(config["RttStore"]["max_age_days"]) * 86400
+        # The number of the closest probes of a located target that run a traceroute toward it, 0 to disable
+        self.traceroute_probes = int(config["Traceroute"]["probes"])
+        self.measurement_planner = MeasurementPlanner(self.packets_num, self.chunk_size,
+                                                      config["Atlas"]["max_target_credits"])
+
+        # The ASN before mapping siblings of the targets in flight that are in a sibling ASN, which are released when
+        # the targets of their ASN group are done
+        self.original_asns = dict()
+        # The locations of the IXPs whose peering LANs include targets that are not registered in PeeringDB
+        self.ixp_locations = dict()
+        # The PeeringDB locations of every ASN, since an ASN can have targets in more than one batch
+        self.peeringdb_locations = dict()
+        self.candidate_probes = dict()
+        self.probes_facility = dict()
+        self.probe_objects = dict()
+        self.asn_probes = dict()
+        # The coordinates of every available location, which prune the locations that the archived RTTs rule out
+        self.location_points = dict()
+        self.closed = False
+
+    '''
+    Step 1: Initialization of the resources
+    '''
+    @lazy_resource
+    def cassette_store(self):
+        """
+        The CassetteStore that records and replays the PeeringDB, Google Maps and Atlas probe requests, or None
+        """
+        from Cassette import open_cassette_store
+        return open_cassette_store(self.config["Cassettes"])
+
+    @lazy_resource
+    def geo_encoder(self):
+        """
+        The GeoEncoder used to geocode locations and to query the Maxmind database
+        """
+        from GeoEncoder import GeoEncoder
+        return GeoEncoder(
+            self.config["ApiKeys"]["gmap_key"],
+            self.config["FilePaths"]["maxmind_db"],
+            self.config["FilePaths"]["city_coordinates"],
+            self.config["FilePaths"]["probes_locations"],
+            self.config["FilePaths"]["worldcities_population"],
+            self.config["FilePaths"]["failed_locations"],
+            self.config["GeocodeParameters"]["failed_retry_hours"],
+            self.config["GeocodeParameters"]["failed_retry_max_hours"],
+            self.cassette_store
+        )
+
+    @lazy_resource
+    def cached_location_coordinates(self):
+        """
+        The coordinates for locations that have been encountered in past runs
+        """
+        return self.geo_encoder.read_location_coordinates()
+
+    @lazy_resource
+    def location_index(self):
+        """
+        The LocationIndex that maps the location strings of the presence data to canonical locations
+        """
+        from LocationIndex import LocationIndex
+        return LocationIndex(
+            self.config["FilePaths"]["location_index"],
+            self.config["GeocodeParameters"]["metro_radius_km"]
+        ).load()
+
+    @lazy_resource
+    def cached_probes_locations(self):
+        """
+        The reverse geocoded locations of probe coordinates that have been encountered in past runs
+        """
+        return self.geo_encoder.read_coordinates_location()
+
+    @lazy_resource
+    def failed_locations(self):
+        """
+        The locations that failed to geocode in past runs, which we don't query again until they expire
+        """
+        return self.geo_encoder.read_failed_locations()
+
+    @lazy_resource
+    def peeringdb_api(self):
+        """
+        The PeeringDB API client
+        """
+        import PeeringDB
+        return PeeringDB.API(self.config["PeeringDB"]["base_url"], self.cassette_store)
+
+    @lazy_resource
+    def ixp_lan_table(self):
+        """
+        The IPs and prefixes of the IXP peering LANs
+        """
+        return self.peeringdb_api.get_ixp_lan_table(
+            self.config["FilePaths"]["ixp_lan_table"],
+            self.config["PeeringDB"]["ixp_table_max_age_hours"]
+        )
+
+    @lazy_resource
+    def asndb(self):
+        """
+        The AsnMapper that maps target IPs to ASNs, including the IPs of IXP members
+        """
+        asndb = arg_parser.read_asn_database(self.args.ipasn)
+        asndb.set_ixp_addresses(self.ixp_lan_table.ips, self.ixp_lan_table.asns)
+        asndb.set_siblings(SIBLINGS)
+        return asndb
+
+    @lazy_resource
+    def as_relationships(self):
+        """
+        The AS relationships used to find probes in neighboring ASes
+        """
+        as_relationships = arg_parser.read_as_relationships(self.args.relations)
+        if len(as_relationships) == 0:
+            logger.error("The provided AS relationships file is invalid. "
+                         "The feature of probe selection based on AS relationships will be deactivated which may "
+                         "lead to lower geo-location accuracy.")
+        return as_relationships
+
+    @lazy_resource
+    def extra_locations(self):
+        """
+        The presence data provided by the -p/--presence argument
+        """
+        if self.args.presence is None:
+            return dict()
+        return arg_parser.read_presence_data(self.args.presence)
+
+    @lazy_resource
+    def alias_sets(self):
+        """
+        The alias sets of router IPs used to cluster co-located targets, or None if no alias file is configured
+        """
+        alias_file = self.config["Clustering"]["alias_file"]
+        if alias_file == "":
+            return None
+        return read_alias_sets(alias_file)
+
+    @lazy_resource
+    def probe_health(self):
+        """
+        The ProbeHealthStore with the reliability of the probes measured in this and previous runs
+        """
+        from ProbeHealth import ProbeHealthStore
+        return ProbeHealthStore(
+            self.config["FilePaths"]["probe_health"],
+            self.config["ProbeHealth"]["min_requests"],
+            self.config["ProbeHealth"]["min_response_rate"],
+            self.config["ProbeHealth"]["max_silent_days"],
+            self.config["ProbeHealth"]["window"]
+        ).load()
+
+    @lazy_resource
+    def rtt_store(self):
+        """
+        The RttStore with the RTTs of past Atlas measurements and of the traceroutes harvested by this run
+        """
+        from RttStore import RttStore
+        return RttStore(self.config["FilePaths"]["rtt_store"]).load()
+
+    @lazy_resource
+    def search_space_artifact(self):
+        """
+        The SearchSpaceArtifact with the precomputed candidate locations and probes of every PeeringDB ASN, or None if
+        the artifact hasn't been built or is stale
+        """
+        from SearchSpaceArtifact import SearchSpaceArtifact
+        return SearchSpaceArtifact(
+            self.config["FilePaths"]["search_spaces"],
+            self.config["SearchSpaces"]["max_age_hours"],
+            self.location_radius_km
+        ).load()
+
+    @lazy_resource
+    def atlas_api(self):
+        """
+        The RIPE Atlas API client
+        """
+        from Atlas import Atlas
+        return Atlas(self.config["ApiKeys"]["atlas_key"], self.cassette_store)
+
+    @lazy_resource
+    def already_geolocated_ips(self):
+        """
+        The ResumeIndex of the IPs that have been geolocated in previous runs
+        """
+        return arg_parser.validate_output_file(self.args.output, self.output_format)
+
+    @lazy_resource
+    def result_writer(self):
+        """
+        The ResultWriter of the geolocation output
+        """
+        from ResultWriter import ResultWriter
+        return ResultWriter(
+            self.args.output,
+            self.output_format,
+            self.config["Output"]["buffer_records"],
+            self.config["Output"]["flush_seconds"],
+            self.config["Output"]["fsync"].lower() == "true",
+            self.already_geolocated_ips
+        )
+
+    @lazy_resource
+    def plan_writer(self):
+        """
+        The PlanWriter of the measurement plan of a dry run (--plan)
+        """
+        return PlanWriter(self.args.plan, self.config["Atlas"]["max_credits"])
+
+    def warm_up(self):
+        """
+        Loads every resource and collects the probe inventory, for long-running processes that geolocate targets
+        on demand
+        """
+        for resource in ("location_index", "cached_location_coordinates", "cached_probes_locations", "failed_locations",
+                         "asndb", "as_relationships", "extra_locations", "result_writer"):
+            getattr(self, resource)
+        self.inventory_min_asns = 0
+        self.collect_probe_inventory()
+
+    def refresh(self):
+        """
+        Drops the resources and caches that depend on PeeringDB and on the Atlas probe inventory, so that they are
+        loaded again on next use
+        """
+        if "probe_health" in self.resources:
+            self.probe_health.write()
+        with self.resources_lock:
+            for resource in ("ixp_lan_table", "asndb", "atlas_api", "search_space_artifact"):
+                self.resources.pop(resource, None)
+            self.probe_inventory_collected = False
+            self.peeringdb_locations = dict()
+            self.ixp_locations = dict()
+            self.candidate_probes = dict()
+            self.probes_facility = dict()
+            self.asn_probes = dict()
+
+    def start_metrics(self):
+        """
+        Switches on the profiling of the timers listed in the configuration, and starts the periodic snapshots of the
+        metrics. SIGUSR1 switches the profiling of every timer on and off, and SIGUSR2 writes a snapshot.
+        """
+        for timer_name in self.config["Metrics"]["profile"].split(","):
+            if timer_name.strip() != "":
+                METRICS.enable_profiling(timer_name.strip())
+        snapshot_file = self.config["Metrics"]["snapshot_file"]
+        if snapshot_file != "":
+            METRICS.start_snapshots(snapshot_file, self.config["Metrics"]["snapshot_seconds"])
+        install_signal_handlers(snapshot_file or None, self.config["Metrics"]["profile_dir"])
+
+    def write_metrics(self):
+        """
+        Writes the final snapshot of the metrics and the collected profiles
+        """
+        if self.config["Metrics"]["snapshot_file"] != "":
+            METRICS.write_snapshot(self.config["Metrics"]["snapshot_file"])
+        profile_files = METRICS.write_profiles(self.config["Metrics"]["profile_dir"])
+        if len(profile_files) > 0:
+            logger.info("Profiles written to %s" % ", ".join(profile_files))
+
+    def close(self):
+        """
+        Flushes the buffered results and writes the metrics. Closing the pipeline more than once has no effect.
+        """
+        if self.closed:
+            return
+        self.closed = True
+        if "result_writer" in self.resources:
+            self.result_writer.close()
+            if self.results_db != "":
+                self.compile_results_database(self.results_db)
+        if "plan_writer" in self.resources:
+            self.plan_writer.close()
+        if "probe_health" in self.resources:
+            self.probe_health.write()
+        if "rtt_store" in self.resources and self.rtt_store.has_changes():
+            self.rtt_store.save()
+        self.write_metrics()
+
+    def compile_results_database(self, database_dir, full=False):
+        """
+        Adds the results written to the output since the last compilation to the results database
+        :param database_dir: the directory of the ResultsDatabase
+        :param full: rebuild the database from the whole output
+        :return: the ResultsDatabase, or None if it couldn't be compiled
+        """
+        from ResultsDatabase import ResultsDatabase
+        results_database = ResultsDatabase(database_dir).load()
+        try:
+            with METRICS.timer("results_db_compile"):
+                read_results = results_database.compile(self.args.output, self.output_format, full)
+        except (IOError, ValueError) as e:
+            logger.error("Could not compile the results database `%s`: %s" % (database_dir, str(e)))
+            return None
+        if read_results is None:
+            return None
+        logger.info("Compiled %s new results into the results database `%s`, which has %s IPs in %s ranges" %
+                    (read_results, database_dir, results_database.ips_num(), len(results_database)))
+        return results_database
+
+    def compile_search_spaces(self, artifact_dir):
+        """
+        Runs Steps 2 and 3 for every ASN in PeeringDB, with the bulk PeeringDB requests and the global probe inventory,
+        and writes the search space artifact that later runs read instead
+        :param artifact_dir: the directory of the artifact
+        :return: the number of ASNs in the artifact, or None if it couldn't be built
+        """
+        from SearchSpaceArtifact import SearchSpaceArtifact
+        self.inventory_min_asns = 0
+        self.collect_probe_inventory()
+        asn_locations = self.peeringdb_api.get_all_asn_locations()
+        if asn_locations is False:
+            logger.error("Could not download the presence of the ASNs from PeeringDB.")
+            return None
+
+        resolved_locations = dict()
+        compiled_asn_locations = dict()
+        for asn in sorted(asn_locations):
+            gmap_locations = set()
+            for location in asn_locations[asn]:
+                if location not in resolved_locations:
+                    resolved_locations[location] = self.resolve_location(location)
+                if resolved_locations[location] is not None:
+                    gmap_locations.add(resolved_locations[location])
+            compiled_asn_locations[asn] = sorted(gmap_locations)
+        locations = dict((gmap_location, self.location_points[gmap_location] +
+                          (sorted(self.candidate_probes[gmap_location]),))
+                         for gmap_location in set(resolved_locations.itervalues()) if gmap_location is not None)
+
+        asn_probes = dict()
+        probe_objects = dict((probe_id, self.probe_objects[probe_id])
+                             for _, _, probe_ids in locations.itervalues() for probe_id in probe_ids)
+        for asn, asn_probe_objects in self.atlas_api.asn_probes.iteritems():
+            asn_probes[asn] = [probe_object.id for probe_object in asn_probe_objects]
+            for probe_object in asn_probe_objects:
+                probe_objects[probe_object.id] = probe_object
+        artifact = SearchSpaceArtifact(artifact_dir, search_radius_km=self.location_radius_km)
+        if not artifact.write(compiled_asn_locations, locations, asn_probes, probe_objects):
+            return None
+        return len(set(compiled_asn_locations) | set(asn_probes))
+
+    def iter_geolocation_targets(self):
+        """
+        Reads the geolocation targets in batches and groups each batch per ASN, so that the measurements for the first
+        ASNs start while the rest of the input is still being read
+        :return: a generator of (ASN, list of target IPs, set of candidate locations hinted by the target IPs) tuples
+        """
+        target_ranges = target_reader.iter_target_ranges(self.args.ip, self.args.file)
+        read_targets = 0
+        for ip_batch in target_reader.iter_target_batches(target_ranges, self.batch_size):
+            read_targets += len(ip_batch)
+            new_ip_batch = self.already_geolocated_ips.filter_new(ip_batch)
+            if len(new_ip_batch) < len(ip_batch):
+                logger.info("Skipping %s IPs because they are already geolocated." %
+                            (len(ip_batch) - len(new_ip_batch)))
+            if len(new_ip_batch) == 0:
+                continue
+            for target_group in self.group_targets(new_ip_batch):
+                yield target_group
+        if read_targets == 0:
+            logger.critical("Program exits because no valid IP address was provided as geo-location target.")
+            sys.exit(-1)
+
+    def group_targets(self, ip_batch):
+        """
+        Groups a batch of targets per ASN and collects the candidate locations that each target hints
+        :param ip_batch: a numpy array of integer target IPs
+        :return: a list of (ASN, list of target IPs, set of candidate locations hinted by the target IPs) tuples
+        """
+        target_batch = [int_to_ip(ip) for ip in ip_batch.tolist()]
+
+        print "Querying Maxmind for IP locations"
+        maxmind_locations = self.geo_encoder.query_maxmind_batch(target_batch)
+
+        # Targets in an IXP peering LAN prefix which are not registered in PeeringDB are at one of the IXP's locations
+        batch_ixp_ids = self.ixp_lan_table.lookup_prefixes(ip_batch)
+        batch_ixp_ids[self.asndb.is_ixp_ip(ip_batch)] = 0
+        target_ixps = dict((target_ip, ix_id) for target_ip, ix_id in zip(target_batch, batch_ixp_ids.tolist())
+                           if ix_id != 0)
+
+        batch_asns = self.asndb.map_asns(ip_batch)
+        self.original_asns.update((target_ip, target_asn) for target_ip, target_asn in
+                                  zip(target_batch, batch_asns.tolist()) if target_asn in self.asndb.siblings)
+        asn_targets = self.asndb.group_by_asn(ip_batch, batch_asns)
+        target_groups = list()
+        for target_asn in asn_targets:
+            asn_targets[target_asn] = [int_to_ip(ip) for ip in asn_targets[target_asn].tolist()]
+            if target_asn == self.asndb.UNKNOWN_ASN:
+                logger.warning("Skipping %s IPs which are not covered by any prefix of the pyasn database." %
+                               len(asn_targets[target_asn]))
+                continue
+            # Add the locations provided by MaxMind in the list of possible locations in which we should ping
+            target_locations = set()
+            for target_ip in asn_targets[target_asn]:
+                if target_ip in maxmind_locations:
+                    target_locations.add(maxmind_locations[target_ip])
+                if target_ip in target_ixps:
+                    ix_id = target_ixps[target_ip]
+                    if ix_id not in self.ixp_locations:
+                        self.ixp_locations[ix_id] = self.peeringdb_api.get_ixp_locations(ix_id)
+                    target_locations |= self.ixp_locations[ix_id]
+            target_groups.append((target_asn, asn_targets[target_asn], target_locations))
+        return target_groups
+
+    def release_targets(self, target_ips):
+        """
+        Forgets the original ASNs of targets whose geolocation is done
+        :param target_ips: the target IP addresses
+        """
+        for target_ip in target_ips:
+            self.original_asns.pop(target_ip, None)
+
+    def collect_probe_inventory(self):
+        """
+        Collects the active Atlas probes per ASN and per country once enough ASNs have been located
+        """
+        if not self.probe_inventory_collected and self.located_asns >= self.inventory_min_asns:
+            print "Collect the active Atlas probes per ASN and per country"
+            with METRICS.timer("probe_inventory"):
+                self.atlas_api.collect_active_probes()
+            self.probe_inventory_collected = True
+
+    def get_asn_probes(self, target_asn):
+        """
+        Returns the active probes in an ASN, from the probe inventory if it has been collected
+        :param target_asn: the ASN
+        :return: a set of Atlas.Probe objects
+        """
+        if self.probe_inventory_collected:
+            return self.atlas_api.asn_probes.get(target_asn, set())
+        if target_asn not in self.asn_probes:
+            with METRICS.timer("probe_search", scope="asn"):
+                self.asn_probes[target_asn] = self.atlas_api.select_probes_in_asn(target_asn)
+        return self.asn_probes[target_asn]
+
+    def get_location_coordinates(self, location):
+        """
+        Returns the coordinates of a location, geocoding it if it has not been encountered before
+        :param location: the location string, in the format of city|country
+        :return: the dictionary with the location data, or False if the location can't be geocoded
+        """
+        location = location.lower()
+        # Get the coordinates for this location
+        if location in self.cached_location_coordinates:
+            # if we have found the coordinates for this location before read it from the cached coordinates file ...
+            METRICS.increment("geocode_lookups", result="hit")
+            return self.cached_location_coordinates[location]
+        elif self.geo_encoder.is_failed_location(self.failed_locations, location):
+            # ... if the location failed to geocode recently don't spend API quota on it again ...
+            print "Warning: Skipping location %s which failed to geocode (%s)" % (
+                location, self.failed_locations[location]["reason"])
+            METRICS.increment("geocode_lookups", result="failed_cache")
+            return False
+
+        # ... otherwise query the Google Maps API for the coordinates ...
+        METRICS.increment("geocode_lookups", result="miss")
+        with METRICS.timer("geocode"):
+            location_data, failure_reason = self.geo_encoder.geocode_location(location)
+        # ... and store the coordinates, or the reason of the failure, in the corresponding file
+        if location_data is not False:
+            self.geo_encoder.write_location_coordinates(location, location_data)
+            self.cached_location_coordinates[location] = location_data
+        else:
+            self.geo_encoder.record_failed_location(self.failed_locations, location, failure_reason)
+            print "Warning: Could not find the coordinates for: %s" % location
+        return location_data
+
+    @METRICS.timed("asn_locate")
+    def locate_asn(self, target_asn, target_locations):
+        """
+        Runs Steps 2 and 3 for an ASN: finds its candidate locations and the Atlas probes in them
+        :param target_asn: the target ASN
+        :param target_locations: the candidate locations hinted by the target IPs (Maxmind, IXP peering LANs)
+        :return: an AsnSearchSpace object
+        """
+        '''
+        Step 2: Get the candidate AS locations based on presence information at IXPs and Facilities
+        '''
+        print("Getting the locations of AS%s" % target_asn)
+        self.located_asns += 1
+        self.collect_probe_inventory()
+
+        # The search space artifact has the geocoded PeeringDB locations of the ASN and their probes, only the
+        # locations hinted by the targets and by the presence file are resolved at runtime
+        compiled_search_space = None
+        if self.search_space_artifact is not None:
+            compiled_search_space = self.search_space_artifact.lookup(target_asn)
+            METRICS.increment("search_space_artifact", result="miss" if compiled_search_space is None else "hit")
+        if compiled_search_space is None:
+            if target_asn not in self.peeringdb_locations:
+                self.peeringdb_locations[target_asn] = self.peeringdb_api.get_asn_locations(target_asn).locations
+            asn_locations = target_locations | self.peeringdb_locations[target_asn]
+        else:
+            asn_locations = set(target_locations)
+        if target_asn in self.extra_locations:
+            asn_locations |= self.extra_locations[target_asn]
+
+        '''
+        Step 3: Get the available Atlas probes in the candidate locations
+        '''
+        target_asn_probes = set()
+        available_locations = set()
+        if compiled_search_space is not None:
+            for gmap_location, lat, lng, probe_ids in compiled_search_space[0]:
+                self.add_compiled_location(gmap_location, lat, lng, probe_ids)
+                available_locations.add(gmap_location)
+        for location in asn_locations:
+            gmap_location = self.resolve_location(location)
+            if gmap_location is not None:
+                available_locations.add(gmap_location)
+
+        # Get the probes in the target ASN
+        if compiled_search_space is not None:
+            asn_probe_objects = [self.search_space_artifact.get_probe(probe_id)
+                                 for probe_id in compiled_search_space[1]]
+        else:
+            asn_probe_objects = self.get_asn_probes(target_asn)
+        for probe_object in asn_probe_objects:
+            target_asn_probes.add(probe_object.id)
+            self.probe_objects[probe_object.id] = probe_object
+        if len(target_asn_probes) > 0:
+            target_asn_probes = set(self.probe_health.healthy_probes(target_asn_probes))
+
+        # Get the probes in ASes that are neighboring to the target ASN
+        neighboring_probes = find_neighboring_probes(self.probe_objects.values(), target_asn, self.as_relationships)
+
+        # Prepare the probes of every location once, so that Step 4 only draws from them for each target
+        # The probes that stopped replying in previous measurements are left out of the pools
+        probe_pools = [ProbePool(location, self.probe_health.healthy_probes(self.candidate_probes[location]),
+                                 self.probe_objects, neighboring_probes)
+                       for location in sorted(available_locations)]
+        return AsnSearchSpace(target_asn, available_locations, target_asn_probes, neighboring_probes, probe_pools,
+                              self.get_asn_rng(target_asn))
+
+    def canonical_location(self, location):
+        """
+        Maps a location string to its canonical location in the LocationIndex, geocoding it only if none of its
+        aliases is in the index
+        :param location: the location string, in the format of city|country
+        :return: the location ID, in the format of City|Country, or None if the location can't be geocoded
+        """
+        location_id = self.location_index.lookup(location)
+        if location_id is not None:
+            METRICS.increment("location_index", result="hit")
+            return location_id
+        location_data = self.get_location_coordinates(location)
+        if location_data is False:
+            return None
+        METRICS.increment("location_index", result="added")
+        return self.location_index.add(location, location_data)
+
+    def resolve_location(self, location):
+        """
+        Maps a candidate location to its canonical location and finds the Atlas probes around it, once per
+        canonical location
+        :param location: the location string, in the format of city|country
+        :return: the location ID, in the format of City|Country, or None if the location can't be geocoded or has no
+        probes
+        """
+        gmap_location = self.canonical_location(location)
+        if gmap_location is None:
+            return None
+        location_data = self.location_index.get(gmap_location)
+        self.location_points[gmap_location] = (location_data["lat"], location_data["lng"])
+        # If we have found the probes in this location in a previous iteration don't search again
+        if gmap_location in self.candidate_probes:
+            return gmap_location
+        print "Getting probes for location: %s" % gmap_location
+        # Get the probes in this location
+        if gmap_location in self.atlas_api.city_probes:
+            available_probes = self.atlas_api.city_probes[gmap_location]
+        else:
+            with METRICS.timer("probe_search", scope="location"):
+                available_probes = self.atlas_api.select_probes_in_location(
+                    location_data["lat"],
+                    location_data["lng"],
+                    location_data["country"],
+                    self.location_radius_km
+                )
+            self.atlas_api.city_probes[gmap_location] = available_probes
+
+        if len(available_probes) == 0:
+            print "Warning: No available probes in the location: %s %s" % (
+                location_data["city"], location_data["country"])
+            return None
+        self.candidate_probes[gmap_location] = set()
+        for probe_object in available_probes:
+            self.candidate_probes[gmap_location].add(probe_object.id)
+            self.probes_facility[probe_object.id] = gmap_location
+            self.probe_objects[probe_object.id] = probe_object
+        return gmap_location
+
+    def add_compiled_location(self, gmap_location, lat, lng, probe_ids):
+        """
+        Adds a geocoded location of the search space artifact and its probes, like resolve_location does for the
+        locations that are resolved at runtime
+        :param gmap_location: the geocoded location, in the format of City|Country
+        :param lat: the latitude of the location
+        :param lng: the longitude of the location
+        :param probe_ids: the list of the IDs of the probes around the location
+        """
+        self.location_points[gmap_location] = (lat, lng)
+        if gmap_location in self.candidate_probes:
+            return
+        self.candidate_probes[gmap_location] = set(probe_ids)
+        for probe_id in probe_ids:
+            self.probes_facility[probe_id] = gmap_location
+            if probe_id not in self.probe_objects:
+                self.probe_objects[probe_id] = self.search_space_artifact.get_probe(probe_id)
+
+    def get_asn_rng(self, target_asn):
+        """
+        Returns the random number generator that samples the probes of an ASN. With a configured seed every ASN has
+        its own generator seeded from the seed and the ASN, so the probes of a target don't depend on the order in
+        which the ASNs are located or on the worker process that measures them.
+        :param target_asn: the target ASN
+        :return: a random.Random object
+        """
+        if self.random_seed is None:
+            return self.rng
+        return random.Random((self.random_seed, target_asn))
+
+    @METRICS.timed("probe_sampling")
+    def select_probes(self, search_space):
+        """
+        Step 4: Sample the available Atlas probes in the candidate cities to meet the querying budget restrictions
+        This step is repeated for every IP address even if it's under the same AS to minimize artifacts caused by
+        biases in the sampling process
+        :param search_space: the AsnSearchSpace of the target's ASN
+        :return: the set of selected probe IDs
+        """
+        selected_probes = set(search_space.target_asn_probes)
+        for probe_pool in search_space.probe_pools:
+            # Probes in neighboring ASes first, then random probes of the location
+            selected_probes.update(probe_pool.sample(self.probes_num, search_space.rng))
+        return selected_probes
+
+    @METRICS.timed("measurement")
+    def measure_target(self, target_ip, selected_probes, atlas_api=None, probe_rtts=None):
+        """
+        Step 5: Run the RTT-based geolocation
+        :param target_ip: the target IP address
+        :param selected_probes: the list of probe IDs to measure from, in the order of the measurements
+        :param atlas_api: the Atlas client that runs the measurements (defaults to the pipeline's client)
+        :param probe_rtts: a dictionary that is filled with the minimum RTT of every probe that replied, or None
+        :return: a tuple with the ID of the probe with the minimum RTT (0 if no probe replied, None if the credit
+        budget of the run didn't allow any measurement) and the minimum RTT
+        """
+        if atlas_api is None:
+            atlas_api = self.atlas_api
+        prv_min_rtt = sys.maxint
+        closest_probe = 0
+        probes_slices = slice_selected_probes(list(selected_probes), self.chunk_size)
+        for index, probes_slice in enumerate(probes_slices):
+            print "Querying probes %s - %s" % (1*(index+1), self.chunk_size*(index+1))
+            af = self.ip_version
+            description = "Presence-informed RTT geolocation"
+
+            probes_slice = self.acquire_credits(probes_slice)
+            if len(probes_slice) == 0:
+                logger.warning("Stopping the measurements of %s because the Atlas credit budget is spent." %
+                               target_ip)
+                if index == 0:
+                    closest_probe = None
+                break
+            ping_results = atlas_api.ping_measurement(af, target_ip, description, self.packets_num, probes_slice)
+            self.probe_health.record_measurement(probes_slice, ping_results)
+
+            for probe_id, rtt_summary in ping_results.iteritems():
+                if rtt_summary.received == 0:
+                    continue
+                probe_min_rtt = rtt_summary.min_rtt
+                if probe_rtts is not None:
+                    probe_rtts[probe_id] = probe_min_rtt
+                if probe_min_rtt < prv_min_rtt:
+                    prv_min_rtt = probe_min_rtt
+                    closest_probe = probe_id
+            # If we found a probe with very low RTT we don't need to run all the pings
+            if prv_min_rtt < self.early_stop_rtt:
+                break
+        return closest_probe, prv_min_rtt
+
+    def acquire_credits(self, probes_slice):
+        """
+        Reserves the credits of a measurement in the run budget. When the whole measurement doesn't fit, the
+        lowest-value probes at the end of the slice are trimmed to the remaining credits.
+        :param probes_slice: the list of probe IDs of the measurement
+        :return: the list of probe IDs that can be measured, empty if the budget is spent
+        """
+        if self.atlas_budget.acquire(estimate_ping_credits(self.packets_num, len(probes_slice))):
+            return probes_slice
+        remaining_credits = self.atlas_budget.remaining_credits() or 0
+        probes_num = min(len(probes_slice), remaining_credits // max(1, self.packets_num))
+        if probes_num > 0 and self.atlas_budget.acquire(estimate_ping_credits(self.packets_num, probes_num)):
+            METRICS.increment("trimmed_probes", len(probes_slice) - probes_num, budget="run")
+            return probes_slice[:probes_num]
+        return []
+
+    def get_probe_location(self, probe_object):
+        """
+        Returns the reverse geocoded location of a probe
+        :param probe_object: the Atlas.Probe object
+        :return: a tuple with the coordinates string and the dictionary with the locality, the administrative area
+        and the country of the probe
+        """
+        # Check if we have obtained the location for the probe coordinates previously ...
+        probe_coordinates = "%s,%s" % (probe_object.lat, probe_object.lng)
+        if not probe_coordinates in self.cached_probes_locations:
+            reverse_location = self.geo_encoder.query_coordinates_location(probe_object.lat, probe_object.lng)
+            # write the reverse location in the probes_locations file
+            self.geo_encoder.write_coordinates_location(probe_object.lat, probe_object.lng, reverse_location)
+            self.cached_probes_locations[probe_coordinates] = {
+                "locality": reverse_location["locality"],
+                "admn_lvl_2": reverse_location["admn_lvl_2"],
+                "country": reverse_location["country"]
+            }
+        return probe_coordinates, self.cached_probes_locations[probe_coordinates]
+
+    def write_result(self, target_ip, target_asn, closest_probe, min_rtt):
+        """
+        Writes the location of the probe with the minimum RTT as the location of the target
+        :param target_ip: the target IP address
+        :param target_asn: the target ASN
+        :param closest_probe: the ID of the probe with the minimum RTT
+        :param min_rtt: the minimum RTT
+        :return: the result record that was written
+        """
+        probe_object = self.probe_objects[closest_probe]
+        probe_coordinates, probe_location_data = self.get_probe_location(probe_object)
+        probe_location = "%s|%s|%s" % (
+            probe_location_data["locality"],
+            probe_location_data["admn_lvl_2"],
+            probe_location_data["country"]
+        )
+
+        nearest_facility_city = "False"
+        if closest_probe in self.probes_facility:
+            nearest_facility_city = self.probes_facility[closest_probe].split("|")[0]
+        comment = None
+
+        original_asn = self.original_asns.get(target_ip, target_asn)
+        if min_rtt < 5:
+            print "Target [%s,%s] | Closest Probe [%s,%s, %s] | Closest Facility [%s] | Min. RTT [%s] " % \
+                  (target_ip, original_asn, closest_probe, probe_location, probe_coordinates,
+                   nearest_facility_city, min_rtt)
+        else:
+            logger.warning(
+                "Couldn't converge to a target for IP %s. Possibly incomplete presence data." % target_ip)
+            logger.info("The closest probe for [%s,%s] is %s in %s with RTT %s" %
+                        (target_ip, original_asn, closest_probe, probe_location, min_rtt))
+            comment = "Too high minimum RTT"
+
+        # Save all result, even those above the RTT threshold. Since RTT is part of the output
+        # it can be used to decide if geolocation was successful or not
+        result = {
+            "ip": target_ip,
+            "asn": target_asn,
+            "city": probe_location_data["locality"],
+            "admn_lvl_2": probe_location_data["admn_lvl_2"],
+            "country": probe_location_data["country"],
+            "lat": probe_object.lat,
+            "lng": probe_object.lng,
+            "min_rtt": min_rtt,
+            "facility_city": nearest_facility_city,
+            "comment": comment
+        }
+        self.result_writer.write(result)
+        return result
+
+    def archived_rtts(self, target_ip):
+        """
+        Returns the RTTs of a target in the RTT store, from the probes whose location is known, i.e. the probes in
+        the candidate locations and in the ASNs located so far
+        :param target_ip: the target IP address
+        :return: a list of (probe ID, minimum RTT) tuples, sorted by RTT
+        """
+        if self.rtt_store.is_empty():
+            return []
+        min_timestamp = int(time() - self.archived_max_age) if self.archived_max_age > 0 else 0
+        return [(probe_id, rtt) for probe_id, rtt in self.rtt_store.lookup(ip_to_int(target_ip), min_timestamp)
+                if probe_id in self.probe_objects]
+
+    def prune_search_space(self, search_space, archived_rtts):
+        """
+        Drops the candidate locations that are farther from a probe of the archived RTTs than the probe's RTT allows.
+        If the archived RTTs rule out every location they contradict the presence data, and the search space is kept.
+        :param search_space: the AsnSearchSpace of the target's ASN
+        :param archived_rtts: the list of (probe ID, minimum RTT) tuples of the target
+        :return: an AsnSearchSpace with the remaining locations
+        """
+        constraints = [(self.probe_objects[probe_id].lat, self.probe_objects[probe_id].lng,
+                        max_distance_km(rtt) + self.location_radius_km) for probe_id, rtt in archived_rtts]
+        probe_pools = list()
+        for probe_pool in search_space.probe_pools:
+            point = self.location_points.get(probe_pool.location)
+            if point is None or all(haversine_km(point[0], point[1], lat, lng) <= radius
+                                    for lat, lng, radius in constraints):
+                probe_pools.append(probe_pool)
+        if len(probe_pools) == len(search_space.probe_pools):
+            return search_space
+        if len(probe_pools) == 0:
+            METRICS.increment("archived_pruning", result="conflict")
+            return search_space
+        METRICS.increment("archived_pruning", result="pruned")
+        METRICS.increment("pruned_locations", len(search_space.probe_pools) - len(probe_pools))
+        return AsnSearchSpace(search_space.asn, set(probe_pool.location for probe_pool in probe_pools),
+                              search_space.target_asn_probes, search_space.neighboring_probes, probe_pools,
+                              search_space.rng)
+
+    def check_archived_rtts(self, target_ip, search_space):
+        """
+        Looks up a target in the RTT store before it is measured
+        :param target_ip: the target IP address
+        :param search_space: the AsnSearchSpace of the target's ASN
+        :return: a tuple with the archived (probe ID, minimum RTT) tuples of the target if the lowest RTT locates it
+        (an empty list otherwise), and the search space pruned by the archived RTTs
+        """
+        archived_rtts = self.archived_rtts(target_ip)
+        if len(archived_rtts) == 0:
+            return [], search_space
+        if archived_rtts[0][1] < self.archived_max_rtt:
+            return archived_rtts, search_space
+        return [], self.prune_search_space(search_space, archived_rtts)
+
+    def write_archived_result(self, target_ip, search_space, archived_rtts, probe_rtts=None):
+        """
+        Writes the location of a target located by the RTT store
+        :param target_ip: the target IP address
+        :param search_space: the AsnSearchSpace of the target's ASN
+        :param archived_rtts: the archived (probe ID, minimum RTT) tuples of the target, sorted by RTT
+        :param probe_rtts: a dictionary that is filled with the archived RTTs, or None
+        :return: the result record that was written
+        """
+        logger.info("Locating %s from the RTT store without measuring it." % target_ip)
+        if probe_rtts is not None:
+            probe_rtts.update(archived_rtts)
+        METRICS.increment("targets", outcome="archived")
+        closest_probe, min_rtt = archived_rtts[0]
+        return self.write_result(target_ip, search_space.asn, closest_probe, min_rtt)
+
+    def plan_target(self, target_ip, selected_probes, search_space):
+        """
+        Orders the selected probes by their value and trims them to the per-target credit budget
+        :param target_ip: the target IP address
+        :param selected_probes: the set of selected probe IDs
+        :param search_space: the AsnSearchSpace of the target's ASN
+        :return: the measurement plan of the target, see MeasurementPlanner.plan_target
+        """
+        plan = self.measurement_planner.plan_target(target_ip, selected_probes, search_space, self.probe_health)
+        if plan["trimmed_probes"] > 0:
+            logger.info("Trimmed %s probes of %s to meet the per-target credit budget." %
+                        (plan["trimmed_probes"], target_ip))
+            METRICS.increment("trimmed_probes", plan["trimmed_probes"], budget="target")
+        return plan
+
+    @METRICS.timed("target")
+    def geolocate_target(self, target_ip, search_space, probe_rtts=None, on_measured=None):
+        """
+        Runs Steps 4 and 5 for a target IP and writes the result
+        :param target_ip: the target IP address
+        :param search_space: the AsnSearchSpace of the target's ASN
+        :param probe_rtts: a dictionary that is filled with the minimum RTT of every probe that replied, or None
+        :param on_measured: a function that is called with the result when the target was located by a measurement,
+        and not from the RTT store, or None
+        :return: the result record, or None if the target could not be geolocated
+        """
+        logger.info("Running geolocation for IP %s in AS%s" % (target_ip, search_space.asn))
+        archived_rtts, search_space = self.check_archived_rtts(target_ip, search_space)
+        if len(archived_rtts) > 0:
+            return self.write_archived_result(target_ip, search_space, archived_rtts, probe_rtts)
+        # TODO Order countries by number of presences to find the main country from which we start the measurements
+        selected_probes = self.select_probes(search_space)
+        print "Total number of selected probes: %s" % len(selected_probes)
+        if len(selected_probes) == 0:
+            print "Error: couldn't find any Atlas probe in the requested locations"
+            METRICS.increment("targets", outcome="no_probes")
+            return None
+
+        plan = self.plan_target(target_ip, selected_probes, search_space)
+        closest_probe, min_rtt = self.measure_target(target_ip, plan["probes"], probe_rtts=probe_rtts)
+        if closest_probe is None:
+            # The target isn't written to the output, so it is measured again by the next run
+            logger.warning("Deferring %s to a later run because the Atlas credit budget is spent." % target_ip)
+            METRICS.increment("targets", outcome="deferred")
+            return None
+        if closest_probe == 0:
+            logger.error(
+                "The destination IP %s was unreachable from every probe." % target_ip
+            )
+            METRICS.increment("targets", outcome="unreachable")
+            return None
+        METRICS.increment("targets", outcome="located")
+        result = self.write_result(target_ip, search_space.asn, closest_probe, min_rtt)
+        if on_measured is not None:
+            on_measured(result)
+        return result
+
+    @METRICS.timed("verification")
+    def verify_target(self, target_ip, search_space, verification_probes):
+        """
+        Measures a member of a cluster of co-located targets only from the closest probes of the cluster's
+        representative. If none of them confirms that the target is close, the target is geolocated with Steps 4 and
+        5 like any other target.
+        :param target_ip: the target IP address
+        :param search_space: the AsnSearchSpace of the target's ASN
+        :param verification_probes: the list of probe IDs that were closest to the representative
+        :return: the result record, or None if the target could not be geolocated
+        """
+        archived_rtts, _ = self.check_archived_rtts(target_ip, search_space)
+        if len(archived_rtts) > 0:
+            return self.write_archived_result(target_ip, search_space, archived_rtts)
+        closest_probe, min_rtt = self.measure_target(target_ip, verification_probes)
+        if closest_probe is None:
+            logger.warning("Deferring %s to a later run because the Atlas credit budget is spent." % target_ip)
+            METRICS.increment("targets", outcome="deferred")
+            return None
+        if closest_probe != 0 and min_rtt < self.verify_max_rtt:
+            METRICS.increment("cluster_verifications", result="confirmed")
+            METRICS.increment("targets", outcome="verified")
+            return self.write_result(target_ip, search_space.asn, closest_probe, min_rtt)
+        logger.info("The closest probes of the cluster did not confirm the location of %s, measuring it from every "
+                    "selected probe." % target_ip)
+        METRICS.increment("cluster_verifications", result="fallback")
+        return self.geolocate_target(target_ip, search_space)
+
+    @METRICS.timed("traceroute_harvest")
+    def harvest_traceroutes(self, target_ip, probe_rtts):
+        """
+        Runs a traceroute toward a located target from its closest probes, and records the RTT of every hop that is
+        a border interface (it maps to an ASN or to an IXP peering LAN) in the RTT store. The hops near the end of
+        the path are close to the probes too, so the targets among them are then located from the RTT store without
+        a measurement of their own.
+        :param target_ip: the target IP address
+        :param probe_rtts: the dictionary with the minimum RTT of every probe that replied to the target
+        :return: the number of hop RTTs that were recorded
+        """
+        probes = sorted(probe_rtts, key=probe_rtts.get)[:self.traceroute_probes]
+        if len(probes) == 0 or not self.atlas_budget.acquire(estimate_traceroute_credits(len(probes))):
+            return 0
+        from atlas_archive import iter_traceroute_rtts
+        results = self.atlas_api.traceroute_measurement(self.ip_version, target_ip,
+                                                        "Presence-informed RTT geolocation", probes)
+        target_int = ip_to_int(target_ip)
+        hop_rtts = [hop_rtt for hop_rtt in iter_traceroute_rtts(results) if hop_rtt[0] != target_int]
+        if len(hop_rtts) == 0:
+            return 0
+        hop_ips = np.array([hop_rtt[0] for hop_rtt in hop_rtts], dtype=np.uint32)
+        is_border = (self.asndb.map_asns(hop_ips) != self.asndb.UNKNOWN_ASN) | \
+                    (self.ixp_lan_table.lookup_prefixes(hop_ips) != 0)
+        recorded = 0
+        for hop_rtt, border in zip(hop_rtts, is_border.tolist()):
+            if border:
+                self.rtt_store.record(*(hop_rtt + (SOURCE_TRACEROUTE,)))
+                recorded += 1
+        METRICS.increment("harvested_hops", recorded)
+        return recorded
+
+    def iter_target_clusters(self, target_asn_ips):
+        """
+        Groups the targets of an ASN that are probably co-located, see target_clusters.cluster_targets
+        :param target_asn_ips: the list of target IPs of an ASN
+        :return: a list of clusters, each a list of target IPs that starts with the representative of the cluster
+        """
+        clusters = cluster_targets(target_asn_ips, self.cluster_prefix_length, self.alias_sets)
+        if len(clusters) < len(target_asn_ips):
+            METRICS.increment("clustered_targets", len(target_asn_ips) - len(clusters))
+        return clusters
+
+    def locate_stage(self, target_group):
+        """
+        The stage of the staged execution that runs Steps 2 and 3 for an ASN
+        :param target_group: an (ASN, list of target IPs, set of hinted locations) tuple
+        :return: a generator with the (AsnSearchSpace, list of target IPs) tuple of the ASN
+        """
+        target_asn, target_asn_ips, target_locations = target_group
+        yield self.locate_asn(target_asn, target_locations), target_asn_ips
+
+    def measure_stage(self, located_group):
+        """
+        The stage of the staged execution that runs Steps 4 and 5 for the targets of an ASN
+        :param located_group: an (AsnSearchSpace, list of target IPs) tuple
+        :return: an empty generator, the results are written to the output
+        """
+        search_space, target_asn_ips = located_group
+        try:
+            for cluster in self.iter_target_clusters(target_asn_ips):
+                probe_rtts = dict()
+                # The targets located from the RTT store have no measurement whose closest probes could traceroute
+                on_measured = None
+                if self.traceroute_probes > 0:
+                    on_measured = lambda result: self.harvest_traceroutes(result["ip"], probe_rtts)
+                self.geolocate_target(cluster[0], search_space, probe_rtts, on_measured)
+                # The other members of the cluster are verified from the winning probe and its runner-up
+                verification_probes = sorted(probe_rtts, key=probe_rtts.get)[:2]
+                for target_ip in cluster[1:]:
+                    if len(verification_probes) > 0:
+                        self.verify_target(target_ip, search_space, verification_probes)
+                    else:
+                        self.geolocate_target(target_ip, search_space)
+        finally:
+            self.release_targets(target_asn_ips)
+        return iter(())
+
+    def plan_stage(self, located_group):
+        """
+        The stage of a dry run that replaces Step 5: it selects the probes of the targets of an ASN and writes their
+        measurement plan without measuring
+        :param located_group: an (AsnSearchSpace, list of target IPs) tuple
+        :return: an empty generator, the plans are written to the plan file
+        """
+        search_space, target_asn_ips = located_group
+        for cluster in self.iter_target_clusters(target_asn_ips):
+            # The targets that the RTT store locates are not measured
+            archived_rtts, target_search_space = self.check_archived_rtts(cluster[0], search_space)
+            if len(archived_rtts) == 0:
+                selected_probes = self.select_probes(target_search_space)
+                self.plan_writer.write(self.plan_target(cluster[0], selected_probes, target_search_space))
+            for target_ip in cluster[1:]:
+                self.plan_writer.write(
+                    self.measurement_planner.plan_verification(target_ip, search_space, cluster[0]))
+        self.release_targets(target_asn_ips)
+        return iter(())
+
+    def run(self):
+        """
+        Geolocates all the targets. Reading the targets, locating the ASNs (presence, geocoding and probe search) and
+        measuring the targets run as concurrent stages, so that the next ASNs are located while the targets of the
+        current ASN are measured. With more than one worker the ASNs are sharded across worker processes. A dry run
+        (--plan) runs Steps 1-4 in a single process and writes the measurement plan instead of measuring.
+        """
+        if self.args.plan is None and self.args.workers > 1:
+            import ShardedExecution
+            ShardedExecution.run_sharded(self, self.args.workers)
+            return
+        queue_size = self.config["Pipeline"]["queue_size"]
+        staged_pipeline = StagedPipeline([
+            PipelineStage("locate", self.locate_stage, queue_size),
+            PipelineStage("measure", self.measure_stage, queue_size) if self.args.plan is None else
+            PipelineStage("plan", self.plan_stage, queue_size)
+        ], self.config["Pipeline"]["report_seconds"])
+        staged_pipeline.run(self.iter_geolocation_targets())
+
+
+def main(argv=None):
+    """
+    The entry point of the presence-informed RTT geolocation
+    :param argv: the command-line arguments (defaults to sys.argv)
+    """
+    # Read the configuration parameters
+    config = arg_parser.read_config()
+    args = arg_parser.parse_arguments(argv)
+    pipeline = GeolocationPipeline(config, args)
+    pipeline.start_metrics()
+    # Flush the buffered results also when the program exits early because of an error
+    atexit.register(pipeline.close)
+    if args.serve is not None:
+        import GeolocationService
+        GeolocationService.serve(pipeline, config, args.serve)
+    else:
+        pipeline.run()
+    pipeline.close()
+    return pipeline
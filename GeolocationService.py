@@ -0,0 +1,507 @@
+# coding=latin-1
+import os
+import socket
+import logging
+import threading
+import itertools
+import Queue
+import BaseHTTPServer
+import SocketServer
+from time import time
+from urlparse import urlparse, parse_qs
+import numpy as np
+from ujson import dumps, loads
+import target_reader
+from ip_utils import ip_to_int, int_to_ip
+from Metrics import METRICS
+
+logging.basicConfig()
+logger = logging.getLogger("Service")
+logger.setLevel(logging.INFO)
+
+
+def parse_listen_address(address):
+    """
+    Parses the address on which the service listens
+    :param address: `host:port` or `port` for a local TCP socket, `unix:<path>` or a path for a Unix socket
+    :return: a tuple with the socket family and the address
+    """
+    if address.startswith("unix:"):
+        return socket.AF_UNIX, address[len("unix:"):]
+    if "/" in address:
+        return socket.AF_UNIX, address
+    host, _, port = address.rpartition(":")
+    return socket.AF_INET, (host or "127.0.0.1", int(port))
+
+
+class GeolocationJob(object):
+    """
+    A set of targets submitted to the service and the results that have arrived so far
+    """
+    def __init__(self, job_id, targets):
+        """
+        :param job_id: the ID of the job
+        :param targets: the list of target IPs
+        """
+        self.id = job_id
+        self.targets = targets
+        self.results = list()
+        self.created = time()
+        self.finished = None
+        self.condition = threading.Condition()
+
+    def add_result(self, result):
+        """
+        Adds the result of a target and wakes up the clients that stream the results of the job
+        :param result: the result record, or a dictionary with the ip and the error for targets that failed
+        """
+        with self.condition:
+            self.results.append(result)
+            if len(self.results) == len(self.targets):
+                self.finished = time()
+            self.condition.notify_all()
+
+    def is_done(self):
+        return len(self.results) == len(self.targets)
+
+    def wait_results(self, offset, timeout=None):
+        """
+        Waits until there are results after the given offset or the job is done
+        :param offset: the number of results that the caller has already received
+        :param timeout: the maximum number of seconds to wait
+        :return: the list of new results
+        """
+        with self.condition:
+            if len(self.results) <= offset and not self.is_done():
+                self.condition.wait(timeout)
+            return self.results[offset:]
+
+    def status(self):
+        return {
+            "job": self.id,
+            "targets": len(self.targets),
+            "completed": len(self.results),
+            "done": self.is_done(),
+            "created": int(self.created)
+        }
+
+
+class GeolocationService(object):
+    """
+    Keeps a GeolocationPipeline warm and geolocates the targets of the jobs that are submitted to it. Targets that
+    are already queued or being measured for another job are not measured twice, targets that are already in the
+    output are answered from the results database instead of being measured again, and the search space of each ASN
+    (its candidate locations and probes) is reused across jobs until the next refresh.
+    """
+
+    def __init__(self, pipeline, workers=4, refresh_hours=6, max_job_targets=65536, job_retention_minutes=60):
+        """
+        :param pipeline: the GeolocationPipeline used to geolocate the targets
+        :param workers: the number of targets that are measured in parallel
+        :param refresh_hours: how often the PeeringDB data and the probe inventory are reloaded
+        :param max_job_targets: the maximum number of addresses in a single job
+        :param job_retention_minutes: how long the results of a finished job are kept
+        """
+        self.pipeline = pipeline
+        self.workers_num = max(1, int(workers))
+        self.refresh_seconds = float(refresh_hours) * 3600
+        self.max_job_targets = int(max_job_targets)
+        self.job_retention_seconds = float(job_retention_minutes) * 60
+
+        self.jobs = dict()
+        self.job_ids = itertools.count(1)
+        self.jobs_lock = threading.Lock()
+        # The jobs that wait for each target that is queued or being measured
+        self.pending_targets = dict()
+        self.pending_lock = threading.Lock()
+        self.work_queue = Queue.Queue()
+        # Steps 1-4 and the result output share the caches of the pipeline, only the measurements run in parallel
+        self.pipeline_lock = threading.RLock()
+        # The search space of each ASN and the hinted locations it was built for
+        self.search_spaces = dict()
+        # The compiled results of the output, which answer the targets that are already geolocated
+        self.results_database = None
+        self.refreshed = time()
+        self.stop_event = threading.Event()
+        self.threads = list()
+
+    def start(self):
+        """
+        Loads all the resources of the pipeline and starts the workers and the background refresh
+        """
+        start = time()
+        self.pipeline.warm_up()
+        self.load_results_database()
+        logger.info("Loaded the geolocation resources in %.1f sec" % (time() - start))
+        for _ in xrange(self.workers_num):
+            self.start_thread(self.run_worker)
+        self.start_thread(self.run_refresh)
+
+    def start_thread(self, target):
+        thread = threading.Thread(target=target)
+        thread.daemon = True
+        thread.start()
+        self.threads.append(thread)
+
+    def stop(self):
+        """
+        Stops the workers and the background refresh, and flushes the results
+        """
+        self.stop_event.set()
+        for _ in xrange(self.workers_num):
+            self.work_queue.put(None)
+        for thread in self.threads:
+            thread.join(1)
+        self.pipeline.close()
+
+    def submit(self, targets):
+        """
+        Creates a job for a list of targets and queues the targets that are not already queued for another job
+        :param targets: a list of IP addresses, prefixes or ranges
+        :return: the GeolocationJob object
+        """
+        ip_ranges = list()
+        for target in targets:
+            ip_range = target_reader.parse_target(target.strip())
+            if ip_range is None:
+                raise ValueError("`%s` is not a valid IPv4 address or prefix" % target)
+            ip_ranges.append(ip_range)
+        if len(ip_ranges) == 0:
+            raise ValueError("The job has no targets")
+        if sum(last - first + 1 for first, last in ip_ranges) > self.max_job_targets:
+            raise ValueError("A job can have at most %s addresses" % self.max_job_targets)
+        ip_batch = np.concatenate([np.zeros(0, dtype=np.uint32)] +
+                                  list(target_reader.iter_target_batches(ip_ranges, self.max_job_targets)))
+
+        self.expire_jobs()
+        with self.jobs_lock:
+            job = GeolocationJob(next(self.job_ids), ip_batch.tolist())
+            self.jobs[job.id] = job
+
+        # The targets in the output are answered right away, so they are neither measured nor written again
+        new_ip_batch = self.pipeline.already_geolocated_ips.filter_new(ip_batch)
+        geolocated_ips = np.setdiff1d(ip_batch, new_ip_batch, assume_unique=True)
+        for int_ip in geolocated_ips.tolist():
+            job.add_result(self.geolocated_result(int_ip))
+
+        new_ips = list()
+        with self.pending_lock:
+            for int_ip in new_ip_batch.tolist():
+                if int_ip in self.pending_targets:
+                    self.pending_targets[int_ip].append(job)
+                else:
+                    self.pending_targets[int_ip] = [job]
+                    new_ips.append(int_ip)
+        logger.info("Job %s: %s targets, %s already geolocated, %s already in flight" %
+                    (job.id, len(job.targets), len(geolocated_ips), len(new_ip_batch) - len(new_ips)))
+        if len(new_ips) > 0:
+            new_ips = np.array(new_ips, dtype=np.uint32)
+            try:
+                self.queue_targets(new_ips)
+            except BaseException as e:
+                # The jobs that wait for the targets would otherwise never finish
+                logger.error("Failed to queue the targets of job %s: %s" % (job.id, str(e)))
+                for int_ip in new_ips.tolist():
+                    target_ip = int_to_ip(int_ip)
+                    self.complete_target(target_ip, {"ip": target_ip, "error": "could not be queued"})
+        return job
+
+    def load_results_database(self):
+        """
+        Compiles the results that were written since the last compilation into the results database of the
+        results_db setting, and loads it
+        """
+        if self.pipeline.results_db == "" or not os.path.exists(self.pipeline.args.output):
+            return
+        with self.pipeline_lock:
+            if "result_writer" in self.pipeline.resources:
+                self.pipeline.result_writer.flush()
+            results_database = self.pipeline.compile_results_database(self.pipeline.results_db)
+        if results_database is not None:
+            self.results_database = results_database
+
+    def geolocated_result(self, int_ip):
+        """
+        :param int_ip: the integer IP of a target in the output
+        :return: the result of the target in the results database, or a record that marks the target as skipped if
+        its result hasn't been compiled yet
+        """
+        target_ip = int_to_ip(int_ip)
+        if self.results_database is not None:
+            result = self.results_database.lookup(int_ip)
+            if result is not None:
+                return result
+        return {"ip": target_ip, "skipped": "already geolocated"}
+
+    def queue_targets(self, ip_batch):
+        """
+        Groups new targets per ASN and adds them to the work queue
+        :param ip_batch: a numpy array of integer target IPs
+        """
+        with self.pipeline_lock:
+            target_groups = self.pipeline.group_targets(ip_batch)
+        grouped_ips = set()
+        for target_asn, target_asn_ips, target_locations in target_groups:
+            for target_ip in target_asn_ips:
+                self.work_queue.put((target_asn, target_ip, target_locations))
+                grouped_ips.add(target_ip)
+        for int_ip in ip_batch.tolist():
+            target_ip = int_to_ip(int_ip)
+            if target_ip not in grouped_ips:
+                self.complete_target(target_ip, {"ip": target_ip, "error": "not covered by any prefix"})
+
+    def complete_target(self, target_ip, result):
+        """
+        Passes the result of a target to every job that waits for it
+        :param target_ip: the target IP address
+        :param result: the result record
+        """
+        with self.pending_lock:
+            jobs = self.pending_targets.pop(ip_to_int(target_ip), list())
+        for job in jobs:
+            job.add_result(result)
+
+    def expire_jobs(self):
+        """
+        Forgets the jobs that finished before the retention period
+        """
+        expiry = time() - self.job_retention_seconds
+        with self.jobs_lock:
+            for job_id in [job.id for job in self.jobs.itervalues()
+                           if job.finished is not None and job.finished < expiry]:
+                del self.jobs[job_id]
+
+    def get_job(self, job_id):
+        with self.jobs_lock:
+            return self.jobs.get(job_id)
+
+    def get_search_space(self, target_asn, target_locations):
+        """
+        Returns the search space of an ASN, which is recomputed only when the targets hint locations that it
+        does not cover
+        :param target_asn: the target ASN
+        :param target_locations: the candidate locations hinted by the targets
+        :return: an AsnSearchSpace object
+        """
+        with self.pipeline_lock:
+            if target_asn in self.search_spaces:
+                hinted_locations, search_space = self.search_spaces[target_asn]
+                if target_locations <= hinted_locations:
+                    return search_space
+                target_locations = target_locations | hinted_locations
+            search_space = self.pipeline.locate_asn(target_asn, target_locations)
+            self.search_spaces[target_asn] = (frozenset(target_locations), search_space)
+            return search_space
+
+    def geolocate(self, target_asn, target_ip, target_locations):
+        """
+        Runs Steps 2-5 for a queued target
+        :return: the result record
+        """
+        with self.pipeline_lock:
+            search_space = self.get_search_space(target_asn, target_locations)
+            archived_rtts, search_space = self.pipeline.check_archived_rtts(target_ip, search_space)
+            if len(archived_rtts) > 0:
+                return self.pipeline.write_archived_result(target_ip, search_space, archived_rtts)
+            selected_probes = self.pipeline.select_probes(search_space)
+        if len(selected_probes) == 0:
+            return {"ip": target_ip, "asn": target_asn, "error": "no Atlas probes in the candidate locations"}
+
+        plan = self.pipeline.plan_target(target_ip, selected_probes, search_space)
+        # The workers share the Atlas client of the pipeline, which attributes the results by measurement ID
+        closest_probe, min_rtt = self.pipeline.measure_target(target_ip, plan["probes"])
+        if closest_probe is None:
+            return {"ip": target_ip, "asn": target_asn, "error": "the Atlas credit budget is spent"}
+        if closest_probe == 0:
+            return {"ip": target_ip, "asn": target_asn, "error": "unreachable from every probe"}
+        with self.pipeline_lock:
+            return self.pipeline.write_result(target_ip, target_asn, closest_probe, min_rtt)
+
+    def run_worker(self):
+        while not self.stop_event.is_set():
+            work = self.work_queue.get()
+            if work is None:
+                break
+            target_asn, target_ip, target_locations = work
+            try:
+                result = self.geolocate(target_asn, target_ip, target_locations)
+            except (Exception, SystemExit) as e:
+                # The Atlas client exits on measurement errors, which must not stop the worker
+                logger.error("Failed to geolocate %s: %s" % (target_ip, str(e)))
+                result = {"ip": target_ip, "asn": target_asn, "error": "measurement failed"}
+            with self.pipeline_lock:
+                self.pipeline.release_targets([target_ip])
+            self.complete_target(target_ip, result)
+
+    def run_refresh(self):
+        while not self.stop_event.wait(self.refresh_seconds):
+            start = time()
+            with self.pipeline_lock:
+                self.pipeline.refresh()
+                self.search_spaces = dict()
+                self.pipeline.warm_up()
+                self.load_results_database()
+                self.refreshed = time()
+            logger.info("Refreshed the geolocation resources in %.1f sec" % (time() - start))
+
+    def status(self):
+        with self.jobs_lock:
+            active_jobs = sum(1 for job in self.jobs.itervalues() if not job.is_done())
+            jobs_num = len(self.jobs)
+        return {
+            "jobs": jobs_num,
+            "active_jobs": active_jobs,
+            "queued_targets": self.work_queue.qsize(),
+            "pending_targets": len(self.pending_targets),
+            "cached_asns": len(self.search_spaces),
+            "refreshed": int(self.refreshed),
+            "load_times": self.pipeline.load_times
+        }
+
+
+class ServiceRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    The HTTP API of the service:
+    POST /jobs                submits the targets in the body (a JSON list, or one target per line) and returns the
+                              job status, or streams the results if the `stream` query parameter is set
+    GET  /jobs/<id>           returns the status of a job
+    GET  /jobs/<id>/results   streams the results of a job as JSON lines, as they arrive
+    GET  /status              returns the status of the service
+    GET  /metrics             returns the metrics in the Prometheus text format (/metrics.json in JSON)
+    POST /profile             switches cProfile on (`enable=1`) or off (`enable=0`) for the timer given by the
+                              `timer` query parameter, or for every timer, and writes the profiles when switched off
+    """
+    server_version = "PresenceGeolocation/1.0"
+
+    def address_string(self):
+        # Unix socket clients have no address
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return "unix"
+
+    def log_message(self, message_format, *args):
+        logger.debug("%s %s" % (self.address_string(), message_format % args))
+
+    def send_json(self, code, data):
+        self.send_body(code, dumps(data) + "\n", "application/json")
+
+    def send_body(self, code, body, content_type):
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def stream_results(self, job):
+        """
+        Streams the results of a job as JSON lines until the job is done
+        """
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.end_headers()
+        offset = 0
+        try:
+            while True:
+                results = job.wait_results(offset, 30)
+                offset += len(results)
+                for result in results:
+                    self.wfile.write(dumps(result) + "\n")
+                self.wfile.flush()
+                if offset == len(job.targets):
+                    break
+        except socket.error:
+            # The client closed the connection, the job keeps running
+            pass
+
+    def toggle_profiling(self, query):
+        timer_name = query.get("timer", [None])[0]
+        if query.get("enable", ["1"])[0] == "1":
+            METRICS.enable_profiling(timer_name)
+            return self.send_json(200, {"profiling": timer_name or "all"})
+        METRICS.disable_profiling(timer_name)
+        profile_files = METRICS.write_profiles(self.server.service.pipeline.config["Metrics"]["profile_dir"])
+        self.send_json(200, {"profiles": profile_files})
+
+    def do_GET(self):
+        service = self.server.service
+        path = urlparse(self.path).path.strip("/").split("/")
+        if path == ["status"]:
+            return self.send_json(200, service.status())
+        if path == ["metrics"]:
+            return self.send_body(200, METRICS.to_prometheus(), "text/plain; version=0.0.4")
+        if path == ["metrics.json"]:
+            return self.send_body(200, METRICS.to_json() + "\n", "application/json")
+        if len(path) in (2, 3) and path[0] == "jobs" and path[1].isdigit():
+            job = service.get_job(int(path[1]))
+            if job is None:
+                return self.send_json(404, {"error": "unknown job"})
+            if len(path) == 2:
+                return self.send_json(200, job.status())
+            if path[2] == "results":
+                return self.stream_results(job)
+        self.send_json(404, {"error": "unknown path"})
+
+    def do_POST(self):
+        service = self.server.service
+        url = urlparse(self.path)
+        if url.path.strip("/") == "profile":
+            return self.toggle_profiling(parse_qs(url.query))
+        if url.path.strip("/") != "jobs":
+            return self.send_json(404, {"error": "unknown path"})
+        body = self.rfile.read(int(self.headers.getheader("Content-Length", 0)))
+        try:
+            if body.lstrip().startswith("["):
+                targets = [str(target) for target in loads(body)]
+            else:
+                targets = [line for line in body.splitlines() if line.strip() != "" and not line.startswith("#")]
+            job = service.submit(targets)
+        except ValueError as e:
+            return self.send_json(400, {"error": str(e)})
+        if "stream" in parse_qs(url.query, keep_blank_values=True):
+            return self.stream_results(job)
+        self.send_json(202, job.status())
+
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class ThreadingUnixHTTPServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(pipeline, config, address):
+    """
+    Runs the geolocation service until it is interrupted
+    :param pipeline: the GeolocationPipeline used to geolocate the targets
+    :param config: the configuration dictionary returned by arg_parser.read_config
+    :param address: the address to listen on, as accepted by parse_listen_address
+    """
+    service = GeolocationService(
+        pipeline,
+        config["Service"]["workers"],
+        config["Service"]["refresh_hours"],
+        config["Service"]["max_job_targets"],
+        config["Service"]["job_retention_minutes"]
+    )
+    family, listen_address = parse_listen_address(address)
+    if family == socket.AF_UNIX:
+        if os.path.exists(listen_address):
+            os.remove(listen_address)
+        server = ThreadingUnixHTTPServer(listen_address, ServiceRequestHandler)
+    else:
+        server = ThreadingHTTPServer(listen_address, ServiceRequestHandler)
+    server.service = service
+
+    service.start()
+    logger.info("Listening on %s" % address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.stop()
+        if family == socket.AF_UNIX and os.path.exists(listen_address):
+            os.remove(listen_address)
+    return service
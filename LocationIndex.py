@@ -0,0 +1,212 @@
+import re
+import logging
+import threading
+import unicodedata
+from RttStore import haversine_km
+
+# The punctuation that separates the words of a city name, e.g. in `frankfurt/main` or `st.-petersburg`
+WORD_SEPARATORS = re.compile(r"[\s/\\_.,;:()'\"-]+", re.UNICODE)
+
+
+def _utf8(value):
+    if isinstance(value, unicode):
+        return value.encode("utf-8")
+    return str(value)
+
+
+def normalize_location(location):
+    """
+    Returns the alias key of a location string: lowercase, without accents and with the punctuation between the
+    words replaced by a space
+    :param location: the location string, in the format of city|country
+    :return: the normalized location string, UTF-8 encoded
+    """
+    if not isinstance(location, unicode):
+        location = location.decode("utf-8", "replace")
+    location = u"".join(char for char in unicodedata.normalize("NFKD", location.lower())
+                        if not unicodedata.combining(char))
+    city, separator, country = location.rpartition(u"|")
+    if separator == u"":
+        city, country = country, u""
+    return _utf8(u"%s|%s" % (WORD_SEPARATORS.sub(u" ", city).strip(), country.strip()))
+
+
+class LocationIndex(object):
+    """
+    The canonical index of the candidate locations. Every location string of the presence data (PeeringDB, the
+    presence file and the locations hinted by the targets) is normalized and mapped through the alias table to a
+    stable location ID with coordinates, before it is geocoded. The ID is the City|Country name of the geocoder,
+    and geocoded locations that are within `metro_radius_km` of a known location of the same country are merged
+    into it. Hence the spelling variants of a metro (e.g. `Frankfurt`, `Frankfurt am Main` and `frankfurt/main`)
+    share one location, which is geocoded and searched for probes once.
+
+    The index is a tab-separated file of `alias, location ID, lat, lng` lines, where the coordinates can be omitted
+    for aliases of a location that is defined on another line. New aliases are appended to it as they are resolved,
+    later lines override earlier ones, and lines can be added or edited by hand to fix or merge locations.
+    """
+
+    def __init__(self, index_file, metro_radius_km=0):
+        """
+        :param index_file: the path to the index file
+        :param metro_radius_km: the distance within which a geocoded location is merged into a known location of the
+        same country, 0 to only merge locations with the same name
+        """
+        logging.basicConfig()
+        self.logger = logging.getLogger("LocationIndex")
+        self.index_file = index_file
+        self.metro_radius_km = float(metro_radius_km)
+        # Normalized location string -> location ID
+        self.aliases = dict()
+        # Location ID -> (lat, lng)
+        self.locations = dict()
+        # Country code -> list of the IDs of its locations, for the metro merging
+        self.country_locations = dict()
+        self.lock = threading.Lock()
+
+    def load(self):
+        """
+        Reads the index file if it exists
+        :return: the LocationIndex object
+        """
+        aliases = list()
+        try:
+            with open(self.index_file) as fin:
+                for line in fin:
+                    if line.startswith("#") or line.strip() == "":
+                        continue
+                    lf = line.rstrip("\n").split("\t")
+                    if len(lf) < 2 or lf[1].strip() == "":
+                        self.logger.warning("Skipping the malformed line of `%s`: %s" % (self.index_file, line.strip()))
+                        continue
+                    location_id = lf[1].strip()
+                    if len(lf) >= 4:
+                        try:
+                            self.add_location(location_id, float(lf[2]), float(lf[3]))
+                            aliases.append((location_id, location_id))
+                        except ValueError:
+                            self.logger.warning("Skipping the malformed coordinates of `%s`: %s" %
+                                                (self.index_file, line.strip()))
+                            continue
+                    aliases.append((lf[0], location_id))
+        except IOError:
+            return self
+        undefined = 0
+        for alias, location_id in aliases:
+            if location_id in self.locations:
+                self.aliases[normalize_location(alias)] = location_id
+            else:
+                undefined += 1
+        if undefined > 0:
+            self.logger.warning("Ignoring %s aliases of `%s` whose location has no coordinates" %
+                                (undefined, self.index_file))
+        return self
+
+    def __len__(self):
+        """
+        :return: the number of locations
+        """
+        return len(self.locations)
+
+    def add_location(self, location_id, lat, lng):
+        if location_id not in self.locations:
+            country = location_id.rpartition("|")[2].lower()
+            self.country_locations.setdefault(country, list()).append(location_id)
+        self.locations[location_id] = (lat, lng)
+
+    def lookup(self, location):
+        """
+        :param location: the location string, in the format of city|country
+        :return: the location ID of the location string, or None if it is not in the index
+        """
+        return self.aliases.get(normalize_location(location))
+
+    def get(self, location_id):
+        """
+        :param location_id: the location ID
+        :return: the dictionary with the lat, lng, city and country of the location
+        """
+        lat, lng = self.locations[location_id]
+        city, _, country = location_id.rpartition("|")
+        return {"lat": lat, "lng": lng, "city": city, "country": country}
+
+    def add(self, location, location_data):
+        """
+        Adds a geocoded location string to the index, either as an alias of a known location or as a new location
+        :param location: the location string, in the format of city|country
+        :param location_data: the dictionary with the lat, lng, city and country of the location by the geocoder
+        :return: the location ID of the location string
+        """
+        lat, lng = float(location_data["lat"]), float(location_data["lng"])
+        geocoded_id = "%s|%s" % (_utf8(location_data["city"]), _utf8(location_data["country"]))
+        with self.lock:
+            location_id = self.aliases.get(normalize_location(geocoded_id))
+            if location_id is None:
+                location_id = self.nearest_location(geocoded_id.rpartition("|")[2].lower(), lat, lng)
+            lines = list()
+            if location_id is None:
+                location_id = geocoded_id
+                self.add_location(location_id, lat, lng)
+                self.aliases[normalize_location(location_id)] = location_id
+                lines.append("%s\t%s\t%s\t%s\n" % (location_id, location_id, lat, lng))
+            alias = normalize_location(location)
+            if self.aliases.get(alias) != location_id:
+                self.aliases[alias] = location_id
+                lines.append("%s\t%s\n" % (alias, location_id))
+            self.append(lines)
+        return location_id
+
+    def merge(self, journal_file):
+        """
+        Adds the aliases that another process appended to its own copy of the index file, e.g. a shard worker, as if
+        their locations had been geocoded here, so that they are merged with the known locations of the same metro
+        :param journal_file: the index file of the other process, with only the lines that it appended
+        :return: the number of aliases that were added
+        """
+        journal_locations = dict()
+        aliases = list()
+        try:
+            with open(journal_file) as fin:
+                for line in fin:
+                    lf = line.rstrip("\n").split("\t")
+                    if line.startswith("#") or len(lf) < 2:
+                        continue
+                    if len(lf) >= 4:
+                        try:
+                            journal_locations[lf[1]] = (float(lf[2]), float(lf[3]))
+                        except ValueError:
+                            continue
+                    aliases.append((lf[0], lf[1]))
+        except IOError as e:
+            self.logger.error("Could not read the index journal `%s`: %s" % (journal_file, str(e)))
+            return 0
+        added = 0
+        for alias, location_id in aliases:
+            coordinates = journal_locations.get(location_id, self.locations.get(location_id))
+            if coordinates is None or normalize_location(alias) in self.aliases:
+                continue
+            city, _, country = location_id.rpartition("|")
+            self.add(alias, {"lat": coordinates[0], "lng": coordinates[1], "city": city, "country": country})
+            added += 1
+        return added
+
+    def nearest_location(self, country, lat, lng):
+        """
+        :return: the ID of the nearest location of a country within the metro radius, or None if there is none
+        """
+        if self.metro_radius_km <= 0:
+            return None
+        nearest_id, nearest_distance = None, self.metro_radius_km
+        for location_id in self.country_locations.get(country, ()):
+            distance = haversine_km(lat, lng, *self.locations[location_id])
+            if distance <= nearest_distance:
+                nearest_id, nearest_distance = location_id, distance
+        return nearest_id
+
+    def append(self, lines):
+        if len(lines) == 0:
+            return
+        try:
+            with open(self.index_file, "a+") as fout:
+                fout.write("".join(lines))
+        except IOError as e:
+            self.logger.error("Appending to file `%s` failed with error: %s" % (self.index_file, str(e)))
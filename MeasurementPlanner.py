@@ -0,0 +1,175 @@
+import logging
+from ujson import dumps
+from ShardedExecution import estimate_ping_credits
+
+# The value of a probe for the geolocation, lower is measured first and trimmed last
+RANK_TARGET_ASN = 0
+RANK_NEIGHBOR_ASN = 1
+RANK_SAMPLED = 2
+
+
+class MeasurementPlanner(object):
+    """
+    Turns the probes selected in Step 4 into the measurements of Step 5. The probes are ordered by their value for
+    the geolocation (probes in the target's ASN, then probes in neighboring ASes, then the randomly sampled ones, and
+    by reliability within each group), and the lowest-value probes are trimmed when the measurements of a target
+    would exceed the per-target credit budget.
+    """
+
+    def __init__(self, packets_num, chunk_size, max_target_credits=0):
+        """
+        :param packets_num: the number of ping packets per probe
+        :param chunk_size: the maximum number of probes per measurement
+        :param max_target_credits: the maximum number of credits spent on a target, 0 for no limit
+        """
+        self.packets_num = int(packets_num)
+        self.chunk_size = max(1, int(chunk_size))
+        self.max_target_credits = int(max_target_credits)
+
+    def rank_probes(self, selected_probes, search_space, probe_health=None):
+        """
+        :param selected_probes: the set of selected probe IDs
+        :param search_space: the AsnSearchSpace of the target's ASN
+        :param probe_health: the ProbeHealthStore that ranks the probes of the same value by their reliability, or
+        None
+        :return: the list of probe IDs, ordered from the most to the least valuable
+        """
+        def probe_rank(probe_id):
+            reliability = -probe_health.score(probe_id) if probe_health is not None else 0
+            if probe_id in search_space.target_asn_probes:
+                return RANK_TARGET_ASN, reliability, probe_id
+            if probe_id in search_space.neighboring_probes:
+                return RANK_NEIGHBOR_ASN, reliability, probe_id
+            return RANK_SAMPLED, reliability, probe_id
+
+        return sorted(selected_probes, key=probe_rank)
+
+    def max_target_probes(self):
+        """
+        :return: the number of probes that fit in the per-target budget, or None if there is no budget
+        """
+        if self.max_target_credits <= 0:
+            return None
+        return self.max_target_credits // max(1, self.packets_num)
+
+    def plan_target(self, target_ip, selected_probes, search_space, probe_health=None):
+        """
+        Plans the measurements of a target
+        :param target_ip: the target IP address
+        :param selected_probes: the set of selected probe IDs
+        :param search_space: the AsnSearchSpace of the target's ASN
+        :param probe_health: the ProbeHealthStore used to rank the probes, or None
+        :return: a dictionary with the ordered probes that will be measured, their chunks, the estimated credits and
+        the number of probes that were trimmed to meet the per-target budget
+        """
+        probes = self.rank_probes(selected_probes, search_space, probe_health)
+        trimmed_probes = 0
+        max_probes = self.max_target_probes()
+        if max_probes is not None and len(probes) > max_probes:
+            trimmed_probes = len(probes) - max_probes
+            probes = probes[:max_probes]
+        chunks = [probes[i:i + self.chunk_size] for i in xrange(0, len(probes), self.chunk_size)]
+        return {
+            "ip": target_ip,
+            "asn": search_space.asn,
+            "probes": probes,
+            "chunks": chunks,
+            "credits": sum(estimate_ping_credits(self.packets_num, len(chunk)) for chunk in chunks),
+            "trimmed_probes": trimmed_probes
+        }
+
+    def plan_verification(self, target_ip, search_space, representative_ip):
+        """
+        Plans the measurement of a cluster member, which is measured only from the two closest probes of the cluster's
+        representative. The probes are only known once the representative has been measured.
+        :param target_ip: the target IP address
+        :param search_space: the AsnSearchSpace of the target's ASN
+        :param representative_ip: the representative of the target's cluster
+        :return: the measurement plan of the target, see plan_target
+        """
+        return {
+            "ip": target_ip,
+            "asn": search_space.asn,
+            "probes": [],
+            "chunks": [],
+            "credits": estimate_ping_credits(self.packets_num, 2),
+            "trimmed_probes": 0,
+            "verify_with": representative_ip
+        }
+
+
+class PlanWriter(object):
+    """
+    Writes the measurement plan of a dry run as JSON lines, one line per target with its probe chunks and estimated
+    credits, and adds up the credits of the run. The credits are an upper bound, since the measurements of a target
+    stop early once a probe replies with a very low RTT. The targets that would not fit in the per-run budget are
+    marked as deferred.
+    """
+
+    def __init__(self, plan_file, max_run_credits=0):
+        """
+        :param plan_file: the path to the plan file
+        :param max_run_credits: the maximum number of credits spent by the run, 0 for no limit
+        """
+        logging.basicConfig()
+        self.logger = logging.getLogger("MeasurementPlanner")
+        self.logger.setLevel(logging.INFO)
+        self.plan_file = plan_file
+        self.max_run_credits = int(max_run_credits)
+        self.fout = open(plan_file, "w")
+        self.targets = 0
+        self.measurements = 0
+        self.credits = 0
+        self.trimmed_targets = 0
+        self.deferred_targets = 0
+        self.deferred_credits = 0
+
+    def write(self, plan):
+        """
+        Adds the plan of a target to the plan file
+        :param plan: the dictionary returned by MeasurementPlanner.plan_target
+        """
+        deferred = self.max_run_credits > 0 and self.credits + plan["credits"] > self.max_run_credits
+        self.targets += 1
+        if plan["trimmed_probes"] > 0:
+            self.trimmed_targets += 1
+        if deferred:
+            self.deferred_targets += 1
+            self.deferred_credits += plan["credits"]
+        else:
+            self.measurements += 1 if "verify_with" in plan else len(plan["chunks"])
+            self.credits += plan["credits"]
+        line = {
+            "ip": plan["ip"],
+            "asn": plan["asn"],
+            "chunks": plan["chunks"],
+            "credits": plan["credits"],
+            "trimmed_probes": plan["trimmed_probes"],
+            "deferred": deferred
+        }
+        if "verify_with" in plan:
+            line["verify_with"] = plan["verify_with"]
+        self.fout.write(dumps(line) + "\n")
+
+    def summary(self):
+        return {
+            "targets": self.targets,
+            "measurements": self.measurements,
+            "credits": self.credits,
+            "trimmed_targets": self.trimmed_targets,
+            "deferred_targets": self.deferred_targets,
+            "deferred_credits": self.deferred_credits
+        }
+
+    def close(self):
+        """
+        Closes the plan file and logs the totals of the plan
+        :return: the summary of the plan
+        """
+        self.fout.close()
+        summary = self.summary()
+        self.logger.info("Measurement plan written to `%s`: %s targets, %s measurements, %s credits, "
+                         "%s targets trimmed to the per-target budget, %s targets (%s credits) over the run budget" %
+                         (self.plan_file, summary["targets"], summary["measurements"], summary["credits"],
+                          summary["trimmed_targets"], summary["deferred_targets"], summary["deferred_credits"]))
+        return summary
@@ -0,0 +1,364 @@
+import os
+import signal
+import logging
+import cProfile
+import pstats
+import threading
+from time import time, sleep
+from contextlib import contextmanager
+from ujson import dumps
+
+# The upper bounds, in seconds, of the buckets of the latency histograms
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 2, 5, 10, 30, 60, 120, 300, float("inf"))
+
+
+def metric_key(name, labels):
+    """
+    :return: the key of a metric with its labels, in the Prometheus notation (name{label="value",...})
+    """
+    if len(labels) == 0:
+        return name
+    return "%s{%s}" % (name, ",".join('%s="%s"' % (label, labels[label]) for label in sorted(labels)))
+
+
+class Histogram(object):
+    """
+    Counts observations in cumulative buckets, like a Prometheus histogram
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+                break
+
+    def to_dict(self):
+        cumulative = list()
+        total = 0
+        for count in self.counts:
+            total += count
+            cumulative.append(total)
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "buckets": dict(("+Inf" if bound == float("inf") else repr(bound), count)
+                            for bound, count in zip(self.buckets, cumulative))
+        }
+
+
+class Metrics(object):
+    """
+    The counters, gauges and latency histograms of a run. Code paths record their duration with `timer`, which
+    can also run the code path under cProfile when profiling of that path is switched on.
+    """
+
+    def __init__(self):
+        # Reentrant, since the signal handlers take it in the main thread, which may already hold it
+        self.lock = threading.RLock()
+        self.counters = dict()
+        self.gauges = dict()
+        self.histograms = dict()
+        self.started = time()
+        # The names of the timers that run under cProfile, None to profile every timer
+        self.profiled = set()
+        self.profilers = dict()
+        self.thread_data = threading.local()
+
+    def reset(self):
+        """
+        Clears all the metrics and profiles, e.g. between the workloads of a benchmark
+        """
+        with self.lock:
+            self.counters = dict()
+            self.gauges = dict()
+            self.histograms = dict()
+            self.profilers = dict()
+            self.started = time()
+
+    def after_fork(self):
+        """
+        Replaces the lock in a forked process, where it is a copy of the lock that the forking thread held
+        """
+        self.lock = threading.RLock()
+
+    def increment(self, name, value=1, **labels):
+        """
+        Increments a counter
+        :param name: the name of the counter
+        :param value: the increment
+        :param labels: the labels of the counter
+        """
+        key = (name, tuple(sorted(labels.iteritems())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set_gauge(self, name, value, **labels):
+        """
+        Sets the current value of a gauge
+        """
+        key = (name, tuple(sorted(labels.iteritems())))
+        with self.lock:
+            self.gauges[key] = value
+
+    def observe(self, name, value, **labels):
+        """
+        Adds an observation to a histogram
+        :param name: the name of the histogram
+        :param value: the observed value, in seconds for latencies
+        :param labels: the labels of the histogram
+        """
+        key = (name, tuple(sorted(labels.iteritems())))
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """
+        Records the duration of a code path in the `<name>_seconds` histogram, and profiles the code path if
+        profiling is switched on for it
+        :param name: the name of the code path
+        :param labels: the labels of the histogram
+        """
+        profiler = self.start_profiler(name)
+        start = time()
+        try:
+            yield
+        finally:
+            self.observe(name + "_seconds", time() - start, **labels)
+            if profiler is not None:
+                profiler.disable()
+                self.thread_data.profiling = False
+
+    def timed(self, name, **labels):
+        """
+        Decorates a function so that every call is recorded with `timer`
+        :param name: the name of the timer
+        :param labels: the labels of the histogram
+        :return: the decorator
+        """
+        def decorator(function):
+            def timed_function(*args, **kwargs):
+                with self.timer(name, **labels):
+                    return function(*args, **kwargs)
+            timed_function.__name__ = function.__name__
+            timed_function.__doc__ = function.__doc__
+            return timed_function
+        return decorator
+
+    def start_profiler(self, name):
+        # Nested timers are profiled as part of the outer timer, since a thread can only run one profiler
+        if self.profiled is not None and name not in self.profiled or getattr(self.thread_data, "profiling", False):
+            return None
+        key = (name, threading.current_thread().ident)
+        with self.lock:
+            if key not in self.profilers:
+                self.profilers[key] = cProfile.Profile()
+            profiler = self.profilers[key]
+        self.thread_data.profiling = True
+        profiler.enable()
+        return profiler
+
+    def enable_profiling(self, name=None):
+        """
+        Switches on cProfile for the code paths of a timer
+        :param name: the name of the timer, or None for every timer
+        """
+        with self.lock:
+            if name is None:
+                self.profiled = None
+            elif self.profiled is not None:
+                self.profiled.add(name)
+
+    def disable_profiling(self, name=None):
+        """
+        Switches off cProfile for the code paths of a timer
+        :param name: the name of the timer, or None for every timer
+        """
+        with self.lock:
+            if name is None:
+                self.profiled = set()
+            elif self.profiled is not None:
+                self.profiled.discard(name)
+
+    def is_profiling(self):
+        return self.profiled is None or len(self.profiled) > 0
+
+    def write_profiles(self, profile_dir):
+        """
+        Writes the collected profiles, one pstats file per timer with the profiles of all the threads merged
+        :param profile_dir: the directory of the pstats files
+        :return: the list of written files
+        """
+        with self.lock:
+            profilers = self.profilers.items()
+        per_name = dict()
+        for (name, _), profiler in profilers:
+            per_name.setdefault(name, list()).append(profiler)
+        if len(per_name) > 0 and not os.path.isdir(profile_dir):
+            os.makedirs(profile_dir)
+        profile_files = list()
+        for name, name_profilers in per_name.iteritems():
+            try:
+                stats = pstats.Stats(name_profilers[0])
+                for profiler in name_profilers[1:]:
+                    stats.add(profiler)
+            except TypeError:
+                # A profiler that has not collected anything yet
+                continue
+            profile_file = os.path.join(profile_dir, "%s.%s.pstats" % (name, os.getpid()))
+            stats.dump_stats(profile_file)
+            profile_files.append(profile_file)
+        return profile_files
+
+    def snapshot(self):
+        """
+        :return: a dictionary with the current values of all the metrics
+        """
+        with self.lock:
+            return {
+                "uptime_seconds": time() - self.started,
+                "counters": dict((metric_key(name, dict(labels)), value)
+                                 for (name, labels), value in self.counters.iteritems()),
+                "gauges": dict((metric_key(name, dict(labels)), value)
+                               for (name, labels), value in self.gauges.iteritems()),
+                "histograms": dict((metric_key(name, dict(labels)), histogram.to_dict())
+                                   for (name, labels), histogram in self.histograms.iteritems())
+            }
+
+    def export_state(self):
+        """
+        :return: the counters, gauges and histograms as plain objects that can be sent to another process
+        """
+        with self.lock:
+            return dict(self.counters), dict(self.gauges), dict(self.histograms)
+
+    def merge(self, state):
+        """
+        Adds the counters and histograms of another process to the metrics of this one
+        :param state: the state returned by export_state in the other process
+        """
+        counters, gauges, histograms = state
+        with self.lock:
+            for key, value in counters.iteritems():
+                self.counters[key] = self.counters.get(key, 0) + value
+            self.gauges.update(gauges)
+            for key, histogram in histograms.iteritems():
+                if key not in self.histograms:
+                    self.histograms[key] = Histogram(histogram.buckets)
+                merged = self.histograms[key]
+                merged.count += histogram.count
+                merged.sum += histogram.sum
+                merged.counts = [a + b for a, b in zip(merged.counts, histogram.counts)]
+
+    def to_json(self):
+        return dumps(self.snapshot(), indent=2)
+
+    def to_prometheus(self):
+        """
+        :return: the metrics in the Prometheus text exposition format
+        """
+        snapshot = self.snapshot()
+        lines = ["# TYPE geolocation_uptime_seconds gauge",
+                 "geolocation_uptime_seconds %s" % snapshot["uptime_seconds"]]
+        typed = set()
+
+        def add_type(key, metric_type):
+            name = key.partition("{")[0]
+            if name not in typed:
+                typed.add(name)
+                lines.append("# TYPE geolocation_%s %s" % (name, metric_type))
+
+        for key in sorted(snapshot["counters"]):
+            add_type(key, "counter")
+            lines.append("geolocation_%s %s" % (key, snapshot["counters"][key]))
+        for key in sorted(snapshot["gauges"]):
+            add_type(key, "gauge")
+            lines.append("geolocation_%s %s" % (key, snapshot["gauges"][key]))
+        for key in sorted(snapshot["histograms"]):
+            add_type(key, "histogram")
+            histogram = snapshot["histograms"][key]
+            name, _, labels = key.partition("{")
+            labels = labels.rstrip("}")
+            separator = "," if labels != "" else ""
+            for bound in sorted(histogram["buckets"], key=lambda b: float("inf") if b == "+Inf" else float(b)):
+                lines.append('geolocation_%s_bucket{%s%sle="%s"} %s' %
+                             (name, labels, separator, bound, histogram["buckets"][bound]))
+            suffix = "{%s}" % labels if labels != "" else ""
+            lines.append("geolocation_%s_sum%s %s" % (name, suffix, histogram["sum"]))
+            lines.append("geolocation_%s_count%s %s" % (name, suffix, histogram["count"]))
+        return "\n".join(lines) + "\n"
+
+    def write_snapshot(self, snapshot_file):
+        """
+        Writes the metrics to a file, in Prometheus text format if the file ends with .prom and in JSON otherwise
+        :param snapshot_file: the path to the file
+        """
+        data = self.to_prometheus() if snapshot_file.endswith(".prom") else self.to_json()
+        tmp_file = snapshot_file + ".tmp"
+        with open(tmp_file, "w") as fout:
+            fout.write(data)
+        os.rename(tmp_file, snapshot_file)
+
+    def start_snapshots(self, snapshot_file, snapshot_seconds):
+        """
+        Writes a snapshot of the metrics periodically from a background thread
+        :param snapshot_file: the path to the file, see write_snapshot
+        :param snapshot_seconds: the interval between the snapshots
+        """
+        def write_snapshots():
+            while True:
+                sleep(snapshot_seconds)
+                try:
+                    self.write_snapshot(snapshot_file)
+                except (IOError, OSError) as e:
+                    logging.getLogger("Metrics").error("Writing the metrics to `%s` failed with error: %s" %
+                                                       (snapshot_file, str(e)))
+
+        snapshot_seconds = float(snapshot_seconds)
+        if snapshot_seconds > 0:
+            thread = threading.Thread(target=write_snapshots, name="MetricsSnapshots")
+            thread.daemon = True
+            thread.start()
+
+
+# The metrics of the current process
+METRICS = Metrics()
+
+
+def install_signal_handlers(snapshot_file=None, profile_dir=None):
+    """
+    Lets a running process be inspected without restarting it: SIGUSR1 switches profiling of every timer on and off
+    (and writes the profiles when it is switched off), SIGUSR2 writes a snapshot of the metrics
+    :param snapshot_file: the file where SIGUSR2 writes the metrics
+    :param profile_dir: the directory where the profiles are written
+    """
+    logger = logging.getLogger("Metrics")
+
+    def toggle_profiling(signum, frame):
+        if METRICS.is_profiling():
+            METRICS.disable_profiling()
+            if profile_dir is not None:
+                logger.warning("Profiling stopped, profiles written to %s" %
+                               ", ".join(METRICS.write_profiles(profile_dir)))
+        else:
+            METRICS.enable_profiling()
+            logger.warning("Profiling started")
+
+    def write_snapshot(signum, frame):
+        if snapshot_file is not None:
+            METRICS.write_snapshot(snapshot_file)
+            logger.warning("Metrics written to %s" % snapshot_file)
+
+    if hasattr(signal, "SIGUSR1"):
+        signal.signal(signal.SIGUSR1, toggle_profiling)
+        signal.signal(signal.SIGUSR2, write_snapshot)
@@ -1,5 +1,11 @@
 import logging
+import os
+import shutil
+import time
 import requests
+import numpy as np
+from ip_utils import ip_to_int, prefix_to_range, sorted_contains
+from Metrics import METRICS
 
 
 class AutSys(object):
@@ -10,19 +16,149 @@ class AutSys(object):
         self.locations = locations
 
 
-class IxpIP(object):
-    def __init__(self, ip, ixp_id, ixp_name, asn):
-        self.ip = ip
-        self.ixp_id = ixp_id
-        self.ixp_name = ixp_name
-        self.asn = asn
+class IxpLanTable(object):
+    """
+    The IPs that IXP members use on the IXP peering LANs, and the peering LAN prefixes, stored in a directory as
+    sorted integer numpy arrays that are loaded with mmap. The table is rebuilt from the PeeringDB API only when it
+    is older than `max_age_hours`, so loading it doesn't depend on the size of the global netixlan table.
+    """
+
+    COLUMNS = ("ips", "asns", "ix_ids", "prefix_starts", "prefix_ends", "prefix_ix_ids")
+
+    def __init__(self, table_dir, max_age_hours=24):
+        logging.basicConfig()
+        self.logger = logging.getLogger("PeeringDB")
+        self.table_dir = table_dir
+        self.max_age_seconds = float(max_age_hours) * 3600
+        self.ips = np.zeros(0, dtype=np.uint32)
+        self.asns = np.zeros(0, dtype=np.uint32)
+        self.ix_ids = np.zeros(0, dtype=np.uint32)
+        self.prefix_starts = np.zeros(0, dtype=np.uint32)
+        self.prefix_ends = np.zeros(0, dtype=np.uint32)
+        self.prefix_ix_ids = np.zeros(0, dtype=np.uint32)
+
+    def is_stale(self):
+        """
+        Checks if the table has to be downloaded again
+        :return: True if the table doesn't exist or it is older than the maximum age, False otherwise
+        """
+        timestamp_file = os.path.join(self.table_dir, "timestamp")
+        try:
+            with open(timestamp_file) as fin:
+                return time.time() - float(fin.read().strip()) > self.max_age_seconds
+        except (IOError, ValueError):
+            return True
+
+    def load(self, peeringdb_api=None):
+        """
+        Memory-maps the table, after rebuilding it if it is stale
+        :param peeringdb_api: the API object used to rebuild the table (the stale table is used if not given)
+        :return: the IxpLanTable object
+        """
+        if peeringdb_api is not None and self.is_stale():
+            if not self.build(peeringdb_api):
+                self.logger.error("Could not update the IXP LAN table `%s`, using the previous table" % self.table_dir)
+        try:
+            for column in self.COLUMNS:
+                setattr(self, column, np.load(os.path.join(self.table_dir, "%s.npy" % column), mmap_mode="r"))
+        except (IOError, ValueError) as e:
+            self.logger.error("Could not load the IXP LAN table `%s`: %s" % (self.table_dir, str(e)))
+        return self
+
+    def build(self, peeringdb_api):
+        """
+        Downloads the IXP LAN IPs and prefixes from PeeringDB and writes the table
+        :param peeringdb_api: the API object used to query PeeringDB
+        :return: True if the table was written, False otherwise
+        """
+        netixlan_info = peeringdb_api.get_request("netixlan?fields=ipaddr4,asn,ix_id")
+        ixlan_info = peeringdb_api.get_request("ixlan?fields=id,ix_id")
+        ixpfx_info = peeringdb_api.get_request("ixpfx?protocol=IPv4&fields=prefix,ixlan_id")
+        if netixlan_info is False or ixlan_info is False or ixpfx_info is False:
+            return False
+
+        ixp_ips = dict()
+        for ixlan in netixlan_info["data"]:
+            if ixlan["ipaddr4"] is not None:
+                try:
+                    ixp_ips[ip_to_int(ixlan["ipaddr4"])] = (ixlan["asn"], ixlan["ix_id"])
+                except (ValueError, IOError):
+                    continue
+        ixlan_ixps = dict((ixlan["id"], ixlan["ix_id"]) for ixlan in ixlan_info["data"])
+        ixp_prefixes = list()
+        for ixpfx in ixpfx_info["data"]:
+            if ixpfx["ixlan_id"] in ixlan_ixps:
+                try:
+                    first, last = prefix_to_range(ixpfx["prefix"])
+                except (ValueError, IOError):
+                    continue
+                ixp_prefixes.append((first, last, ixlan_ixps[ixpfx["ixlan_id"]]))
+        ixp_prefixes.sort()
+
+        ips = sorted(ixp_ips)
+        columns = {
+            "ips": np.array(ips, dtype=np.uint32),
+            "asns": np.array([ixp_ips[ip][0] for ip in ips], dtype=np.uint32),
+            "ix_ids": np.array([ixp_ips[ip][1] for ip in ips], dtype=np.uint32),
+            "prefix_starts": np.array([prefix[0] for prefix in ixp_prefixes], dtype=np.uint32),
+            "prefix_ends": np.array([prefix[1] for prefix in ixp_prefixes], dtype=np.uint32),
+            "prefix_ix_ids": np.array([prefix[2] for prefix in ixp_prefixes], dtype=np.uint32)
+        }
+        # Write the new table next to the old one and swap them, so that a failed download never leaves a
+        # half-written table behind
+        temp_dir = self.table_dir.rstrip("/") + ".tmp"
+        try:
+            if os.path.isdir(temp_dir):
+                shutil.rmtree(temp_dir)
+            os.makedirs(temp_dir)
+            for column in self.COLUMNS:
+                np.save(os.path.join(temp_dir, "%s.npy" % column), columns[column])
+            with open(os.path.join(temp_dir, "timestamp"), "w") as fout:
+                fout.write("%s\n" % int(time.time()))
+            if os.path.isdir(self.table_dir):
+                shutil.rmtree(self.table_dir)
+            os.rename(temp_dir, self.table_dir)
+        except (IOError, OSError) as e:
+            self.logger.error("Writing the IXP LAN table `%s` failed with error: %s" % (self.table_dir, str(e)))
+            return False
+        return True
+
+    def lookup_prefixes(self, ips):
+        """
+        Finds the IXP of the IPs that are in an IXP peering LAN prefix, even if they are not registered in PeeringDB
+        :param ips: a numpy array of integer IPs
+        :return: a numpy array with the IXP ID of each IP (0 if the IP is not in a peering LAN prefix)
+        """
+        ips = np.asarray(ips, dtype=np.uint32)
+        ix_ids = np.zeros(len(ips), dtype=np.uint32)
+        if len(self.prefix_starts) > 0:
+            positions = np.searchsorted(self.prefix_starts, ips, side="right") - 1
+            candidates = positions >= 0
+            positions[~candidates] = 0
+            found = candidates & (self.prefix_ends[positions] >= ips)
+            ix_ids[found] = self.prefix_ix_ids[positions[found]]
+        return ix_ids
+
+    def __contains__(self, ip):
+        if not isinstance(ip, (int, long, np.integer)):
+            ip = ip_to_int(ip)
+        return bool(sorted_contains(self.ips, np.array([ip], dtype=np.uint32))[0])
+
+    def __len__(self):
+        return len(self.ips)
 
 
 class API(object):
 
-    def __init__(self):
+    def __init__(self, base_url="https://peeringdb.com/api/", cassette_store=None):
+        """
+        :param base_url: the URL of the PeeringDB API, which can point to a mirror or to a local fixture server
+        :param cassette_store: the CassetteStore that records and replays the responses, or None
+        """
         logging.basicConfig()
         self.logger = logging.getLogger("PeeringDB")
+        self.base_url = base_url if base_url.endswith("/") else base_url + "/"
+        self.cassette_store = cassette_store
 
     def get_asn_locations(self, target_asn):
         """
@@ -97,19 +233,42 @@ class API(object):
 
         return ixp_locations
 
-    def get_ixp_ips(self):
+    def get_all_asn_locations(self):
         """
-        Get the the IXP IPs and the corresponding AS members
-        :return: A dictionary that maps IPs to IxpIP objects
+        Retrieves the facility and IXP locations of every ASN in PeeringDB with four bulk requests, instead of the
+        per-ASN requests of get_asn_locations
+        :return: a dictionary that maps ASNs to the set of their locations, or False if a request failed
         """
-        endpoint = "netixlan"
-        netixlan_info = self.get_request(endpoint)
-        ixp_lan_addresses = dict()
+        netfac_info = self.get_request("netfac?fields=local_asn,city,country")
+        netixlan_info = self.get_request("netixlan?fields=asn,ix_id")
+        ix_info = self.get_request("ix?fields=id,city,country")
+        ixfac_info = self.get_request("ixfac?fields=ix_id,city,country")
+        if netfac_info is False or netixlan_info is False or ix_info is False or ixfac_info is False:
+            return False
+
+        ixp_locations = dict()
+        for ixp in ix_info["data"]:
+            ixp_locations.setdefault(ixp["id"], set()).add(("%s|%s" % (ixp["city"], ixp["country"])).lower())
+        for ixfac in ixfac_info["data"]:
+            ixp_locations.setdefault(ixfac["ix_id"], set()).add(
+                ("%s|%s" % (ixfac["city"], ixfac["country"])).lower())
+
+        asn_locations = dict()
+        for netfac in netfac_info["data"]:
+            asn_locations.setdefault(netfac["local_asn"], set()).add(
+                ("%s|%s" % (netfac["city"], netfac["country"])).lower())
         for ixlan in netixlan_info["data"]:
-            ixp_ip = IxpIP(ixlan["ipaddr4"], ixlan["ix_id"], ixlan["name"], ixlan["asn"])
-            ixp_lan_addresses[ixlan["ipaddr4"]] = ixp_ip
+            asn_locations.setdefault(ixlan["asn"], set()).update(ixp_locations.get(ixlan["ix_id"], ()))
+        return asn_locations
 
-        return ixp_lan_addresses
+    def get_ixp_lan_table(self, table_dir, max_age_hours=24):
+        """
+        Get the compact table of IXP IPs and IXP peering LAN prefixes, which is cached on disk
+        :param table_dir: the directory where the table is stored
+        :param max_age_hours: the age after which the table is downloaded again
+        :return: an IxpLanTable object
+        """
+        return IxpLanTable(table_dir, max_age_hours).load(self)
 
     def get_request(self, endpoint):
         """
@@ -117,12 +276,26 @@ class API(object):
         :param endpoint: the API endpoint that will receive the GET request
         :return: The API response in JSON format, or False if the request failed
         """
-        base_url = "https://peeringdb.com/api/"
-        query = base_url + endpoint
+        if self.cassette_store is not None:
+            return self.cassette_store.call("peeringdb", self.base_url + endpoint,
+                                            lambda: self.send_request(endpoint), lambda response: response is not False)
+        return self.send_request(endpoint)
+
+    def send_request(self, endpoint):
+        """
+        Sends a GET HTTP request to the PeeringDB RESTful API, bypassing the cassettes
+        :param endpoint: the API endpoint that will receive the GET request
+        :return: The API response in JSON format, or False if the request failed
+        """
+        query = self.base_url + endpoint
+        # The object type of the endpoint, e.g. net or netixlan
+        object_type = endpoint.split("?", 1)[0].split("/", 1)[0]
         try:
-            response = requests.get(query)
-            return response.json()
+            with METRICS.timer("peeringdb_request", endpoint=object_type):
+                response = requests.get(query)
+                return response.json()
         except requests.exceptions.RequestException as e:
+            METRICS.increment("peeringdb_request_errors", endpoint=object_type)
             self.logger.error("GET request to %s failed with error %s", endpoint, str(e))
             return False
 
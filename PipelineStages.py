@@ -0,0 +1,206 @@
+import sys
+import logging
+import threading
+import Queue
+from time import time
+from Metrics import METRICS
+
+# Marks the end of the items that flow through the stages
+END_OF_STREAM = object()
+
+
+class StageAborted(Exception):
+    """
+    Raised in the threads of the stages when another stage has failed
+    """
+    pass
+
+
+class PipelineStage(object):
+    """
+    A step of the geolocation that runs in its own thread and processes the items of its bounded input queue. The
+    time of the thread is split in busy time (processing items), starved time (waiting for input) and blocked time
+    (waiting for space in the queue of the next stage), which shows where the bottleneck of a run is.
+    """
+
+    def __init__(self, name, process, queue_size=4):
+        """
+        :param name: the name of the stage, used in the occupancy reports
+        :param process: a function that takes an input item and returns an iterable of output items
+        :param queue_size: the maximum number of items that wait in the input queue of the stage
+        """
+        self.name = name
+        self.process = process
+        self.input_queue = Queue.Queue(max(1, int(queue_size)))
+        self.items = 0
+        self.busy_seconds = 0.0
+        self.starved_seconds = 0.0
+        self.blocked_seconds = 0.0
+        self.started = None
+        self.finished = None
+
+    def occupancy(self):
+        """
+        :return: a dictionary with the number of processed items and the fraction of the stage's running time that
+        was spent busy, starved and blocked
+        """
+        elapsed = max((self.finished or time()) - (self.started or time()), 1e-9)
+        return {
+            "items": self.items,
+            "queued": self.input_queue.qsize(),
+            "busy": self.busy_seconds / elapsed,
+            "starved": self.starved_seconds / elapsed,
+            "blocked": self.blocked_seconds / elapsed
+        }
+
+
+class StagedPipeline(object):
+    """
+    Runs a chain of PipelineStages concurrently, so that e.g. the presence and probe lookup of the next ASN run while
+    the targets of the current ASN are measured. The bounded queues between the stages keep the fast stages from
+    running too far ahead of the slow ones.
+    """
+
+    def __init__(self, stages, report_seconds=60):
+        """
+        :param stages: the list of PipelineStages, in the order in which the items flow through them
+        :param report_seconds: how often the occupancy of the stages is logged (0 disables the periodic reports)
+        """
+        logging.basicConfig()
+        self.logger = logging.getLogger("PipelineStages")
+        self.logger.setLevel(logging.INFO)
+        self.stages = stages
+        self.report_seconds = float(report_seconds)
+        # Reading the input runs in the calling thread and is reported like the other stages
+        self.source_stage = PipelineStage("read", None)
+        self.abort_event = threading.Event()
+        self.error = None
+        self.last_report = None
+
+    def put(self, stage, output_queue, item):
+        """
+        Puts an item in the queue of the next stage, waiting while the queue is full
+        """
+        if output_queue is None:
+            return
+        start = time()
+        while True:
+            if self.abort_event.is_set():
+                raise StageAborted()
+            try:
+                output_queue.put(item, timeout=0.5)
+                break
+            except Queue.Full:
+                continue
+        stage.blocked_seconds += time() - start
+
+    def get(self, stage):
+        """
+        Gets the next item from the input queue of a stage, waiting while the queue is empty
+        """
+        start = time()
+        while True:
+            if self.abort_event.is_set():
+                raise StageAborted()
+            try:
+                item = stage.input_queue.get(timeout=0.5)
+                break
+            except Queue.Empty:
+                continue
+        stage.starved_seconds += time() - start
+        return item
+
+    def run_stage(self, stage, output_queue):
+        stage.started = time()
+        try:
+            while True:
+                item = self.get(stage)
+                if item is END_OF_STREAM:
+                    break
+                start = time()
+                for output in stage.process(item):
+                    stage.busy_seconds += time() - start
+                    self.put(stage, output_queue, output)
+                    start = time()
+                stage.busy_seconds += time() - start
+                stage.items += 1
+            self.put(stage, output_queue, END_OF_STREAM)
+        except StageAborted:
+            pass
+        except BaseException:
+            # SystemExit is caught too, since the Atlas client exits on measurement errors
+            self.fail(sys.exc_info())
+        finally:
+            stage.finished = time()
+
+    def fail(self, exc_info):
+        if self.error is None:
+            self.error = exc_info
+        self.abort_event.set()
+
+    def report(self):
+        """
+        Logs the occupancy of every stage
+        """
+        for stage in [self.source_stage] + self.stages:
+            occupancy = stage.occupancy()
+            for state in ("busy", "starved", "blocked"):
+                METRICS.set_gauge("stage_%s_ratio" % state, occupancy[state], stage=stage.name)
+            METRICS.set_gauge("stage_queued_items", occupancy["queued"], stage=stage.name)
+            self.logger.info("Stage %-10s items %6s | queued %3s | busy %5.1f%% | starved %5.1f%% | blocked %5.1f%%" %
+                             (stage.name, occupancy["items"], occupancy["queued"], 100 * occupancy["busy"],
+                              100 * occupancy["starved"], 100 * occupancy["blocked"]))
+
+    def report_if_due(self):
+        if self.report_seconds > 0 and time() - self.last_report >= self.report_seconds:
+            self.report()
+            self.last_report = time()
+
+    def run(self, source):
+        """
+        Runs the stages until every item of the source has been processed. An error in any stage stops the other
+        stages and is raised again in the calling thread.
+        :param source: an iterable with the input items of the first stage, which is read in the calling thread
+        """
+        threads = list()
+        for index, stage in enumerate(self.stages):
+            output_queue = self.stages[index + 1].input_queue if index + 1 < len(self.stages) else None
+            thread = threading.Thread(target=self.run_stage, args=(stage, output_queue), name=stage.name)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+        self.last_report = time()
+        self.source_stage.started = time()
+        first_queue = self.stages[0].input_queue
+        try:
+            items = iter(source)
+            while True:
+                start = time()
+                try:
+                    item = next(items)
+                except StopIteration:
+                    break
+                self.source_stage.busy_seconds += time() - start
+                self.source_stage.items += 1
+                self.put(self.source_stage, first_queue, item)
+                self.report_if_due()
+            self.put(self.source_stage, first_queue, END_OF_STREAM)
+            self.source_stage.finished = time()
+            for thread in threads:
+                while thread.is_alive():
+                    thread.join(1.0)
+                    self.report_if_due()
+        except StageAborted:
+            pass
+        except BaseException:
+            self.fail(sys.exc_info())
+        finally:
+            for thread in threads:
+                thread.join()
+            if self.source_stage.finished is None:
+                self.source_stage.finished = time()
+        self.report()
+
+        if self.error is not None:
+            raise self.error[0], self.error[1], self.error[2]
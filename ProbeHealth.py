@@ -0,0 +1,187 @@
+import os
+import logging
+import threading
+from time import time
+
+# The columns of the probe health file, after the probe ID
+HEALTH_COLUMNS = ("requested", "replied", "noise_sum", "noise_count", "last_request", "last_success")
+
+
+class ProbeHealthStore(object):
+    """
+    The reliability of the Atlas probes, updated from every measurement and kept across runs: how often a probe
+    replied when it was requested, how noisy its RTTs are (the gap between the median and the minimum RTT of its
+    replies, relative to the minimum), and when it last replied. Probes that stopped replying are excluded from the
+    probe selection, and the others are ranked so that the most reliable probes are measured first and the least
+    reliable are trimmed first. Excluded probes are requested again once they haven't been requested for the maximum
+    silence, so that probes that came back online are used again.
+    """
+
+    def __init__(self, health_file, min_requests=5, min_response_rate=0.2, max_silent_days=7, window=50):
+        """
+        :param health_file: the TSV file where the health of the probes is kept, None to keep it only in memory
+        :param min_requests: the number of requests after which a probe can be excluded
+        :param min_response_rate: probes that replied to fewer of their requests than this are excluded
+        :param max_silent_days: probes that were requested but haven't replied for this many days are excluded, and
+        excluded probes are requested again after this many days without requests
+        :param window: the counters of a probe are halved when it has been requested this many times, so that the
+        recent measurements weigh more than the old ones
+        """
+        logging.basicConfig()
+        self.logger = logging.getLogger("ProbeHealth")
+        self.health_file = health_file
+        self.min_requests = int(min_requests)
+        self.min_response_rate = float(min_response_rate)
+        self.max_silent_seconds = float(max_silent_days) * 86400
+        self.window = max(2, int(window))
+        self.lock = threading.Lock()
+        # Probe ID -> list with the values of HEALTH_COLUMNS
+        self.probes = dict()
+        # The updates since the store was loaded, which the worker processes of a sharded run send to the parent
+        self.updates = dict()
+
+    def load(self):
+        """
+        Reads the health of the probes measured in previous runs
+        :return: the ProbeHealthStore object
+        """
+        if self.health_file is None:
+            return self
+        try:
+            with open(self.health_file) as fin:
+                for line in fin:
+                    if line.startswith("#"):
+                        continue
+                    lf = line.rstrip("\n").split("\t")
+                    if len(lf) < len(HEALTH_COLUMNS) + 1:
+                        continue
+                    self.probes[int(lf[0])] = [int(lf[1]), int(lf[2]), float(lf[3]), int(lf[4]), int(lf[5]),
+                                               int(lf[6])]
+        except IOError:
+            # The file is only created at the end of the first run
+            pass
+        except ValueError:
+            self.logger.error("The probe health file `%s` is malformatted" % self.health_file)
+        return self
+
+    def write(self):
+        """
+        Writes the health of every probe to the health file
+        """
+        if self.health_file is None:
+            return
+        with self.lock:
+            probes = sorted(self.probes.iteritems())
+        tmp_file = self.health_file + ".tmp"
+        try:
+            with open(tmp_file, "w") as fout:
+                fout.write("#probe_id\t%s\n" % "\t".join(HEALTH_COLUMNS))
+                for probe_id, health in probes:
+                    fout.write("%s\t%s\t%s\t%s\t%s\t%s\t%s\n" % ((probe_id,) + tuple(health)))
+            os.rename(tmp_file, self.health_file)
+        except (IOError, OSError) as e:
+            self.logger.error("Writing the probe health file `%s` failed with error: %s" % (self.health_file, str(e)))
+
+    def apply(self, probe_id, requested, replied, noise_sum, noise_count, last_request, last_success):
+        health = self.probes.get(probe_id)
+        if health is None:
+            health = self.probes[probe_id] = [0, 0, 0.0, 0, 0, 0]
+        health[0] += requested
+        health[1] += replied
+        health[2] += noise_sum
+        health[3] += noise_count
+        health[4] = max(health[4], last_request)
+        health[5] = max(health[5], last_success)
+        if health[0] >= self.window:
+            health[0] = (health[0] + 1) // 2
+            health[1] = health[1] // 2
+            health[2] /= 2
+            health[3] = health[3] // 2
+
+    def record_measurement(self, probe_ids, ping_results):
+        """
+        Updates the health of the probes of a measurement
+        :param probe_ids: the probes that were requested
+        :param ping_results: a dictionary that maps the probes that reported a result to their
+        RttAggregator.RttSummary
+        """
+        now = int(time())
+        with self.lock:
+            for probe_id in probe_ids:
+                rtt_summary = ping_results.get(probe_id)
+                if rtt_summary is not None and rtt_summary.received > 0:
+                    noise = (rtt_summary.median_rtt - rtt_summary.min_rtt) / max(rtt_summary.min_rtt, 1.0)
+                    update = (1, 1, noise, 1, now, now)
+                else:
+                    update = (1, 0, 0.0, 0, now, 0)
+                self.apply(probe_id, *update)
+                previous = self.updates.get(probe_id)
+                if previous is None:
+                    self.updates[probe_id] = list(update)
+                else:
+                    for index in xrange(4):
+                        previous[index] += update[index]
+                    previous[4] = max(previous[4], update[4])
+                    previous[5] = max(previous[5], update[5])
+
+    def export_updates(self):
+        """
+        :return: the updates since the store was loaded, which can be sent to another process
+        """
+        with self.lock:
+            return dict((probe_id, tuple(update)) for probe_id, update in self.updates.iteritems())
+
+    def merge(self, updates):
+        """
+        Applies the updates of another process
+        :param updates: the updates returned by export_updates in the other process
+        """
+        with self.lock:
+            for probe_id, update in updates.iteritems():
+                self.apply(probe_id, *update)
+
+    def response_rate(self, probe_id):
+        """
+        :return: the smoothed fraction of requests to which a probe replied (0.5 for unknown probes)
+        """
+        health = self.probes.get(probe_id)
+        if health is None:
+            return 0.5
+        return (health[1] + 1.0) / (health[0] + 2.0)
+
+    def is_excluded(self, probe_id, now=None):
+        """
+        :return: True if the probe has been requested enough times and rarely replied, or if it has been silent for
+        longer than the maximum silence, unless it hasn't been requested for the maximum silence
+        """
+        health = self.probes.get(probe_id)
+        if health is None or health[0] < self.min_requests:
+            return False
+        now = time() if now is None else now
+        # Excluded probes are not requested, so their counters would never change again
+        if now - health[4] > self.max_silent_seconds:
+            return False
+        if float(health[1]) / health[0] < self.min_response_rate:
+            return True
+        return health[4] > health[5] and now - health[5] > self.max_silent_seconds
+
+    def score(self, probe_id):
+        """
+        :return: the reliability of a probe, the response rate reduced by the noise of its RTTs
+        """
+        health = self.probes.get(probe_id)
+        if health is None:
+            return self.response_rate(probe_id)
+        noise = health[2] / health[3] if health[3] > 0 else 0.0
+        return self.response_rate(probe_id) / (1.0 + noise)
+
+    def healthy_probes(self, probe_ids):
+        """
+        Filters out the excluded probes, unless every probe is excluded, so that a location is never left without
+        probes
+        :param probe_ids: the probe IDs
+        :return: the list of probe IDs that are not excluded
+        """
+        now = time()
+        healthy = [probe_id for probe_id in probe_ids if not self.is_excluded(probe_id, now)]
+        return healthy if len(healthy) > 0 else list(probe_ids)
@@ -0,0 +1,61 @@
+def draw_indices(population_size, sample_size, random):
+    """
+    Draws distinct indices with rejection, which for the few probes per location is much cheaper than random.sample
+    :param population_size: the number of items to draw from
+    :param sample_size: the number of indices to draw, at most :population_size
+    :param random: the random() function of a random.Random object
+    :return: the set of drawn indices
+    """
+    indices = set()
+    while len(indices) < sample_size:
+        indices.add(int(random() * population_size))
+    return indices
+
+
+class ProbePool(object):
+    """
+    The Atlas probes of a candidate location of an ASN. The pool is built once per (ASN, location) when the ASN is
+    located: the probe IDs are kept in a sorted tuple, and the probes in ASes that neighbor the target ASN are
+    bucketed per probe ASN. Sampling the probes of a target is then a handful of random draws per location, instead
+    of a walk over every probe of the location.
+    """
+
+    def __init__(self, location, probe_ids, probe_objects, neighboring_probes):
+        """
+        :param location: the location of the probes, in the format city|country
+        :param probe_ids: the IDs of the probes in the location
+        :param probe_objects: a dictionary that maps probe IDs to Atlas.Probe objects
+        :param neighboring_probes: the set of probe IDs in ASes neighboring the target ASN
+        """
+        self.location = location
+        self.probes = tuple(sorted(probe_ids))
+        neighbor_buckets = dict()
+        for probe_id in self.probes:
+            if probe_id in neighboring_probes:
+                neighbor_buckets.setdefault(probe_objects[probe_id].asn, list()).append(probe_id)
+        # One bucket per neighboring ASN, in a fixed order so that seeded runs draw the same probes
+        self.neighbor_buckets = [tuple(neighbor_buckets[asn]) for asn in sorted(neighbor_buckets)]
+
+    def sample(self, probes_num, rng):
+        """
+        Draws the probes of a target in the location: one probe from each of up to :probes_num neighboring ASNs,
+        then random probes of the location until :probes_num probes are selected
+        :param probes_num: the number of probes per location
+        :param rng: the random.Random object used for the draws
+        :return: a collection of probe IDs
+        """
+        if probes_num >= len(self.probes):
+            return list(self.probes)
+        random = rng.random
+        buckets = self.neighbor_buckets
+        if len(buckets) > probes_num:
+            buckets = [buckets[index] for index in draw_indices(len(buckets), probes_num, random)]
+        selected = set(bucket[int(random() * len(bucket))] for bucket in buckets)
+        # Fill up with random probes of the location, skipping the ones already selected
+        probes_len = len(self.probes)
+        while len(selected) < probes_num:
+            selected.add(self.probes[int(random() * probes_len)])
+        return selected
+
+    def __len__(self):
+        return len(self.probes)
@@ -0,0 +1,285 @@
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+from ujson import dumps
+from Metrics import METRICS
+import numpy as np
+
+# The columns of the geolocation output, in the order they are written in the TSV format
+COLUMNS = (
+    "ip",             # Column 1: IP address
+    "asn",            # Column 2: ASN
+    "city",           # Column 3: City name of closest probe
+    "admn_lvl_2",     # Column 4: Administrative area of closest probe
+    "country",        # Column 5: Country ISO code of closest probe
+    "lat",            # Column 6: Latitude of the closest probe
+    "lng",            # Column 7: Longitude of the closest probe
+    "min_rtt",        # Column 8: Measured minimum RTT
+    "facility_city",  # Column 9: City of nearest facility
+    "timestamp",      # Column 10: Current timestamp
+    "datetime"        # Column 11: Current datetime (added to facilitate readability)
+)
+
+# The data types of the numeric columns in the columnar format, all other columns are stored as text
+NUMERIC_COLUMNS = {
+    "asn": np.int64,
+    "lat": np.float64,
+    "lng": np.float64,
+    "min_rtt": np.float64,
+    "timestamp": np.int64
+}
+
+
+def _encode(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+
+class TsvFormat(object):
+    """
+    Writes one tab-separated line per result, with the columns in the order of COLUMNS. The optional comment of a
+    record is appended to the line after a `#`.
+    """
+    def __init__(self, output_file):
+        self.output_file = output_file
+        self.fout = open(output_file, "a+")
+
+    def write_batch(self, records):
+        lines = list()
+        for record in records:
+            line = "\t".join(_encode(record[column]) for column in COLUMNS)
+            if record.get("comment"):
+                line += " # %s" % record["comment"]
+            lines.append(line + "\n")
+        self.fout.write("".join(lines))
+
+    def flush(self, fsync):
+        self.fout.flush()
+        if fsync:
+            os.fsync(self.fout.fileno())
+
+    def close(self):
+        self.fout.close()
+
+    @staticmethod
+    def read_ips(output_file):
+        """
+        Reads the IPs that have been written in a previous run
+        :param output_file: the path to the output file
+        :return: a generator of the IPs in the output file
+        """
+        with open(output_file) as fin:
+            for line in fin:
+                if not line.startswith("#"):
+                    lf = line.strip().split("\t")
+                    if len(lf[0]) > 0:
+                        yield lf[0]
+
+
+class JsonLinesFormat(object):
+    """
+    Writes one JSON object per line with the columns of COLUMNS as keys
+    """
+    def __init__(self, output_file):
+        self.output_file = output_file
+        self.fout = open(output_file, "a+")
+
+    def write_batch(self, records):
+        lines = list()
+        for record in records:
+            lines.append(dumps(record) + "\n")
+        self.fout.write("".join(lines))
+
+    def flush(self, fsync):
+        self.fout.flush()
+        if fsync:
+            os.fsync(self.fout.fileno())
+
+    def close(self):
+        self.fout.close()
+
+    @staticmethod
+    def read_ips(output_file):
+        with open(output_file) as fin:
+            for line in fin:
+                # Avoid decoding the whole record just to get the IP
+                start = line.find('"ip":"')
+                if start >= 0:
+                    start += 6
+                    yield line[start:line.index('"', start)]
+
+
+class ColumnarFormat(object):
+    """
+    Writes every column to a separate file inside the output directory. Numeric columns are appended as raw
+    little-endian arrays (`<column>.bin`) that can be loaded with numpy.fromfile or numpy.memmap, and text columns
+    are appended as one value per line (`<column>.txt`). The data types are described in `schema.tsv`.
+    """
+    def __init__(self, output_file):
+        self.output_file = output_file
+        if not os.path.isdir(output_file):
+            os.makedirs(output_file)
+        with open(os.path.join(output_file, "schema.tsv"), "w") as fout:
+            for column in COLUMNS + ("comment",):
+                if column in NUMERIC_COLUMNS:
+                    fout.write("%s\t%s.bin\t%s\n" % (column, column, np.dtype(NUMERIC_COLUMNS[column]).str))
+                else:
+                    fout.write("%s\t%s.txt\tutf-8\n" % (column, column))
+        self.column_files = dict()
+        for column in COLUMNS + ("comment",):
+            if column in NUMERIC_COLUMNS:
+                self.column_files[column] = open(os.path.join(output_file, "%s.bin" % column), "ab")
+            else:
+                self.column_files[column] = open(os.path.join(output_file, "%s.txt" % column), "a+")
+
+    def write_batch(self, records):
+        for column, fout in self.column_files.iteritems():
+            if column in NUMERIC_COLUMNS:
+                values = np.array([record[column] for record in records], dtype=NUMERIC_COLUMNS[column])
+                fout.write(values.astype(values.dtype.newbyteorder("<")).tostring())
+            else:
+                fout.write("".join("%s\n" % _encode(record.get(column, "")) for record in records))
+
+    def flush(self, fsync):
+        for fout in self.column_files.itervalues():
+            fout.flush()
+            if fsync:
+                os.fsync(fout.fileno())
+
+    def close(self):
+        for fout in self.column_files.itervalues():
+            fout.close()
+
+    @staticmethod
+    def read_ips(output_file):
+        with open(os.path.join(output_file, "ip.txt")) as fin:
+            for line in fin:
+                yield line.rstrip("\n")
+
+
+OUTPUT_FORMATS = {
+    "tsv": TsvFormat,
+    "jsonl": JsonLinesFormat,
+    "columnar": ColumnarFormat
+}
+
+
+def register_output_format(name, format_class):
+    """
+    Makes a new output format available to the ResultWriter. The format class is constructed with the output path
+    and must implement write_batch(records), flush(fsync), close() and the static read_ips(output_file).
+    :param name: the name of the format, as used in the [Output] section of the configuration file
+    :param format_class: the class implementing the format
+    """
+    OUTPUT_FORMATS[name] = format_class
+
+
+class ResultWriter(object):
+    """
+    Buffers geolocation results and writes them in batches to the output file. The buffer is flushed when it holds
+    `buffer_records` results, or when `flush_seconds` have passed since the last flush. A writer can be shared
+    between threads. If a ResumeIndex is given, the IPs of every batch are added to it once the batch is written.
+    """
+
+    def __init__(self, output_file, output_format="tsv", buffer_records=100, flush_seconds=10, fsync=False,
+                 resume_index=None):
+        logging.basicConfig()
+        self.logger = logging.getLogger("ResultWriter")
+        if output_format not in OUTPUT_FORMATS:
+            raise ValueError("Unknown output format `%s`. Available formats: %s" %
+                             (output_format, ", ".join(sorted(OUTPUT_FORMATS))))
+        self.output_file = output_file
+        self.output_format = OUTPUT_FORMATS[output_format](output_file)
+        self.buffer_records = max(1, int(buffer_records))
+        self.flush_seconds = float(flush_seconds)
+        self.fsync = fsync
+        # The ResumeIndex which is updated with the IPs of every flushed batch
+        self.resume_index = resume_index
+        self.buffer = list()
+        self.lock = threading.RLock()
+        self.last_flush = time.time()
+        self.closed = False
+        self.last_timestamp = None
+        self.last_datetime = None
+        # Flush the buffer periodically even if no new results arrive
+        self.stop_event = threading.Event()
+        self.flush_thread = None
+        if self.flush_seconds > 0:
+            self.flush_thread = threading.Thread(target=self._flush_periodically, name="ResultWriterFlush")
+            self.flush_thread.daemon = True
+            self.flush_thread.start()
+
+    def _flush_periodically(self):
+        while not self.stop_event.wait(self.flush_seconds):
+            with self.lock:
+                if len(self.buffer) > 0 and time.time() - self.last_flush >= self.flush_seconds:
+                    self.flush()
+
+    def _datetime(self, timestamp):
+        # Consecutive results are mostly written within the same second, so reuse the last formatted datetime
+        if timestamp != self.last_timestamp:
+            self.last_timestamp = timestamp
+            self.last_datetime = str(datetime.utcfromtimestamp(timestamp))
+        return self.last_datetime
+
+    def write(self, record):
+        """
+        Adds a geolocation result to the buffer
+        :param record: a dictionary with the values of COLUMNS. The timestamp and datetime are filled in if missing,
+        and an optional `comment` is kept along with the result.
+        """
+        with self.lock:
+            if self.closed:
+                raise ValueError("Write to closed ResultWriter for `%s`" % self.output_file)
+            if record.get("timestamp") is None:
+                record["timestamp"] = int(time.time())
+            if record.get("datetime") is None:
+                record["datetime"] = self._datetime(record["timestamp"])
+            self.buffer.append(record)
+            if len(self.buffer) >= self.buffer_records or \
+                    (self.flush_seconds > 0 and time.time() - self.last_flush >= self.flush_seconds):
+                self.flush()
+
+    def flush(self):
+        """
+        Writes the buffered results to the output file
+        """
+        with self.lock:
+            if len(self.buffer) > 0:
+                try:
+                    with METRICS.timer("output_write"):
+                        self.output_format.write_batch(self.buffer)
+                        self.output_format.flush(self.fsync)
+                    METRICS.increment("output_records", len(self.buffer))
+                except (IOError, OSError) as e:
+                    self.logger.error("Writing to `%s` failed with error: %s" % (self.output_file, str(e)))
+                    return
+                if self.resume_index is not None:
+                    self.resume_index.add(record["ip"] for record in self.buffer)
+                self.buffer = list()
+            self.last_flush = time.time()
+
+    def close(self):
+        """
+        Flushes the remaining results and closes the output file. Closing a closed writer has no effect.
+        """
+        self.stop_event.set()
+        if self.flush_thread is not None and self.flush_thread is not threading.current_thread():
+            self.flush_thread.join()
+        with self.lock:
+            if self.closed:
+                return
+            self.flush()
+            self.output_format.close()
+            if self.resume_index is not None:
+                self.resume_index.close()
+            self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
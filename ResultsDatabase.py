@@ -0,0 +1,390 @@
+import os
+import time
+import zlib
+import shutil
+import logging
+import numpy as np
+from ujson import dumps, loads
+from ip_utils import ip_to_int, int_to_ip, ips_to_array
+
+# The version of the database layout, databases of another version are rebuilt from scratch
+FORMAT_VERSION = 3
+
+# The RTTs are rounded to this precision (ms) so that the records of neighboring IPs can be shared
+RTT_PRECISION_MS = 0.1
+
+# The number of bytes at the start of the output file whose checksum detects an output that has been replaced
+HEAD_BYTES = 65536
+
+# The output formats that can be compiled, which are read line by line from an offset
+COMPILED_FORMATS = ("tsv", "jsonl")
+
+
+def iter_output_records(output_file, output_format="tsv", offset=0):
+    """
+    Reads the results of a geolocation output file from a byte offset. A last line without a newline is still being
+    written and is left for the next compilation.
+    :param output_file: the output file of the ResultWriter
+    :param output_format: the format of the output, one of COMPILED_FORMATS
+    :param offset: the offset of the first line to read
+    :return: a generator of (offset after the line, record) tuples, where the record is an (integer IP, ASN, city,
+    administrative area, country, lat, lng, minimum RTT, facility city, timestamp) tuple or None for the lines that
+    are not IPv4 results
+    """
+    if output_format not in COMPILED_FORMATS:
+        raise ValueError("The results database can't be compiled from the `%s` format. Compiled formats: %s" %
+                         (output_format, ", ".join(COMPILED_FORMATS)))
+    with open(output_file, "rb") as fin:
+        fin.seek(offset)
+        for line in fin:
+            if not line.endswith("\n"):
+                break
+            offset += len(line)
+            try:
+                if output_format == "tsv":
+                    if line.startswith("#"):
+                        yield offset, None
+                        continue
+                    values = line.rstrip("\n").split("\t")
+                    ip, asn, city, admn_lvl_2, country, lat, lng, min_rtt, facility_city, timestamp = values[:10]
+                else:
+                    record = loads(line)
+                    ip, asn, city, admn_lvl_2, country, lat, lng, min_rtt, facility_city, timestamp = (
+                        record["ip"], record["asn"], record["city"], record["admn_lvl_2"], record["country"],
+                        record["lat"], record["lng"], record["min_rtt"], record["facility_city"], record["timestamp"])
+                    city, admn_lvl_2, country, facility_city = [
+                        value.encode("utf-8") if isinstance(value, unicode) else str(value)
+                        for value in (city, admn_lvl_2, country, facility_city)]
+                yield offset, (ip_to_int(ip), int(asn), city, admn_lvl_2, country, float(lat), float(lng),
+                               float(min_rtt), facility_city, int(timestamp))
+            except (ValueError, TypeError, KeyError, AttributeError):
+                # Comments, IPv6 results and truncated records
+                yield offset, None
+
+
+def file_head_checksum(path, length):
+    """
+    :return: the CRC32 of the first `length` bytes of a file
+    """
+    with open(path, "rb") as fin:
+        return zlib.crc32(fin.read(length)) & 0xffffffff
+
+
+class ResultsDatabase(object):
+    """
+    A compiled, read-only copy of the geolocation output for high-rate lookups, in the spirit of the MMDB files. The
+    results are stored as sorted, non-overlapping ranges of integer IPs: consecutive IPs with the same result share
+    a range, so a /24 located at one city is a single entry. Every range points to an interned record, and the text
+    fields of the records point to an interned string pool, so the database is a few arrays of integers that are
+    loaded with mmap. A lookup is a binary search over the range starts, and lookup_many answers a whole array of IPs
+    in one vectorized search. The timestamps of the results are kept per IP, outside of the ranges, as runs of
+    consecutive IPs (in the order of the IPs) with the same timestamp.
+
+    The database remembers how far it has read the output file, so compiling it again only parses the results that
+    were appended since. Newer results of an IP replace the older ones.
+    """
+
+    COLUMNS = ("range_starts", "range_ends", "range_records", "range_offsets", "timestamp_starts", "timestamp_values",
+               "record_asns", "record_cities", "record_admn_lvl_2", "record_countries", "record_lats", "record_lngs",
+               "record_rtts", "record_facility_cities", "strings")
+
+    def __init__(self, database_dir):
+        """
+        :param database_dir: the directory of the database
+        """
+        logging.basicConfig()
+        self.logger = logging.getLogger("ResultsDatabase")
+        self.database_dir = database_dir
+        self.metadata = dict()
+        self.range_starts = np.zeros(0, dtype=np.uint32)
+        self.range_ends = np.zeros(0, dtype=np.uint32)
+        self.range_records = np.zeros(0, dtype=np.uint32)
+        # The number of IPs before each range, i.e. the index of its first IP among all the IPs of the database
+        self.range_offsets = np.zeros(0, dtype=np.uint32)
+        # The index of the first IP of every timestamp run among all the IPs of the database, and its timestamp
+        self.timestamp_starts = np.zeros(0, dtype=np.uint32)
+        self.timestamp_values = np.zeros(0, dtype=np.uint32)
+        self.record_asns = np.zeros(0, dtype=np.uint32)
+        self.record_cities = np.zeros(0, dtype=np.uint32)
+        self.record_admn_lvl_2 = np.zeros(0, dtype=np.uint32)
+        self.record_countries = np.zeros(0, dtype=np.uint32)
+        self.record_lats = np.zeros(0, dtype=np.float64)
+        self.record_lngs = np.zeros(0, dtype=np.float64)
+        self.record_rtts = np.zeros(0, dtype=np.float32)
+        self.record_facility_cities = np.zeros(0, dtype=np.uint32)
+        self.strings = np.zeros(0, dtype=np.string_)
+
+    def load(self):
+        """
+        Memory-maps the database if it exists and has the current format version
+        :return: the ResultsDatabase object, which is empty if the database can't be used
+        """
+        try:
+            with open(os.path.join(self.database_dir, "metadata.json")) as fin:
+                metadata = loads(fin.read())
+        except (IOError, ValueError):
+            return self
+        if metadata.get("version") != FORMAT_VERSION:
+            self.logger.warning("Ignoring the results database `%s` of version %s" %
+                                (self.database_dir, metadata.get("version")))
+            return self
+        try:
+            columns = dict((column, np.load(os.path.join(self.database_dir, "%s.npy" % column), mmap_mode="r"))
+                           for column in self.COLUMNS)
+        except (IOError, ValueError) as e:
+            self.logger.error("Could not load the results database `%s`: %s" % (self.database_dir, str(e)))
+            return self
+        for column, values in columns.iteritems():
+            setattr(self, column, values)
+        self.metadata = metadata
+        return self
+
+    def __len__(self):
+        """
+        :return: the number of IP ranges
+        """
+        return len(self.range_starts)
+
+    def ips_num(self):
+        """
+        :return: the number of IPs with a result
+        """
+        return int(self.metadata.get("ips", 0))
+
+    def lookup_many(self, ips):
+        """
+        Finds the ranges of an array of IPs with one vectorized binary search
+        :param ips: a numpy array of integer IPs, or an iterable of IPs
+        :return: a numpy int64 array with the index of the range of every IP, -1 for the IPs without a result
+        """
+        if not isinstance(ips, np.ndarray):
+            ips = ips_to_array(ips)
+        positions = np.searchsorted(self.range_starts, ips, side="right").astype(np.int64) - 1
+        if len(self.range_starts) == 0:
+            return positions
+        found = (positions >= 0) & (ips <= self.range_ends[np.maximum(positions, 0)])
+        positions[~found] = -1
+        return positions
+
+    def lookup(self, ip):
+        """
+        :param ip: an IP address, dotted or as an integer
+        :return: the result of the IP as a dictionary with the columns of the output, or None if there is none
+        """
+        if not isinstance(ip, (int, long, np.integer)):
+            ip = ip_to_int(ip)
+        position = int(np.searchsorted(self.range_starts, ip, side="right")) - 1
+        if position < 0 or ip > self.range_ends[position]:
+            return None
+        return self.get_result(position, ip)
+
+    def get_result(self, position, ip):
+        """
+        :param position: the index of a range, as returned by lookup_many
+        :param ip: the integer IP in the range
+        :return: the result of the IP as a dictionary with the columns of the output
+        """
+        record = self.range_records[position]
+        ip_index = int(self.range_offsets[position]) + int(ip) - int(self.range_starts[position])
+        return {
+            "ip": int_to_ip(ip),
+            "asn": int(self.record_asns[record]),
+            "city": self.strings[self.record_cities[record]].decode("utf-8"),
+            "admn_lvl_2": self.strings[self.record_admn_lvl_2[record]].decode("utf-8"),
+            "country": self.strings[self.record_countries[record]].decode("utf-8"),
+            "lat": float(self.record_lats[record]),
+            "lng": float(self.record_lngs[record]),
+            "min_rtt": round(float(self.record_rtts[record]), 3),
+            "facility_city": self.strings[self.record_facility_cities[record]].decode("utf-8"),
+            "timestamp": self.get_timestamp(ip_index)
+        }
+
+    def get_timestamp(self, ip_index):
+        """
+        :param ip_index: the index of an IP among all the IPs of the database
+        :return: the timestamp of the result of the IP
+        """
+        run = int(np.searchsorted(self.timestamp_starts, ip_index, side="right")) - 1
+        return int(self.timestamp_values[run])
+
+    def iter_ranges(self):
+        """
+        :return: a generator of (first IP, last IP, result of the first IP) tuples, in the order of the IPs
+        """
+        for position in xrange(len(self.range_starts)):
+            yield int(self.range_starts[position]), int(self.range_ends[position]), \
+                self.get_result(position, int(self.range_starts[position]))
+
+    def expand(self):
+        """
+        :return: a tuple with the numpy arrays of every IP in the database, its record and its timestamp
+        """
+        lengths = (self.range_ends.astype(np.int64) - self.range_starts + 1)
+        range_offsets = np.cumsum(lengths) - lengths
+        ips = (np.arange(lengths.sum(), dtype=np.int64) - np.repeat(range_offsets, lengths) +
+               np.repeat(self.range_starts.astype(np.int64), lengths)).astype(np.uint32)
+        run_lengths = np.diff(np.append(self.timestamp_starts.astype(np.int64), len(ips)))
+        return ips, np.repeat(self.range_records, lengths), np.repeat(self.timestamp_values, run_lengths)
+
+    def resolved_records(self):
+        """
+        :return: the list of the records with their strings instead of the string IDs
+        """
+        strings = self.strings.tolist()
+        return zip(self.record_asns.tolist(), [strings[index] for index in self.record_cities.tolist()],
+                   [strings[index] for index in self.record_admn_lvl_2.tolist()],
+                   [strings[index] for index in self.record_countries.tolist()], self.record_lats.tolist(),
+                   self.record_lngs.tolist(), self.record_rtts.tolist(),
+                   [strings[index] for index in self.record_facility_cities.tolist()])
+
+    def has_same_results(self, other):
+        """
+        Compares the results of two databases, whatever the order of their records and strings, e.g. to check that an
+        incremental compilation equals a full rebuild
+        :param other: the other ResultsDatabase
+        :return: True if both databases have the same ranges with the same results and timestamps
+        """
+        if not (np.array_equal(self.range_starts, other.range_starts) and
+                np.array_equal(self.range_ends, other.range_ends) and
+                np.array_equal(self.timestamp_starts, other.timestamp_starts) and
+                np.array_equal(self.timestamp_values, other.timestamp_values)):
+            return False
+        records, other_records = self.resolved_records(), other.resolved_records()
+        return all(records[record] == other_records[other_record] for record, other_record in
+                   zip(self.range_records.tolist(), other.range_records.tolist()))
+
+    def resume_offset(self, output_file, output_format):
+        """
+        :return: the offset of the output file up to which the database has been compiled, 0 if the database was
+        compiled from another output, or if the output has been truncated or replaced since
+        """
+        offset = self.metadata.get("offset", 0)
+        if len(self.metadata) == 0 or self.metadata.get("source") != os.path.abspath(output_file) or \
+                self.metadata.get("format") != output_format or os.path.getsize(output_file) < offset:
+            return 0
+        if file_head_checksum(output_file, min(offset, HEAD_BYTES)) != self.metadata.get("head_checksum"):
+            return 0
+        return offset
+
+    def compile(self, output_file, output_format="tsv", full=False):
+        """
+        Adds the results that were appended to an output file since the last compilation, and writes the database
+        next to the previous one before swapping them. The database is rebuilt from the start of the output file
+        if it was compiled from another file, or if the file has been truncated or replaced.
+        :param output_file: the output file of the ResultWriter
+        :param output_format: the format of the output, one of COMPILED_FORMATS
+        :param full: rebuild the database from the start of the output file
+        :return: the number of results read from the output file, or None if the database couldn't be written
+        """
+        offset = 0 if full else self.resume_offset(output_file, output_format)
+        if offset == 0:
+            ips, ip_records, ip_timestamps = (np.zeros(0, dtype=np.uint32), np.zeros(0, dtype=np.uint32),
+                                              np.zeros(0, dtype=np.uint32))
+            records, strings = list(), list()
+        else:
+            ips, ip_records, ip_timestamps = self.expand()
+            strings = [value for value in self.strings]
+            records = zip(self.record_asns.tolist(), self.record_cities.tolist(), self.record_admn_lvl_2.tolist(),
+                          self.record_countries.tolist(), self.record_lats.tolist(), self.record_lngs.tolist(),
+                          self.record_rtts.tolist(), self.record_facility_cities.tolist())
+        string_ids = dict((value, index) for index, value in enumerate(strings))
+        record_ids = dict((record, index) for index, record in enumerate(records))
+
+        def intern_string(value):
+            string_id = string_ids.get(value)
+            if string_id is None:
+                string_id = string_ids[value] = len(strings)
+                strings.append(value)
+            return string_id
+
+        new_ips, new_records, new_timestamps = list(), list(), list()
+        read_results = 0
+        for offset, result in iter_output_records(output_file, output_format, offset):
+            if result is None:
+                continue
+            ip, asn, city, admn_lvl_2, country, lat, lng, min_rtt, facility_city, timestamp = result
+            record = (asn, intern_string(city), intern_string(admn_lvl_2), intern_string(country), lat, lng,
+                      float(np.float32(round(min_rtt / RTT_PRECISION_MS) * RTT_PRECISION_MS)),
+                      intern_string(facility_city))
+            record_id = record_ids.get(record)
+            if record_id is None:
+                record_id = record_ids[record] = len(records)
+                records.append(record)
+            new_ips.append(ip)
+            new_records.append(record_id)
+            new_timestamps.append(timestamp)
+            read_results += 1
+
+        # The newest result of every IP is the last one, so it is the first one of the reversed arrays
+        ips = np.concatenate([ips, np.array(new_ips, dtype=np.uint32)])[::-1]
+        ip_records = np.concatenate([ip_records, np.array(new_records, dtype=np.uint32)])[::-1]
+        ip_timestamps = np.concatenate([ip_timestamps, np.array(new_timestamps, dtype=np.uint32)])[::-1]
+        ips, first_indices = np.unique(ips, return_index=True)
+        ip_records = ip_records[first_indices]
+        ip_timestamps = ip_timestamps[first_indices]
+
+        # A range starts wherever the IPs are not consecutive or the record changes
+        breaks = np.ones(len(ips), dtype=bool)
+        breaks[1:] = (np.diff(ips.astype(np.int64)) != 1) | (ip_records[1:] != ip_records[:-1])
+        range_first = np.flatnonzero(breaks)
+        range_last = np.concatenate([range_first[1:], [len(ips)]])[:len(range_first)].astype(np.int64) - 1
+        # A timestamp run starts wherever the timestamp changes, so that every IP keeps its own timestamp and an
+        # incremental compilation equals a full one
+        timestamp_breaks = np.ones(len(ips), dtype=bool)
+        timestamp_breaks[1:] = ip_timestamps[1:] != ip_timestamps[:-1]
+        timestamp_first = np.flatnonzero(timestamp_breaks)
+        # Drop the records of the IPs whose result has been replaced
+        used_records, range_records = np.unique(ip_records[range_first], return_inverse=True)
+        records = [records[record_id] for record_id in used_records.tolist()]
+        columns = {
+            "range_starts": ips[range_first],
+            "range_ends": ips[range_last],
+            "range_records": range_records.astype(np.uint32),
+            "range_offsets": range_first.astype(np.uint32),
+            "timestamp_starts": timestamp_first.astype(np.uint32),
+            "timestamp_values": ip_timestamps[timestamp_first],
+            "strings": np.array(strings if len(strings) > 0 else [""], dtype=np.string_)
+        }
+        for index, column in enumerate(("record_asns", "record_cities", "record_admn_lvl_2", "record_countries",
+                                        "record_lats", "record_lngs", "record_rtts", "record_facility_cities")):
+            columns[column] = np.array([record[index] for record in records], dtype=getattr(self, column).dtype)
+        metadata = {
+            "version": FORMAT_VERSION,
+            "built": int(time.time()),
+            "source": os.path.abspath(output_file),
+            "format": output_format,
+            "offset": offset,
+            "head_checksum": file_head_checksum(output_file, min(offset, HEAD_BYTES)),
+            "ips": len(ips),
+            "ranges": len(range_first),
+            "records": len(records),
+            "strings": len(strings)
+        }
+        if not self.write(columns, metadata):
+            return None
+        for column, values in columns.iteritems():
+            setattr(self, column, values)
+        self.metadata = metadata
+        return read_results
+
+    def write(self, columns, metadata):
+        """
+        Writes the database next to the previous one and swaps them
+        :return: True if the database was written, False otherwise
+        """
+        temp_dir = self.database_dir.rstrip("/") + ".tmp"
+        try:
+            if os.path.isdir(temp_dir):
+                shutil.rmtree(temp_dir)
+            os.makedirs(temp_dir)
+            for column in self.COLUMNS:
+                np.save(os.path.join(temp_dir, "%s.npy" % column), columns[column])
+            with open(os.path.join(temp_dir, "metadata.json"), "w") as fout:
+                fout.write(dumps(metadata) + "\n")
+            if os.path.isdir(self.database_dir):
+                shutil.rmtree(self.database_dir)
+            os.rename(temp_dir, self.database_dir)
+        except (IOError, OSError) as e:
+            self.logger.error("Writing the results database `%s` failed with error: %s" % (self.database_dir, str(e)))
+            return False
+        return True
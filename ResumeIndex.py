@@ -0,0 +1,119 @@
+import logging
+import os
+import threading
+import numpy as np
+from ip_utils import ip_to_int, ips_to_array, sorted_contains, CompactIPSet
+
+
+class ResumeIndex(object):
+    """
+    Persistent index of the IPs that have already been geolocated in an output file. The index is kept next to the
+    output file as a sorted array of unsigned 32-bit integers (`<output>.idx`), so testing if an IP has been
+    geolocated is a binary search. The ResultWriter appends the IPs of every flushed batch to a journal
+    (`<output>.idx.journal`), which is merged into the sorted array the next time the index is loaded.
+    """
+
+    def __init__(self, output_file):
+        logging.basicConfig()
+        self.logger = logging.getLogger("ResumeIndex")
+        self.output_file = output_file
+        self.index_file = output_file.rstrip("/") + ".idx"
+        self.journal_file = self.index_file + ".journal"
+        self.sorted_ips = np.zeros(0, dtype=np.uint32)
+        # IPs added during this run, which are only in the journal
+        self.added_ips = CompactIPSet()
+        self.journal = None
+        self.lock = threading.Lock()
+
+    def load(self, read_ips=None):
+        """
+        Loads the index and merges the journal of the previous runs into it. If the output file exists but the index
+        doesn't (e.g. output written by an older version), the index is built once from the output file.
+        :param read_ips: a function that reads the IPs of the output file, used to build a missing index
+        :return: the ResumeIndex object
+        """
+        if not os.path.exists(self.output_file):
+            # Don't resume from an index whose output file has been removed
+            for index_file in (self.index_file, self.journal_file):
+                if os.path.exists(index_file):
+                    os.remove(index_file)
+            return self
+
+        if os.path.exists(self.index_file):
+            self.sorted_ips = np.fromfile(self.index_file, dtype="<u4")
+            journal_ips = np.zeros(0, dtype=np.uint32)
+            if os.path.exists(self.journal_file):
+                journal_ips = np.fromfile(self.journal_file, dtype="<u4")
+            if len(journal_ips) > 0:
+                self.sorted_ips = np.union1d(self.sorted_ips, journal_ips).astype(np.uint32)
+                self.save()
+        elif read_ips is not None:
+            self.logger.info("Building the resume index `%s` from the output file" % self.index_file)
+            self.sorted_ips = np.unique(ips_to_array(read_ips(self.output_file))).astype(np.uint32)
+            self.save()
+        return self
+
+    def save(self):
+        """
+        Writes the sorted array to the index file and truncates the journal
+        """
+        temp_file = self.index_file + ".tmp"
+        self.sorted_ips.astype("<u4").tofile(temp_file)
+        os.rename(temp_file, self.index_file)
+        with open(self.journal_file, "wb"):
+            pass
+
+    def add(self, ips):
+        """
+        Marks a batch of IPs as geolocated and appends them to the journal
+        :param ips: the IPs that have been written to the output file
+        """
+        ips = ips_to_array(ips)
+        with self.lock:
+            if self.journal is None:
+                self.journal = open(self.journal_file, "ab")
+            self.journal.write(ips.astype("<u4").tostring())
+            self.journal.flush()
+            self.added_ips.add_new(ips)
+
+    def close(self):
+        with self.lock:
+            if self.journal is not None:
+                self.journal.close()
+                self.journal = None
+
+    def exclude(self, ips):
+        """
+        Filters out the IPs that have already been geolocated
+        :param ips: an iterable of IPs
+        :return: the list of the IPs that are not in the index, in the input order
+        """
+        ips = list(ips)
+        ip_values = ips_to_array(ips)
+        found = sorted_contains(self.sorted_ips, ip_values)
+        with self.lock:
+            found |= self.added_ips.contains(ip_values)
+        return [ip for ip, is_found in zip(ips, found) if not is_found]
+
+    def filter_new(self, ip_values):
+        """
+        Filters out the IPs that have already been geolocated from an array of integer IPs
+        :param ip_values: a numpy array of integer IPs
+        :return: the numpy array of the IPs that are not in the index
+        """
+        found = sorted_contains(self.sorted_ips, ip_values)
+        with self.lock:
+            found |= self.added_ips.contains(ip_values)
+        return ip_values[~found]
+
+    def __contains__(self, ip):
+        if not isinstance(ip, (int, long, np.integer)):
+            ip = ip_to_int(ip)
+        with self.lock:
+            if ip in self.added_ips:
+                return True
+        position = np.searchsorted(self.sorted_ips, ip)
+        return position < len(self.sorted_ips) and self.sorted_ips[position] == ip
+
+    def __len__(self):
+        return len(self.sorted_ips) + len(self.added_ips)
@@ -0,0 +1,140 @@
+import random
+import threading
+import collections
+import numpy as np
+
+
+class RttSummary(collections.namedtuple("RttSummary", ["min_rtt", "median_rtt", "sent", "received"])):
+    """
+    The RTT statistics of a probe in a measurement
+    """
+    __slots__ = ()
+
+    @property
+    def loss(self):
+        """
+        :return: the fraction of the sent packets that didn't come back
+        """
+        if self.sent <= 0:
+            return 1.0 if self.received == 0 else 0.0
+        return max(0.0, 1.0 - float(self.received) / self.sent)
+
+
+class RttAggregator(object):
+    """
+    Aggregates the ping results of the in-flight measurements as they arrive from the result stream. Every
+    (measurement, probe) pair is a row of fixed-size numpy arrays with the minimum RTT, the sent and received packets
+    and a small reservoir of RTTs from which the median is estimated, so the memory doesn't grow with the number of
+    packets. The rows of a measurement are recycled once its results are collected. The aggregator can be fed by
+    several concurrent measurements, since the results are attributed by their measurement ID.
+    """
+
+    # The number of RTTs per row from which the median is estimated, exact for up to this many packets
+    RESERVOIR_SIZE = 8
+
+    def __init__(self, capacity=1024, seed=None):
+        """
+        :param capacity: the initial number of rows, which doubles when it runs out
+        :param seed: the seed of the reservoir sampling
+        """
+        self.lock = threading.Lock()
+        self.rng = random.Random(seed)
+        # Measurement ID -> dictionary that maps the probe IDs to their rows
+        self.measurements = dict()
+        self.free_rows = list()
+        self.rows_num = 0
+        self.min_rtts = np.zeros(0, dtype=np.float64)
+        self.sent = np.zeros(0, dtype=np.uint32)
+        self.received = np.zeros(0, dtype=np.uint32)
+        self.samples = np.zeros((0, self.RESERVOIR_SIZE), dtype=np.float64)
+        self.grow(max(1, int(capacity)))
+
+    def grow(self, capacity):
+        """
+        Extends the arrays to the given number of rows
+        """
+        extra_rows = capacity - len(self.min_rtts)
+        self.min_rtts = np.concatenate([self.min_rtts, np.zeros(extra_rows, dtype=np.float64)])
+        self.sent = np.concatenate([self.sent, np.zeros(extra_rows, dtype=np.uint32)])
+        self.received = np.concatenate([self.received, np.zeros(extra_rows, dtype=np.uint32)])
+        self.samples = np.concatenate([self.samples, np.zeros((extra_rows, self.RESERVOIR_SIZE), dtype=np.float64)])
+
+    def allocate_row(self):
+        if len(self.free_rows) > 0:
+            row = self.free_rows.pop()
+        else:
+            if self.rows_num == len(self.min_rtts):
+                self.grow(2 * len(self.min_rtts))
+            row = self.rows_num
+            self.rows_num += 1
+        self.min_rtts[row] = np.inf
+        self.sent[row] = 0
+        self.received[row] = 0
+        return row
+
+    def open(self, measurement_id):
+        """
+        Starts collecting the results of a measurement. The results of measurements that are not open are ignored.
+        :param measurement_id: the ID of the measurement
+        """
+        with self.lock:
+            self.measurements.setdefault(measurement_id, dict())
+
+    def add_result(self, result):
+        """
+        Adds the result of a probe to the statistics of its measurement
+        :param result: the ping result in the format of the RIPE Atlas API, with the msm_id, prb_id and result fields
+        :return: True if the result belongs to an open measurement, False otherwise
+        """
+        packets = result.get("result") or ()
+        rtts = [packet["rtt"] for packet in packets if isinstance(packet, dict) and "rtt" in packet]
+        sent = result.get("sent", len(packets))
+        with self.lock:
+            probe_rows = self.measurements.get(result.get("msm_id"))
+            if probe_rows is None:
+                return False
+            row = probe_rows.get(result["prb_id"])
+            if row is None:
+                row = probe_rows[result["prb_id"]] = self.allocate_row()
+            received = int(self.received[row])
+            for rtt in rtts:
+                if rtt < self.min_rtts[row]:
+                    self.min_rtts[row] = rtt
+                if received < self.RESERVOIR_SIZE:
+                    self.samples[row, received] = rtt
+                else:
+                    index = self.rng.randint(0, received)
+                    if index < self.RESERVOIR_SIZE:
+                        self.samples[row, index] = rtt
+                received += 1
+            self.received[row] = received
+            self.sent[row] += sent
+        return True
+
+    def collect(self, measurement_id):
+        """
+        Returns the statistics of a measurement and releases its rows
+        :param measurement_id: the ID of the measurement
+        :return: a dictionary that maps the probes that reported a result to their RttSummary. Probes that sent
+        packets without a reply have a summary with no received packets.
+        """
+        with self.lock:
+            probe_rows = self.measurements.pop(measurement_id, dict())
+            summaries = dict()
+            for probe_id, row in probe_rows.iteritems():
+                received = int(self.received[row])
+                if received > 0:
+                    median_rtt = float(np.median(self.samples[row, :min(received, self.RESERVOIR_SIZE)]))
+                    summaries[probe_id] = RttSummary(float(self.min_rtts[row]), median_rtt, int(self.sent[row]),
+                                                     received)
+                else:
+                    summaries[probe_id] = RttSummary(None, None, int(self.sent[row]), 0)
+                self.free_rows.append(row)
+        return summaries
+
+    def in_flight(self):
+        """
+        :return: the number of open measurements
+        """
+        with self.lock:
+            return len(self.measurements)
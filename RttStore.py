@@ -0,0 +1,220 @@
+import logging
+import os
+import shutil
+import math
+import threading
+import numpy as np
+
+# The measurements from which an RTT was taken
+SOURCE_PING = 0
+SOURCE_TRACEROUTE = 1
+
+# The distance that a packet covers in fiber per millisecond of RTT, i.e. half of the speed of light in fiber
+FIBER_KM_PER_RTT_MS = 100.0
+
+# The decimals of the RTTs that Atlas reports. The stores of earlier versions kept float32 RTTs, which are rounded back
+# to these decimals when they are read and when they are merged.
+RTT_DECIMALS = 3
+EARTH_RADIUS_KM = 6371.0
+
+
+def haversine_km(lat1, lng1, lat2, lng2):
+    """
+    :return: the great-circle distance between two points in km
+    """
+    lat1, lng1, lat2, lng2 = [math.radians(float(value)) for value in (lat1, lng1, lat2, lng2)]
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+def max_distance_km(rtt):
+    """
+    :param rtt: an RTT in ms
+    :return: the maximum distance between the two ends of a path with this RTT
+    """
+    return float(rtt) * FIBER_KM_PER_RTT_MS
+
+
+class RttStore(object):
+    """
+    The minimum RTT between Atlas probes and target IPs in past measurements, e.g. ingested from Atlas result
+    archives. The store is a directory of numpy arrays sorted by target IP and probe ID and loaded with mmap, with one
+    row per (target, probe) pair that keeps the lowest RTT and the time of the latest measurement. The RTTs recorded
+    during a run (e.g. the hops of harvested traceroutes) are also kept in a dictionary, so that they can be looked up
+    before the store is saved.
+    """
+
+    COLUMNS = ("targets", "probes", "rtts", "timestamps", "sources")
+    DTYPES = {
+        "targets": np.uint32,
+        "probes": np.uint32,
+        "rtts": np.float64,
+        "timestamps": np.uint32,
+        "sources": np.uint8
+    }
+
+    def __init__(self, store_dir):
+        logging.basicConfig()
+        self.logger = logging.getLogger("RttStore")
+        self.store_dir = store_dir
+        for column in self.COLUMNS:
+            setattr(self, column, np.zeros(0, dtype=self.DTYPES[column]))
+        # The rows added since the store was loaded, which are merged by `save`
+        self.pending = list()
+        # Target IP -> dictionary that maps probe IDs to the (RTT, timestamp, source) recorded during the run
+        self.recorded = dict()
+        self.lock = threading.Lock()
+
+    def load(self):
+        """
+        Memory-maps the store, which is empty if it doesn't exist yet
+        :return: the RttStore object
+        """
+        if not os.path.isdir(self.store_dir):
+            return self
+        try:
+            for column in self.COLUMNS:
+                setattr(self, column, np.load(os.path.join(self.store_dir, "%s.npy" % column), mmap_mode="r"))
+        except (IOError, ValueError) as e:
+            self.logger.error("Could not load the RTT store `%s`: %s" % (self.store_dir, str(e)))
+        return self
+
+    def __len__(self):
+        return len(self.targets)
+
+    def is_empty(self):
+        return len(self.targets) == 0 and len(self.recorded) == 0
+
+    def has_changes(self):
+        return len(self.pending) > 0 or len(self.recorded) > 0
+
+    def pending_rows(self):
+        """
+        :return: the number of rows added since the store was loaded or saved
+        """
+        return sum(len(batch["targets"]) for batch in self.pending)
+
+    def add(self, targets, probes, rtts, timestamps, source=SOURCE_PING):
+        """
+        Adds a batch of RTTs, which is merged into the store by `save`
+        :param targets: the integer target IPs
+        :param probes: the probe IDs
+        :param rtts: the RTTs in ms
+        :param timestamps: the UNIX timestamps of the measurements
+        :param source: one of SOURCE_PING and SOURCE_TRACEROUTE, or an array with the source of every RTT
+        """
+        if len(targets) == 0:
+            return
+        self.pending.append({
+            "targets": np.asarray(targets, dtype=np.uint32),
+            "probes": np.asarray(probes, dtype=np.uint32),
+            "rtts": np.asarray(rtts, dtype=np.float64),
+            "timestamps": np.asarray(timestamps, dtype=np.uint32),
+            "sources": np.broadcast_to(np.asarray(source, dtype=np.uint8), (len(targets),)).copy()
+        })
+
+    def record(self, target_int, probe_id, rtt, timestamp, source=SOURCE_PING):
+        """
+        Records an RTT measured during the run, which `lookup` returns right away
+        :param target_int: the integer target IP
+        :param probe_id: the probe ID
+        :param rtt: the RTT in ms
+        :param timestamp: the UNIX timestamp of the measurement
+        :param source: one of SOURCE_PING and SOURCE_TRACEROUTE
+        """
+        with self.lock:
+            probe_rtts = self.recorded.setdefault(target_int, dict())
+            if probe_id not in probe_rtts or rtt < probe_rtts[probe_id][0]:
+                probe_rtts[probe_id] = (rtt, timestamp, source)
+
+    def export_recorded(self):
+        """
+        :return: the list of (target, probe ID, RTT, timestamp, source) tuples recorded during the run, which can be
+        sent to another process
+        """
+        with self.lock:
+            return [(target_int, probe_id) + values for target_int, probe_rtts in self.recorded.iteritems()
+                    for probe_id, values in probe_rtts.iteritems()]
+
+    def merge_recorded(self, recorded_rtts):
+        """
+        Records the RTTs exported by another process
+        :param recorded_rtts: the list returned by export_recorded in the other process
+        """
+        for recorded_rtt in recorded_rtts:
+            self.record(*recorded_rtt)
+
+    def merge(self):
+        """
+        Merges the pending rows with the rows of the store
+        :return: a dictionary with the merged columns
+        """
+        recorded_rtts = self.export_recorded()
+        batches = list(self.pending)
+        if len(recorded_rtts) > 0:
+            recorded_columns = zip(*recorded_rtts)
+            batches.append(dict((column, np.array(values, dtype=self.DTYPES[column]))
+                                for column, values in zip(self.COLUMNS, recorded_columns)))
+        columns = dict()
+        for column in self.COLUMNS:
+            columns[column] = np.concatenate([np.asarray(getattr(self, column))] +
+                                             [batch[column] for batch in batches]).astype(self.DTYPES[column])
+        columns["rtts"] = np.round(columns["rtts"], RTT_DECIMALS)
+        # Sort by target, probe and RTT, and keep the lowest RTT of every (target, probe) pair
+        order = np.lexsort((columns["rtts"], columns["probes"], columns["targets"]))
+        for column in self.COLUMNS:
+            columns[column] = columns[column][order]
+        first = np.ones(len(order), dtype=bool)
+        if len(order) > 1:
+            first[1:] = (columns["targets"][1:] != columns["targets"][:-1]) | \
+                        (columns["probes"][1:] != columns["probes"][:-1])
+        # The latest measurement of every pair
+        pair_ids = np.cumsum(first) - 1
+        latest = np.zeros(int(first.sum()), dtype=np.uint32)
+        np.maximum.at(latest, pair_ids, columns["timestamps"])
+        for column in self.COLUMNS:
+            columns[column] = columns[column][first]
+        columns["timestamps"] = latest
+        return columns
+
+    def save(self):
+        """
+        Merges the pending rows into the store and writes it, next to the old store which is then replaced
+        :return: True if the store was written, False otherwise
+        """
+        columns = self.merge()
+        temp_dir = self.store_dir.rstrip("/") + ".tmp"
+        try:
+            if os.path.isdir(temp_dir):
+                shutil.rmtree(temp_dir)
+            os.makedirs(temp_dir)
+            for column in self.COLUMNS:
+                np.save(os.path.join(temp_dir, "%s.npy" % column), columns[column])
+            if os.path.isdir(self.store_dir):
+                shutil.rmtree(self.store_dir)
+            os.rename(temp_dir, self.store_dir)
+        except (IOError, OSError) as e:
+            self.logger.error("Writing the RTT store `%s` failed with error: %s" % (self.store_dir, str(e)))
+            return False
+        self.pending = list()
+        with self.lock:
+            self.recorded = dict()
+        self.load()
+        return True
+
+    def lookup(self, target_int, min_timestamp=0):
+        """
+        :param target_int: the integer target IP
+        :param min_timestamp: the UNIX timestamp before which the measurements are ignored
+        :return: a list of (probe ID, minimum RTT) tuples of the target, sorted by RTT
+        """
+        start = np.searchsorted(self.targets, target_int, side="left")
+        end = np.searchsorted(self.targets, target_int, side="right")
+        probe_rtts = dict((int(probe_id), round(float(rtt), RTT_DECIMALS)) for probe_id, rtt, timestamp in
+                          zip(self.probes[start:end], self.rtts[start:end], self.timestamps[start:end])
+                          if timestamp >= min_timestamp)
+        with self.lock:
+            for probe_id, (rtt, timestamp, _) in self.recorded.get(target_int, dict()).iteritems():
+                if timestamp >= min_timestamp and rtt < probe_rtts.get(probe_id, rtt + 1):
+                    probe_rtts[probe_id] = rtt
+        return sorted(probe_rtts.iteritems(), key=lambda row: row[1])
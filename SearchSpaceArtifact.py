@@ -0,0 +1,199 @@
+import os
+import time
+import shutil
+import logging
+import itertools
+import numpy as np
+from ujson import dumps, loads
+
+# The version of the artifact layout, artifacts of another version are ignored until they are rebuilt
+FORMAT_VERSION = 1
+
+# The probe search radius of the artifacts built before the radius was recorded in the metadata
+DEFAULT_SEARCH_RADIUS_KM = 40.0
+
+
+class ArtifactProbe(object):
+    """
+    An Atlas probe read from the artifact, with the attributes of Atlas.Probe
+    """
+    def __init__(self, id, asn, lat, lng, country):
+        self.id = id
+        self.asn = asn
+        self.lat = lat
+        self.lng = lng
+        self.country = country
+
+
+class SearchSpaceArtifact(object):
+    """
+    The precomputed Steps 2 and 3 of every ASN in PeeringDB: its candidate locations, geocoded, and the Atlas probes
+    around each location and in the ASN itself. The artifact is a directory of numpy arrays loaded with mmap. The
+    ASNs are sorted, and each ASN points to a slice of its location indices and a slice of its probe IDs, so looking
+    up the search space of an ASN is a binary search and a few slices.
+    """
+
+    COLUMNS = ("asns", "asn_location_offsets", "asn_locations", "asn_probe_offsets", "asn_probes",
+               "location_names", "location_lats", "location_lngs", "location_probe_offsets", "location_probes",
+               "probe_ids", "probe_asns", "probe_lats", "probe_lngs", "probe_countries")
+
+    def __init__(self, artifact_dir, max_age_hours=168, search_radius_km=DEFAULT_SEARCH_RADIUS_KM):
+        """
+        :param artifact_dir: the directory of the artifact
+        :param max_age_hours: the age after which the artifact is not used, 0 to always use it
+        :param search_radius_km: the radius around the locations in which the probes are searched. Artifacts built
+        with another radius are not used.
+        """
+        logging.basicConfig()
+        self.logger = logging.getLogger("SearchSpaceArtifact")
+        self.artifact_dir = artifact_dir
+        self.max_age_seconds = float(max_age_hours) * 3600
+        self.search_radius_km = float(search_radius_km)
+        self.metadata = dict()
+        self.asns = np.zeros(0, dtype=np.uint32)
+
+    def read_metadata(self):
+        """
+        :return: the metadata dictionary of the artifact, or None if it doesn't exist or can't be read
+        """
+        try:
+            with open(os.path.join(self.artifact_dir, "metadata.json")) as fin:
+                return loads(fin.read())
+        except (IOError, ValueError):
+            return None
+
+    def load(self):
+        """
+        Memory-maps the artifact if it exists, has the current format version and search radius, and is not stale
+        :return: the SearchSpaceArtifact object, or None if the artifact can't be used
+        """
+        metadata = self.read_metadata()
+        if metadata is None:
+            return None
+        if metadata.get("version") != FORMAT_VERSION:
+            self.logger.warning("Ignoring the search space artifact `%s` of version %s, rebuild it with "
+                                "build-search-spaces.py" % (self.artifact_dir, metadata.get("version")))
+            return None
+        if self.max_age_seconds > 0 and time.time() - metadata.get("built", 0) > self.max_age_seconds:
+            self.logger.warning("Ignoring the search space artifact `%s` because it is older than %s hours" %
+                                (self.artifact_dir, self.max_age_seconds / 3600))
+            return None
+        search_radius_km = float(metadata.get("search_radius_km", DEFAULT_SEARCH_RADIUS_KM))
+        if search_radius_km != self.search_radius_km:
+            self.logger.warning("Ignoring the search space artifact `%s` because its probes were searched within %s km "
+                                "instead of %s km" % (self.artifact_dir, search_radius_km, self.search_radius_km))
+            return None
+        try:
+            for column in self.COLUMNS:
+                setattr(self, column, np.load(os.path.join(self.artifact_dir, "%s.npy" % column), mmap_mode="r"))
+        except (IOError, ValueError) as e:
+            self.logger.error("Could not load the search space artifact `%s`: %s" % (self.artifact_dir, str(e)))
+            return None
+        self.metadata = metadata
+        return self
+
+    def write(self, asn_locations, locations, asn_probes, probe_objects):
+        """
+        Writes the artifact next to the previous one and swaps them
+        :param asn_locations: a dictionary that maps ASNs to the list of their geocoded locations
+        :param locations: a dictionary that maps the geocoded locations to (lat, lng, list of probe IDs) tuples
+        :param asn_probes: a dictionary that maps ASNs to the list of the IDs of their probes
+        :param probe_objects: a dictionary that maps probe IDs to Atlas.Probe objects
+        :return: True if the artifact was written, False otherwise
+        """
+        location_names = sorted(locations)
+        location_indices = dict((location, index) for index, location in enumerate(location_names))
+        asns = sorted(set(asn_locations) | set(asn_probes))
+        probe_ids = sorted(probe_objects)
+
+        def offsets(lists):
+            return np.concatenate([[0], np.cumsum([len(values) for values in lists])]).astype(np.uint32)
+
+        def flatten(lists):
+            return np.fromiter(itertools.chain.from_iterable(lists), dtype=np.uint32)
+
+        asn_location_lists = [sorted(location_indices[location] for location in asn_locations.get(asn, ()))
+                              for asn in asns]
+        asn_probe_lists = [sorted(asn_probes.get(asn, ())) for asn in asns]
+        location_probe_lists = [sorted(locations[location][2]) for location in location_names]
+        columns = {
+            "asns": np.array(asns, dtype=np.uint32),
+            "asn_location_offsets": offsets(asn_location_lists),
+            "asn_locations": flatten(asn_location_lists),
+            "asn_probe_offsets": offsets(asn_probe_lists),
+            "asn_probes": flatten(asn_probe_lists),
+            "location_names": np.array([location.encode("utf-8") if isinstance(location, unicode) else location
+                                        for location in location_names], dtype=np.string_),
+            "location_lats": np.array([locations[location][0] for location in location_names], dtype=np.float64),
+            "location_lngs": np.array([locations[location][1] for location in location_names], dtype=np.float64),
+            "location_probe_offsets": offsets(location_probe_lists),
+            "location_probes": flatten(location_probe_lists),
+            "probe_ids": np.array(probe_ids, dtype=np.uint32),
+            "probe_asns": np.array([probe_objects[probe_id].asn for probe_id in probe_ids], dtype=np.uint32),
+            "probe_lats": np.array([probe_objects[probe_id].lat for probe_id in probe_ids], dtype=np.float64),
+            "probe_lngs": np.array([probe_objects[probe_id].lng for probe_id in probe_ids], dtype=np.float64),
+            "probe_countries": np.array([str(probe_objects[probe_id].country or "") for probe_id in probe_ids],
+                                        dtype="S2")
+        }
+        metadata = {
+            "version": FORMAT_VERSION,
+            "built": int(time.time()),
+            "search_radius_km": self.search_radius_km,
+            "asns": len(asns),
+            "locations": len(location_names),
+            "probes": len(probe_ids)
+        }
+        temp_dir = self.artifact_dir.rstrip("/") + ".tmp"
+        try:
+            if os.path.isdir(temp_dir):
+                shutil.rmtree(temp_dir)
+            os.makedirs(temp_dir)
+            for column in self.COLUMNS:
+                np.save(os.path.join(temp_dir, "%s.npy" % column), columns[column])
+            with open(os.path.join(temp_dir, "metadata.json"), "w") as fout:
+                fout.write(dumps(metadata) + "\n")
+            if os.path.isdir(self.artifact_dir):
+                shutil.rmtree(self.artifact_dir)
+            os.rename(temp_dir, self.artifact_dir)
+        except (IOError, OSError) as e:
+            self.logger.error("Writing the search space artifact `%s` failed with error: %s" %
+                              (self.artifact_dir, str(e)))
+            return False
+        return True
+
+    def get_probe(self, probe_id):
+        """
+        :param probe_id: the probe ID
+        :return: an ArtifactProbe object, or None if the probe is not in the artifact
+        """
+        position = np.searchsorted(self.probe_ids, probe_id)
+        if position == len(self.probe_ids) or self.probe_ids[position] != probe_id:
+            return None
+        return ArtifactProbe(int(probe_id), int(self.probe_asns[position]), float(self.probe_lats[position]),
+                             float(self.probe_lngs[position]), self.probe_countries[position])
+
+    def lookup(self, asn):
+        """
+        Returns the search space of an ASN
+        :param asn: the ASN
+        :return: a tuple with the list of (location ID, lat, lng, list of probe IDs) tuples of the ASN's locations and
+        the list of the IDs of the probes in the ASN, or None if the ASN is not in the artifact
+        """
+        position = np.searchsorted(self.asns, asn)
+        if position == len(self.asns) or self.asns[position] != asn:
+            return None
+        locations = list()
+        for location_index in self.asn_locations[self.asn_location_offsets[position]:
+                                                 self.asn_location_offsets[position + 1]]:
+            locations.append((
+                str(self.location_names[location_index]),
+                float(self.location_lats[location_index]),
+                float(self.location_lngs[location_index]),
+                self.location_probes[self.location_probe_offsets[location_index]:
+                                     self.location_probe_offsets[location_index + 1]].tolist()
+            ))
+        asn_probes = self.asn_probes[self.asn_probe_offsets[position]:self.asn_probe_offsets[position + 1]].tolist()
+        return locations, asn_probes
+
+    def __len__(self):
+        return len(self.asns)
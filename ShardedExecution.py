@@ -0,0 +1,298 @@
+import os
+import sys
+import Queue
+import random
+import logging
+import threading
+import multiprocessing
+from time import time, sleep
+from PipelineStages import PipelineStage, StagedPipeline
+from Metrics import METRICS
+
+logging.basicConfig()
+logger = logging.getLogger("Sharding")
+logger.setLevel(logging.INFO)
+
+
+def estimate_ping_credits(packets_num, probes_num):
+    """
+    Estimates the RIPE Atlas credits of a one-off ping measurement
+    :param packets_num: the number of packets per probe
+    :param probes_num: the number of probes
+    :return: the number of credits
+    """
+    return int(packets_num) * int(probes_num)
+
+
+def estimate_traceroute_credits(probes_num):
+    """
+    Estimates the RIPE Atlas credits of a one-off ICMP traceroute with the default 3 packets per hop
+    :param probes_num: the number of probes
+    :return: the number of credits, an upper bound since the actual cost depends on the length of the path
+    """
+    return 30 * int(probes_num)
+
+
+class AtlasBudget(object):
+    """
+    The rate of Atlas measurements and the credits that a run may spend. The state lives in shared memory, so the
+    budget is enforced globally across the worker processes of a sharded run.
+    """
+
+    def __init__(self, measurements_per_minute=0, max_credits=0):
+        """
+        :param measurements_per_minute: the maximum rate at which measurements are created, 0 for no limit
+        :param max_credits: the maximum number of credits spent by the run, 0 for no limit
+        """
+        measurements_per_minute = float(measurements_per_minute)
+        self.interval = 60.0 / measurements_per_minute if measurements_per_minute > 0 else 0.0
+        self.max_credits = int(max_credits)
+        self.lock = multiprocessing.Lock()
+        self.next_start = multiprocessing.Value("d", 0.0, lock=False)
+        self.used_credits = multiprocessing.Value("l", 0, lock=False)
+        self.measurements = multiprocessing.Value("l", 0, lock=False)
+
+    def acquire(self, credits):
+        """
+        Reserves the credits of a measurement and waits until the measurement rate allows to create it
+        :param credits: the estimated credits of the measurement
+        :return: True if the measurement can be created, False if it would exceed the credit budget
+        """
+        with self.lock:
+            if self.max_credits > 0 and self.used_credits.value + credits > self.max_credits:
+                return False
+            self.used_credits.value += credits
+            self.measurements.value += 1
+            now = time()
+            start = max(now, self.next_start.value)
+            self.next_start.value = start + self.interval
+        if start > now:
+            sleep(start - now)
+        return True
+
+    def remaining_credits(self):
+        """
+        :return: the credits left in the budget, or None if there is no credit limit
+        """
+        if self.max_credits <= 0:
+            return None
+        with self.lock:
+            return max(0, self.max_credits - self.used_credits.value)
+
+    def status(self):
+        with self.lock:
+            return {
+                "measurements": self.measurements.value,
+                "credits": self.used_credits.value,
+                "max_credits": self.max_credits
+            }
+
+
+class QueueResultWriter(object):
+    """
+    Takes the place of the ResultWriter in the worker processes and sends the results to the process that owns the
+    output
+    """
+
+    def __init__(self, result_queue):
+        self.result_queue = result_queue
+
+    def write(self, record):
+        self.result_queue.put(("result", record))
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def journaled_files(pipeline):
+    """
+    :return: the (object, attribute) pairs of the files that the geocoding appends to, which every worker appends to
+    its own journal instead
+    """
+    return [(pipeline.geo_encoder, "coordinates_file"), (pipeline.geo_encoder, "probes_locations_file"),
+            (pipeline.geo_encoder, "failed_locations_file"), (pipeline.location_index, "index_file")]
+
+
+def journal_file(path, shard):
+    return "%s.shard-%s" % (path, shard)
+
+
+def merge_journals(pipeline, workers_num):
+    """
+    Appends the journals of the workers to the geocoding files of the parent process, and adds the new aliases of
+    the location index through the LocationIndex of the parent, so that the locations that several workers added are
+    merged
+    """
+    for owner, attribute in journaled_files(pipeline):
+        path = getattr(owner, attribute)
+        if path is None:
+            continue
+        for shard in xrange(workers_num):
+            shard_journal = journal_file(path, shard)
+            if not os.path.exists(shard_journal):
+                continue
+            try:
+                if owner is pipeline.location_index:
+                    owner.merge(shard_journal)
+                else:
+                    with open(shard_journal) as fin, open(path, "a+") as fout:
+                        fout.write(fin.read())
+                os.remove(shard_journal)
+            except (IOError, OSError) as e:
+                logger.error("Merging the journal `%s` failed with error: %s" % (shard_journal, str(e)))
+
+
+def iter_shard_tasks(pipeline, task_queue):
+    """
+    Reads the ASN groups that the parent process assigns to a worker
+    :return: a generator of (ASN, list of target IPs, set of hinted locations) tuples
+    """
+    while True:
+        task = task_queue.get()
+        if task is None:
+            break
+        target_asn, target_asn_ips, target_locations, original_asns = task
+        pipeline.original_asns.update(original_asns)
+        yield target_asn, target_asn_ips, target_locations
+
+
+def run_shard(pipeline, shard, task_queue, result_queue):
+    """
+    The main function of a worker process, which locates and measures the ASNs that it receives
+    :param pipeline: the GeolocationPipeline inherited from the parent process
+    :param shard: the index of the worker
+    :param task_queue: the queue with the ASN groups of the targets
+    :param result_queue: the queue where the results are sent
+    """
+    pipeline.resources["result_writer"] = QueueResultWriter(result_queue)
+    # The workers don't append to the same geocoding files, the parent merges their journals
+    for owner, attribute in journaled_files(pipeline):
+        if getattr(owner, attribute) is not None:
+            setattr(owner, attribute, journal_file(getattr(owner, attribute), shard))
+    # The metrics inherited from the parent process are already counted there
+    METRICS.after_fork()
+    METRICS.reset()
+    # The forked workers would otherwise sample the same probes. Seeded runs sample with per-ASN generators.
+    random.seed()
+    pipeline.rng.seed()
+    try:
+        queue_size = pipeline.config["Pipeline"]["queue_size"]
+        StagedPipeline([
+            PipelineStage("locate-%s" % shard, pipeline.locate_stage, queue_size),
+            PipelineStage("measure-%s" % shard, pipeline.measure_stage, queue_size)
+        ], pipeline.config["Pipeline"]["report_seconds"]).run(iter_shard_tasks(pipeline, task_queue))
+    except BaseException as e:
+        # SystemExit is caught too, since the Atlas client exits on measurement errors
+        result_queue.put(("error", shard, "%s: %s" % (type(e).__name__, str(e))))
+    else:
+        METRICS.write_profiles(pipeline.config["Metrics"]["profile_dir"])
+        result_queue.put(("metrics", shard, METRICS.export_state()))
+        result_queue.put(("probe_health", shard, pipeline.probe_health.export_updates()))
+        result_queue.put(("rtt_store", shard, pipeline.rtt_store.export_recorded()))
+        result_queue.put(("done", shard, None))
+
+
+def collect_results(pipeline, result_queue, workers, errors):
+    """
+    Writes the results of the workers to the output until every worker has finished
+    """
+    running = len(workers)
+    while running > 0:
+        try:
+            message = result_queue.get(timeout=1)
+        except Queue.Empty:
+            # Workers that were killed never report that they are done
+            if not any(worker.is_alive() for worker in workers):
+                errors.append((None, "the workers exited unexpectedly"))
+                break
+            continue
+        if message[0] == "result":
+            pipeline.result_writer.write(message[1])
+        elif message[0] == "metrics":
+            METRICS.merge(message[2])
+        elif message[0] == "probe_health":
+            pipeline.probe_health.merge(message[2])
+        elif message[0] == "rtt_store":
+            pipeline.rtt_store.merge_recorded(message[2])
+        else:
+            running -= 1
+            if message[0] == "error":
+                errors.append(message[1:])
+
+
+def run_sharded(pipeline, workers_num):
+    """
+    Geolocates the targets of a pipeline with a pool of worker processes, which receive whole ASNs so that every
+    ASN is located only once. The resources that are read-only during the measurements (the pyasn database, the IXP
+    LAN table, the AS relationships, the location index, the geocoding caches, the probe health, the RTT store, the
+    search space artifact and the probe inventory) are loaded before forking and are shared with the workers. The
+    targets are read and grouped in the parent process, which also writes the output and merges the probe health
+    updates, the harvested RTTs and the geocoding journals of the workers.
+    :param pipeline: the GeolocationPipeline
+    :param workers_num: the number of worker processes
+    """
+    start = time()
+    for resource in ("asndb", "as_relationships", "extra_locations", "location_index", "cached_location_coordinates",
+                     "cached_probes_locations", "failed_locations", "probe_health", "rtt_store",
+                     "search_space_artifact"):
+        getattr(pipeline, resource)
+    pipeline.inventory_min_asns = 0
+    pipeline.collect_probe_inventory()
+    # The journals of a previous run that stopped before merging them
+    merge_journals(pipeline, workers_num)
+    logger.info("Loaded the shared resources in %.1f sec" % (time() - start))
+
+    task_queue = multiprocessing.Queue(2 * workers_num)
+    result_queue = multiprocessing.Queue()
+    workers = list()
+    # The workers are forked while this thread holds the locks of the metrics and of the output, so that the
+    # snapshot and flush threads are not halfway through them when the process is copied
+    with METRICS.lock, pipeline.result_writer.lock:
+        for shard in xrange(workers_num):
+            worker = multiprocessing.Process(target=run_shard, args=(pipeline, shard, task_queue, result_queue),
+                                             name="shard-%s" % shard)
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+
+    errors = list()
+    collector = threading.Thread(target=collect_results, args=(pipeline, result_queue, workers, errors))
+    collector.daemon = True
+    collector.start()
+
+    def put_task(task):
+        while len(errors) == 0:
+            try:
+                task_queue.put(task, timeout=1)
+                return
+            except Queue.Full:
+                continue
+
+    for target_asn, target_asn_ips, target_locations in pipeline.iter_geolocation_targets():
+        if len(errors) > 0:
+            break
+        # The original ASNs move to the worker that geolocates the targets
+        original_asns = dict((target_ip, pipeline.original_asns.pop(target_ip)) for target_ip in target_asn_ips
+                             if target_ip in pipeline.original_asns)
+        put_task((target_asn, target_asn_ips, target_locations, original_asns))
+    for _ in xrange(workers_num):
+        put_task(None)
+    while collector.is_alive() and len(errors) == 0:
+        collector.join(1)
+    if len(errors) > 0:
+        for worker in workers:
+            worker.terminate()
+    for worker in workers:
+        worker.join()
+    merge_journals(pipeline, workers_num)
+
+    status = pipeline.atlas_budget.status()
+    logger.info("The %s workers used %s credits in %s measurements" %
+                (workers_num, status["credits"], status["measurements"]))
+    if len(errors) > 0:
+        for shard, message in errors:
+            logger.critical("Worker %s failed: %s" % (shard, message))
+        sys.exit(-1)
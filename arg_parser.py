@@ -4,7 +4,31 @@ import socket
 import sys
 import os.path
 import bz2
-import pyasn
+import ConfigParser
+from ResultWriter import OUTPUT_FORMATS
+from ResumeIndex import ResumeIndex
+import target_reader
+from AsnMapper import AsnMapper
+
+
+def read_config(config_file="config/config.ini"):
+    """
+    Reads the configuration parameters and maps each section and option in the configuration file to a dictionary
+    :param config_file: the path to the configuration file
+    :return: the dictionary including all the configuration parameters
+    """
+    config = dict()
+    config_parser = ConfigParser.ConfigParser()
+    config_parser.read(config_file)
+    for section in config_parser.sections():
+        options = config_parser.options(section)
+        config[section] = dict()
+        for option in options:
+            try:
+                config[section][option] = config_parser.get(section, option)
+            except:
+                config[section][option] = None
+    return config
 
 
 def read_presence_data(presence_file):
@@ -56,40 +80,25 @@ def is_valid_ipv4_address(address):
 
 def read_geolocation_targets(target_ip, target_file):
     """
-    Reads and validates the input given as target for the geolocation (either a single IP or a file with IPs)
+    Validates the input given as target for the geolocation (either a single IP or prefix, or a file with IPs and
+    prefixes), which is read lazily while the geolocation runs
     :param target_ip: the value of the -i/--ip user argument
-    :param target_file: the value of the -f/--file user argument
-    :return: a list of valid IP addresses
+    :param target_file: the value of the -f/--file user argument, `-` reads the targets from the standard input
+    :return: a generator of the (first, last) integer address ranges of the valid targets
     """
     global logger
-    target_addresses = set()
     # Check that the user input is correct
     if target_ip is not None:
-        if is_valid_ipv4_address(target_ip):
-            target_addresses.add(target_ip)
-        else:
-            logger.critical("The provided -i/--ip argument `%s` is not a valid IPv4 address." % target_ip)
-    elif target_file is not None:
-        # First check that the file exists and then check if the address in the file are valid IPv4 addresses
+        if target_reader.parse_target(target_ip.strip()) is None:
+            logger.critical("The provided -i/--ip argument `%s` is not a valid IPv4 address or prefix." % target_ip)
+            sys.exit(-1)
+    elif target_file is not None and target_file != "-":
+        # Check that the file exists, the addresses in the file are validated while reading it
         if not os.path.isfile(target_file):
             logger.critical("The file `%s` provided by the -f/--file argument does not exist." % target_file)
-        else:
-            try:
-                with open(target_file) as fin:
-                    line_counter = 0
-                    for line in fin:
-                        line_counter += 1
-                        ip = line.strip()
-                        if len(ip) > 0 and is_valid_ipv4_address(ip):
-                            target_addresses.add(ip)
-                        elif len(ip) > 0:
-                            logger.warning("Skipping line %s in the `%s` file because "
-                                           "it is not a valid IPv4 address." % (line_counter, target_file))
-            except IOError, e:
-                logger.critical("Failed to read the file `%s` provided by the -f/--file argument. Error: %s" %
-                                target_file, str(e))
+            sys.exit(-1)
 
-    return target_addresses
+    return target_reader.iter_target_ranges(target_ip, target_file)
 
 
 def read_as_relationships(relationships_file):
@@ -130,13 +139,13 @@ def read_as_relationships(relationships_file):
     return as_relationships
 
 
-def validate_output_file(output_file):
+def validate_output_file(output_file, output_format="tsv"):
     """
-    Checks if the output file is writable, and if it exists reads IPs already geolocated in it
-    :param output_file:
-    :return:
+    Checks if the output file is writable, and if it exists loads the index of the IPs already geolocated in it
+    :param output_file: the value of the -o/--output argument
+    :param output_format: the format of the output file (one of ResultWriter.OUTPUT_FORMATS)
+    :return: the ResumeIndex of the IPs already geolocated in the output file
     """
-    already_geolocated = set()
     dirname = os.path.dirname(output_file)
     if dirname == "":
         output_file = "./" + output_file
@@ -145,25 +154,33 @@ def validate_output_file(output_file):
         logging.critical("The programe does not have write permissions to the output file location `%s` "
                          "provided by the -o/--output argument. " % output_file)
         sys.exit(-1)
-    elif os.path.isfile(output_file):
-        try:
-            with open(output_file) as fin:
-                for line in fin:
-                    if not line.startswith("#"):
-                        lf = line.strip().split("\t")
-                        if len(lf) > 0:
-                            already_geolocated.add(lf[0])
-        except IOError:
-            pass
 
-    return already_geolocated
+    resume_index = ResumeIndex(output_file)
+    try:
+        resume_index.load(OUTPUT_FORMATS[output_format].read_ips)
+    except (IOError, OSError, ValueError) as e:
+        logger.error("Could not load the index of the already geolocated IPs in `%s`: %s" % (output_file, str(e)))
+    return resume_index
 
-def read_user_arguments():
+def read_asn_database(ipasn_file):
     """
-    Reads and validates the command-line arguments provided by the user
-    :return: the parsed values of the command-line arguments
+    Reads the pyasn database provided by the user
+    :param ipasn_file: the value of the -a/--ipasn argument
+    :return: an AsnMapper object
+    """
+    try:
+        return AsnMapper.from_ipasn_file(ipasn_file)
+    except (IOError, OSError):
+        logging.critical("Could not read the pyasn file `%s` provided by the -a/--ipasn argument. "
+                         "Please enter the correct file location." % ipasn_file)
+        sys.exit(-1)
+
+
+def build_argument_parser():
+    """
+    Builds the parser of the command-line arguments
+    :return: an argparse.ArgumentParser object
     """
-    global logger
     # Initialize the argument parser
     description = 'Geo-locates border IP addresses based on latency measurements from RIPE Atlas'
     parser = argparse.ArgumentParser(description=description)
@@ -171,11 +188,17 @@ def read_user_arguments():
     group = parser.add_mutually_exclusive_group(required=True)
     group.add_argument('-i', '--ip',
                         type=str,
-                        help="A single IP address to geo-locate")
+                        help="A single IP address or prefix to geo-locate")
 
     group.add_argument('-f', '--file',
                         type=str,
-                        help="The path to a file with IP address to geo-locate (one address per line)")
+                        help="The path to a file with IP addresses or prefixes to geo-locate (one per line), "
+                             "or - to read them from the standard input")
+
+    group.add_argument('-s', '--serve',
+                        type=str,
+                        help="Run as a service that accepts geolocation jobs over HTTP on the given local address "
+                             "(host:port, or unix:<path> for a Unix socket)")
 
     parser.add_argument('-a', '--ipasn',
                         type=str,
@@ -200,34 +223,42 @@ def read_user_arguments():
                         required=True,
                         help="The path to the file where the geolocation output will be written")
 
-    args = parser.parse_args()
+    parser.add_argument('-w', '--workers',
+                        type=int,
+                        default=1,
+                        help="The number of worker processes across which the target ASNs are sharded")
 
-    # Read and validate the provided IP geolocation targets
-    target_addresses = read_geolocation_targets(args.ip, args.file)
-    if len(target_addresses) == 0:
-        logger.critical("Program exits because no valid IP address was provided as geo-location target.")
-        sys.exit(-1)
+    parser.add_argument('--plan',
+                        type=str,
+                        help="Dry run: select the probes of every target without measuring, and write the "
+                             "measurement plan with the estimated Atlas credits to the given file")
+    return parser
 
-    as_relationships = read_as_relationships(args.relations)
-    if len(as_relationships) == 0:
-        logger.error("The provided AS relationships file is invalid. "
-                     "The feature of probe selection based on AS relationships will be deactivated which may lead "
-                     "to lower geo-location accuracy.")
 
-    # Read the provided pyasn file
-    try:
-        asndb = pyasn.pyasn(args.ipasn)
-    except IOError:
+def parse_arguments(argv=None):
+    """
+    Reads the command-line arguments provided by the user and validates the ones that are cheap to check. The files
+    they point to are read by the GeolocationPipeline when they are first needed.
+    :param argv: the list of arguments to parse (defaults to sys.argv)
+    :return: the argparse.Namespace with the parsed values of the command-line arguments
+    """
+    args = build_argument_parser().parse_args(argv)
+
+    # Validate the provided IP geolocation targets, they are read lazily while the geolocation runs
+    read_geolocation_targets(args.ip, args.file)
+
+    if not os.path.isfile(args.ipasn):
         logging.critical("Could not read the pyasn file `%s` provided by the -a/--ipasn argument. "
                          "Please enter the correct file location." % args.ipasn)
         sys.exit(-1)
 
-    # Read the provided presence AS data
-    presence_data = dict()
-    if args.presence is not None:
-        presence_data = read_presence_data(args.presence)
-
-    already_geolocated_ips = validate_output_file(args.output)
+    output_dir = os.path.dirname(args.output)
+    if output_dir == "":
+        output_dir = "."
+    if not os.access(output_dir, os.W_OK):
+        logging.critical("The programe does not have write permissions to the output file location `%s` "
+                         "provided by the -o/--output argument. " % args.output)
+        sys.exit(-1)
     '''
     # Linux permits pretty much any character in the file name so the filename check bellow may be unnecessary.
     # So, I will leave it commented-out unless we experience probles related with filenaming conventions in
@@ -243,7 +274,7 @@ def read_user_arguments():
             sys.exit(-1)
     '''
 
-    return target_addresses, asndb, as_relationships, presence_data, already_geolocated_ips, args.output
+    return args
 
 logging.basicConfig()
 logger = logging.getLogger("ArgParser")
\ No newline at end of file
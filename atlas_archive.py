@@ -0,0 +1,225 @@
+import logging
+import socket
+import numpy as np
+import ujson
+from ip_utils import ip_to_int
+from target_reader import open_targets_file
+from RttStore import SOURCE_PING, SOURCE_TRACEROUTE
+
+logging.basicConfig()
+logger = logging.getLogger("AtlasArchive")
+
+
+def iter_archive_results(archive_file):
+    """
+    Streams the results of an Atlas result dump, e.g. a daily dump of the public built-in measurements, without
+    loading it whole. The dump can be compressed with gzip or bzip2, and every line is a result or a list of results.
+    :param archive_file: the path to the dump, or `-` to read it from the standard input
+    :return: a generator of result dictionaries
+    """
+    fin = open_targets_file(archive_file)
+    try:
+        for line_counter, line in enumerate(fin, 1):
+            line = line.strip()
+            if len(line) == 0 or line[0] not in "[{":
+                continue
+            try:
+                results = ujson.loads(line)
+            except ValueError:
+                logger.warning("Skipping line %s of the archive `%s` because it is not valid JSON." %
+                               (line_counter, archive_file))
+                continue
+            if isinstance(results, dict):
+                yield results
+            else:
+                for result in results:
+                    if isinstance(result, dict):
+                        yield result
+    finally:
+        if archive_file != "-":
+            fin.close()
+
+
+def ping_min_rtt(result):
+    """
+    :param result: an Atlas ping result, in the same format as the results of Atlas.parse_results
+    :return: the minimum RTT of the result, or None if no packet came back
+    """
+    if result.get("min", -1) > 0:
+        return float(result["min"])
+    rtts = [packet["rtt"] for packet in result.get("result", ()) if isinstance(packet, dict) and "rtt" in packet]
+    return float(min(rtts)) if len(rtts) > 0 else None
+
+
+def iter_ping_rtts(results):
+    """
+    Extracts the minimum RTT of the IPv4 ping results
+    :param results: an iterable of Atlas result dictionaries
+    :return: a generator of (integer target IP, probe ID, minimum RTT, timestamp) tuples
+    """
+    for result in results:
+        if result.get("type") != "ping" or result.get("af", 4) != 4:
+            continue
+        min_rtt = ping_min_rtt(result)
+        if min_rtt is None:
+            continue
+        try:
+            target_int = ip_to_int(result.get("dst_addr") or result["dst_name"])
+            yield target_int, int(result["prb_id"]), min_rtt, int(result.get("timestamp", 0))
+        except (KeyError, TypeError, ValueError, socket.error):
+            continue
+
+
+def iter_traceroute_rtts(results):
+    """
+    Extracts the minimum RTT of every hop that replied in the IPv4 traceroute results, so that one traceroute gives
+    an RTT from its probe to each interface on the path
+    :param results: an iterable of Atlas result dictionaries
+    :return: a generator of (integer hop IP, probe ID, minimum RTT, timestamp) tuples
+    """
+    for result in results:
+        if result.get("type") != "traceroute" or result.get("af", 4) != 4:
+            continue
+        try:
+            probe_id = int(result["prb_id"])
+            timestamp = int(result.get("timestamp", 0))
+        except (KeyError, TypeError, ValueError):
+            continue
+        for hop in result.get("result") or ():
+            hop_rtts = dict()
+            for reply in hop.get("result") or ():
+                if "from" in reply and "rtt" in reply:
+                    hop_rtts[reply["from"]] = min(reply["rtt"], hop_rtts.get(reply["from"], reply["rtt"]))
+            for hop_ip, rtt in hop_rtts.iteritems():
+                try:
+                    yield ip_to_int(hop_ip), probe_id, float(rtt), timestamp
+                except (TypeError, ValueError, socket.error):
+                    continue
+
+
+def iter_result_rtts(results):
+    """
+    Extracts the RTTs of the ping and traceroute results
+    :param results: an iterable of Atlas result dictionaries
+    :return: a generator of (integer IP, probe ID, minimum RTT, timestamp, source) tuples, where source is
+    RttStore.SOURCE_PING or RttStore.SOURCE_TRACEROUTE
+    """
+    for result in results:
+        if result.get("type") == "ping":
+            for rtt in iter_ping_rtts((result,)):
+                yield rtt + (SOURCE_PING,)
+        elif result.get("type") == "traceroute":
+            for rtt in iter_traceroute_rtts((result,)):
+                yield rtt + (SOURCE_TRACEROUTE,)
+
+
+class BorderInterfaces(object):
+    """
+    Recognizes the traceroute hops that are worth geolocating besides the targets: the interfaces originated by
+    given ASNs according to the pyasn database, and the interfaces on IXP peering LANs
+    """
+
+    def __init__(self, asndb=None, asns=None, ixp_lan_table=None):
+        """
+        :param asndb: the AsnMapper that maps the hop IPs to ASNs, or None
+        :param asns: the collection of ASNs whose interfaces are kept
+        :param ixp_lan_table: the PeeringDB.IxpLanTable of the IXP peering LANs, or None
+        """
+        self.asndb = asndb
+        self.asns = np.array(sorted(asns or ()), dtype=np.uint32)
+        self.ixp_lan_table = ixp_lan_table
+
+    def contains(self, ips):
+        """
+        :param ips: a numpy array of integer IPs
+        :return: a boolean numpy array, True for the border interfaces
+        """
+        ips = np.asarray(ips, dtype=np.uint32)
+        contained = np.zeros(len(ips), dtype=bool)
+        if self.asndb is not None and len(self.asns) > 0:
+            contained |= np.in1d(self.asndb.map_asns(ips), self.asns)
+        if self.ixp_lan_table is not None:
+            contained |= self.ixp_lan_table.lookup_prefixes(ips) != 0
+        return contained
+
+
+class TargetRanges(object):
+    """
+    The address ranges of the geolocation targets, merged and sorted so that batches of IPs are matched with a
+    single searchsorted
+    """
+
+    def __init__(self, target_ranges):
+        """
+        :param target_ranges: an iterable of (first, last) integer address tuples, see target_reader.iter_target_ranges
+        """
+        merged = list()
+        for first, last in sorted(target_ranges):
+            if len(merged) > 0 and first <= merged[-1][1] + 1:
+                merged[-1][1] = max(merged[-1][1], last)
+            else:
+                merged.append([first, last])
+        self.firsts = np.array([target_range[0] for target_range in merged], dtype=np.int64)
+        self.lasts = np.array([target_range[1] for target_range in merged], dtype=np.int64)
+
+    def __len__(self):
+        return len(self.firsts)
+
+    def contains(self, ips):
+        """
+        :param ips: a numpy array of integer IPs
+        :return: a boolean numpy array, True for the IPs that are in a target range
+        """
+        ips = np.asarray(ips, dtype=np.int64)
+        indices = np.searchsorted(self.firsts, ips, side="right") - 1
+        valid = indices >= 0
+        contained = np.zeros(len(ips), dtype=bool)
+        contained[valid] = ips[valid] <= self.lasts[indices[valid]]
+        return contained
+
+
+def ingest_archive(archive_file, rtt_store, target_ranges=None, border_interfaces=None, batch_size=100000,
+                   max_pending_rows=10000000):
+    """
+    Adds the ping and traceroute RTTs of an Atlas result dump to the RTT store, keeping only the targets in
+    :target_ranges and, for the traceroute hops, the border interfaces
+    :param archive_file: the path to the dump
+    :param rtt_store: the RttStore object, which has to be saved afterwards
+    :param target_ranges: a TargetRanges object, or None to keep every target
+    :param border_interfaces: a BorderInterfaces object that keeps traceroute hops outside :target_ranges, or None
+    :param batch_size: the number of RTTs that are filtered and added to the store at a time
+    :param max_pending_rows: the store is saved whenever this many rows have been added since it was saved, so that
+    a whole dump is never held in memory
+    :return: a tuple with the number of RTTs read and the number of RTTs added
+    """
+    read_rtts = 0
+    added_rtts = 0
+    batch = list()
+
+    def add_batch():
+        columns = np.array(batch, dtype=np.float64).reshape(-1, 5)
+        targets = columns[:, 0].astype(np.int64)
+        sources = columns[:, 4].astype(np.uint8)
+        if target_ranges is not None:
+            keep = target_ranges.contains(targets)
+        else:
+            keep = np.ones(len(batch), dtype=bool)
+        if border_interfaces is not None:
+            is_hop = sources == SOURCE_TRACEROUTE
+            if target_ranges is None:
+                keep[is_hop] = False
+            keep[is_hop] |= border_interfaces.contains(targets[is_hop])
+        rtt_store.add(targets[keep], columns[keep, 1], columns[keep, 2], columns[keep, 3], sources[keep])
+        if rtt_store.pending_rows() >= max_pending_rows and not rtt_store.save():
+            raise IOError("Could not save the RTT store `%s`" % rtt_store.store_dir)
+        return int(keep.sum())
+
+    for rtt in iter_result_rtts(iter_archive_results(archive_file)):
+        batch.append(rtt)
+        read_rtts += 1
+        if len(batch) >= batch_size:
+            added_rtts += add_batch()
+            batch = list()
+    if len(batch) > 0:
+        added_rtts += add_batch()
+    return read_rtts, added_rtts
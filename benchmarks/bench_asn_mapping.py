@@ -0,0 +1,116 @@
+# coding=latin-1
+"""
+Compares the per-IP pyasn lookups of the original main loop with the bulk AsnMapper when grouping targets per ASN.
+
+Usage: python benchmarks/bench_asn_mapping.py [-a ipasn.dat] [-n 1000000]
+Without -a a synthetic pyasn database with nested prefixes is generated.
+"""
+import os
+import sys
+import random
+import argparse
+import tempfile
+from time import time
+import numpy as np
+import pyasn
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from AsnMapper import AsnMapper
+from ip_utils import int_to_ip, prefix_to_range
+
+
+def write_synthetic_ipasn(prefixes_num, seed=1):
+    """
+    Writes a pyasn database with random /8-/24 prefixes, half of which are more specifics of other prefixes
+    :param prefixes_num: the number of prefixes to generate
+    :param seed: the seed of the random number generator
+    :return: the path to the generated file
+    """
+    rng = random.Random(seed)
+    prefixes = set()
+    covering = list()
+    while len(prefixes) < prefixes_num:
+        if len(covering) > 0 and rng.random() < 0.5:
+            base, length = rng.choice(covering)
+            new_length = min(24, length + rng.randint(1, 8))
+            first, last = prefix_to_range("%s/%s" % (int_to_ip(base), length))
+            address = rng.randint(first, last)
+        else:
+            new_length = rng.randint(8, 24)
+            address = rng.randint(1 << 24, 223 << 24)
+        address = (address >> (32 - new_length)) << (32 - new_length)
+        prefixes.add((address, new_length))
+        if new_length < 20:
+            covering.append((address, new_length))
+
+    fd, ipasn_file = tempfile.mkstemp(suffix=".dat", prefix="bench_ipasn_")
+    with os.fdopen(fd, "w") as fout:
+        fout.write("; IP-ASN32-DAT file\n")
+        for address, length in sorted(prefixes):
+            fout.write("%s/%s\t%s\n" % (int_to_ip(address), length, rng.randint(1, 65000)))
+    return ipasn_file
+
+
+def random_covered_ips(asn_mapper, ips_num, seed=2):
+    """
+    Draws random IPs from the address space covered by the database, like a list of border router interfaces
+    """
+    rng = np.random.RandomState(seed)
+    covered = np.nonzero(asn_mapper.asns != AsnMapper.UNKNOWN_ASN)[0]
+    intervals = covered[rng.randint(0, len(covered), ips_num)]
+    starts = asn_mapper.starts[intervals].astype(np.uint64)
+    ends = np.append(asn_mapper.starts[1:].astype(np.uint64), 1 << 32)[intervals]
+    return (starts + (rng.random_sample(ips_num) * (ends - starts)).astype(np.uint64)).astype(np.uint32)
+
+
+parser = argparse.ArgumentParser(description="Benchmarks the per-IP and the bulk IP to ASN mapping")
+parser.add_argument('-a', '--ipasn', type=str, help="The path to a pyasn database file")
+parser.add_argument('-n', '--ips', type=int, default=1000000, help="The number of target IPs")
+parser.add_argument('-p', '--prefixes', type=int, default=500000, help="The number of synthetic prefixes")
+args = parser.parse_args()
+
+ipasn_file = args.ipasn
+if ipasn_file is None:
+    ipasn_file = write_synthetic_ipasn(args.prefixes)
+    print "Generated a synthetic pyasn database with %s prefixes in %s" % (args.prefixes, ipasn_file)
+
+start = time()
+asn_mapper = AsnMapper.from_ipasn_file(ipasn_file)
+print "AsnMapper: built %s intervals in %.2f sec" % (len(asn_mapper.starts), time() - start)
+start = time()
+asndb = pyasn.pyasn(ipasn_file)
+print "pyasn: loaded the database in %.2f sec" % (time() - start)
+
+target_ips = random_covered_ips(asn_mapper, args.ips)
+target_strings = [int_to_ip(ip) for ip in target_ips.tolist()]
+
+# Per-IP path of the original main loop: one pyasn lookup and one dictionary insertion per dotted IP
+start = time()
+geolocation_targets = dict()
+for target_ip in target_strings:
+    target_asn, prefix = asndb.lookup(target_ip)
+    if target_asn not in geolocation_targets:
+        geolocation_targets[target_asn] = set()
+    geolocation_targets[target_asn].add(target_ip)
+per_ip_seconds = time() - start
+
+# Bulk path: one searchsorted over the integer IPs and one sort to group them
+start = time()
+bulk_asns = asn_mapper.map_asns(target_ips)
+asn_targets = asn_mapper.group_by_asn(target_ips, bulk_asns)
+bulk_seconds = time() - start
+
+mismatches = 0
+for target_ip, bulk_asn in zip(target_strings[:100000], bulk_asns[:100000].tolist()):
+    if (asndb.lookup(target_ip)[0] or AsnMapper.UNKNOWN_ASN) != bulk_asn:
+        mismatches += 1
+
+print "Targets: %s, ASNs: %s" % (len(target_ips), len(asn_targets))
+print "Per-IP pyasn grouping: %.2f sec (%.0f IPs/sec)" % (per_ip_seconds, len(target_ips) / per_ip_seconds)
+print "Bulk AsnMapper grouping: %.2f sec (%.0f IPs/sec)" % (bulk_seconds, len(target_ips) / bulk_seconds)
+print "Speedup: %.1fx, mismatches in the first 100000 IPs: %s" % (per_ip_seconds / bulk_seconds, mismatches)
+
+if args.ipasn is None:
+    os.remove(ipasn_file)
+    if os.path.exists(ipasn_file + ".npz"):
+        os.remove(ipasn_file + ".npz")
@@ -0,0 +1,139 @@
+# coding=latin-1
+"""
+Runs the whole geolocation offline against a fixture PeeringDB server, a fake geocoder and a fake Atlas backend,
+and reports the throughput and latency of every step, so that changes to the pipeline can be compared.
+
+Usage: python benchmarks/bench_end_to_end.py [--workload single|1k|100k|all] [--workers N]
+                                             [--peeringdb-latency ms] [--geocoder-latency ms] [--atlas-latency ms]
+
+Workloads:
+  single  1 IP
+  1k      1000 IPs in 50 ASNs
+  100k    100000 IPs in 2000 ASNs
+Must be run from the repository root so that config/config.ini is found.
+"""
+import os
+import sys
+import shutil
+import argparse
+import tempfile
+from time import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import arg_parser
+from Metrics import METRICS
+from GeolocationPipeline import GeolocationPipeline
+from fakes import SyntheticWorld, FixturePeeringDBServer, FakeAtlas, FakeGeocoder, make_workspace, install_fakes
+
+WORKLOADS = [
+    ("single", 1, 1),
+    ("1k", 1000, 50),
+    ("100k", 100000, 2000)
+]
+
+# The timers of the pipeline steps, in the order in which they run
+STEP_TIMERS = [
+    "peeringdb_request",
+    "geocode",
+    "probe_inventory",
+    "probe_search",
+    "asn_locate",
+    "probe_sampling",
+    "atlas_measurement_create",
+    "atlas_stream_wait",
+    "measurement",
+    "verification",
+    "traceroute_harvest",
+    "output_write",
+    "target"
+]
+
+
+def histogram_quantile(histogram, quantile):
+    """
+    :return: the upper bound of the histogram bucket that contains the quantile
+    """
+    threshold = quantile * histogram["count"]
+    for bound in sorted(histogram["buckets"], key=lambda b: float("inf") if b == "+Inf" else float(b)):
+        if histogram["buckets"][bound] >= threshold:
+            return bound
+    return "+Inf"
+
+
+def report(workload, targets_num, elapsed, snapshot):
+    print "\n== Workload %s: %s targets in %.2f sec (%.1f targets/sec)" % (
+        workload, targets_num, elapsed, targets_num / elapsed)
+    print "  %-40s %8s %10s %10s %8s %8s %12s" % ("step", "calls", "total s", "mean ms", "p50 <=", "p95 <=",
+                                                   "calls/sec")
+    for timer in STEP_TIMERS:
+        histograms = [(key, histogram) for key, histogram in snapshot["histograms"].iteritems()
+                      if key.partition("{")[0] == timer + "_seconds"]
+        for key, histogram in sorted(histograms):
+            label = key[len(timer + "_seconds"):]
+            print "  %-40s %8s %10.3f %10.3f %8s %8s %12.1f" % (
+                timer + label, histogram["count"], histogram["sum"],
+                1000 * histogram["sum"] / max(histogram["count"], 1),
+                histogram_quantile(histogram, 0.5), histogram_quantile(histogram, 0.95),
+                histogram["count"] / elapsed)
+    stages = sorted(key for key in snapshot["gauges"] if key.startswith("stage_busy_ratio"))
+    for key in stages:
+        stage = key.partition("{")[2].rstrip("}")
+        print "  stage %-34s busy %5.1f%% | starved %5.1f%% | blocked %5.1f%%" % (
+            stage, 100 * snapshot["gauges"][key],
+            100 * snapshot["gauges"][key.replace("busy", "starved")],
+            100 * snapshot["gauges"][key.replace("busy", "blocked")])
+    for key in sorted(snapshot["counters"]):
+        print "  %-50s %s" % (key, snapshot["counters"][key])
+
+
+def run_workload(world, workload, targets_num, asns_num, args):
+    targets = world.targets(targets_num, asns_num)
+    workspace_dir = tempfile.mkdtemp(prefix="bench_e2e_%s_" % workload)
+    try:
+        with FixturePeeringDBServer(world, args.peeringdb_latency) as peeringdb_server:
+            config, argv = make_workspace(world, targets, workspace_dir, peeringdb_server.base_url)
+            argv += ["-w", str(args.workers)]
+            config["Traceroute"]["probes"] = str(args.traceroute_probes)
+            METRICS.reset()
+            start = time()
+            pipeline = GeolocationPipeline(config, arg_parser.parse_arguments(argv))
+            install_fakes(pipeline, world,
+                          FakeAtlas(world, args.atlas_latency, args.atlas_latency, dead_probes=args.dead_probes),
+                          FakeGeocoder(world, args.geocoder_latency))
+            pipeline.run()
+            pipeline.close()
+            elapsed = time() - start
+            report(workload, len(targets), elapsed, METRICS.snapshot())
+            print "  %-50s %s" % ("peeringdb_fixture_requests", peeringdb_server.requests)
+            status = pipeline.atlas_budget.status()
+            print "  %-50s %.3f" % ("replies_per_credit", float(METRICS.snapshot()["counters"].get(
+                "atlas_replying_probes", 0)) / max(status["credits"], 1))
+    finally:
+        if args.keep:
+            print "  workspace: %s" % workspace_dir
+        else:
+            shutil.rmtree(workspace_dir)
+
+
+parser = argparse.ArgumentParser(description="Benchmarks the geolocation end-to-end with local fake services")
+parser.add_argument('--workload', choices=[w[0] for w in WORKLOADS] + ["all"], default="1k")
+parser.add_argument('--workers', type=int, default=1, help="The number of worker processes")
+parser.add_argument('--seed', type=int, default=1, help="The seed of the synthetic world")
+parser.add_argument('--peeringdb-latency', type=float, default=0, help="The latency of the PeeringDB server (ms)")
+parser.add_argument('--geocoder-latency', type=float, default=0, help="The latency of the geocoder (ms)")
+parser.add_argument('--atlas-latency', type=float, default=0,
+                    help="The latency of creating a measurement and of receiving its results (ms)")
+parser.add_argument('--dead-probes', type=float, default=0,
+                    help="The fraction of the probes that never reply to measurements")
+parser.add_argument('--traceroute-probes', type=int, default=0,
+                    help="The number of closest probes that run a traceroute toward every located target")
+parser.add_argument('--keep', action="store_true", help="Keep the workspace with the output of each workload")
+args = parser.parse_args()
+
+start = time()
+world = SyntheticWorld(args.seed)
+print "Synthetic world: %s cities, %s IXPs, %s ASNs, %s probes (%.1f sec)" % (
+    len(world.cities), len(world.ixps), len(world.asns), len(world.probes), time() - start)
+for workload, targets_num, asns_num in WORKLOADS:
+    if args.workload in (workload, "all"):
+        run_workload(world, workload, targets_num, asns_num, args)
@@ -0,0 +1,69 @@
+# coding=latin-1
+"""
+Measures the startup cost of a geolocation run, up to the moment the first ASN is ready to be located.
+
+Usage: python benchmarks/bench_startup.py -i <ip> -a <ipasn.dat> -r <relations.bz2> -o <output> [--eager]
+
+The lazy run only loads the resources that grouping the targets touches. With --eager every resource is loaded
+up-front, like the main script did before the pipeline was made lazy, which gives the baseline to compare with.
+Must be run from the repository root so that config/config.ini is found.
+"""
+import os
+import sys
+from time import time
+
+start = time()
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import GeolocationPipeline
+import arg_parser
+import_seconds = time() - start
+
+# Resources that the eager startup loaded before grouping the targets
+EAGER_RESOURCES = (
+    "geo_encoder",
+    "cached_location_coordinates",
+    "cached_probes_locations",
+    "failed_locations",
+    "peeringdb_api",
+    "ixp_lan_table",
+    "atlas_api",
+    "as_relationships",
+    "asndb",
+    "extra_locations",
+    "already_geolocated_ips"
+)
+
+argv = sys.argv[1:]
+eager = "--eager" in argv
+if eager:
+    argv.remove("--eager")
+
+start = time()
+config = arg_parser.read_config()
+args = arg_parser.parse_arguments(argv)
+pipeline = GeolocationPipeline.GeolocationPipeline(config, args)
+setup_seconds = time() - start
+
+start = time()
+if eager:
+    for resource in EAGER_RESOURCES:
+        getattr(pipeline, resource)
+    pipeline.inventory_min_asns = 0
+    pipeline.collect_probe_inventory()
+first_asn = None
+for target_asn, target_asn_ips, target_locations in pipeline.iter_geolocation_targets():
+    first_asn = target_asn
+    break
+ready_seconds = time() - start
+
+print "Mode: %s" % ("eager" if eager else "lazy")
+print "Import: %.3f sec" % import_seconds
+print "Configuration and arguments: %.3f sec" % setup_seconds
+print "Ready to locate the first ASN (AS%s): %.3f sec" % (first_asn, ready_seconds)
+print "Loaded resources:"
+for resource, seconds in sorted(pipeline.load_times.items(), key=lambda x: -x[1]):
+    print "  %-30s %.3f sec" % (resource, seconds)
+heavy_modules = [module for module in ("Atlas", "GeoEncoder", "PeeringDB", "ripe.atlas.cousteau", "geoip2")
+                 if module in sys.modules]
+print "Heavy modules imported: %s" % (", ".join(heavy_modules) if len(heavy_modules) > 0 else "none")
+pipeline.close()
@@ -0,0 +1,477 @@
+# coding=latin-1
+"""
+Local stand-ins for the services that the geolocation depends on, for benchmarks that run without network access:
+- SyntheticWorld generates cities, facilities, IXPs, ASNs with their prefixes and presence, Atlas probes and the
+  true location of every target IP
+- FixturePeeringDBServer serves the PeeringDB API endpoints that the pipeline uses from the synthetic world
+- FakeGeocoder replaces the geopy Google Maps geolocator of the GeoEncoder
+- FakeAtlas replaces the RIPE Atlas client, and synthesizes the RTTs of the pings from the distance between the
+  probe and the true location of the target
+- ReplayAtlas replaces the measurements of the RIPE Atlas client with the RTTs observed in past measurements
+"""
+import os
+import bz2
+import math
+import random
+import threading
+import itertools
+import BaseHTTPServer
+import SocketServer
+from time import sleep, time
+from urlparse import urlparse, parse_qs
+from ujson import dumps
+
+import arg_parser
+from Atlas import Atlas
+from ip_utils import int_to_ip, ip_to_int
+
+# Speed of light in fiber, in km per ms, and the latency that every ping has regardless of the distance
+FIBER_KM_PER_MS = 100.0
+BASE_RTT_MS = 0.3
+
+
+def haversine_km(lat1, lng1, lat2, lng2):
+    lat1, lng1, lat2, lng2 = map(math.radians, (lat1, lng1, lat2, lng2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+    return 6371.0 * 2 * math.asin(math.sqrt(min(1.0, a)))
+
+
+class SyntheticWorld(object):
+    """
+    A random but reproducible Internet: countries with cities, facilities and IXPs in the cities, ASNs that are
+    present in some cities and originate a /16 each, Atlas probes spread across the cities, and a true city for
+    every target IP among the cities of its ASN
+    """
+
+    def __init__(self, seed=1, countries_num=20, cities_num=200, asns_num=2000, probes_num=5000):
+        rng = random.Random(seed)
+        self.seed = seed
+        self.cities = list()
+        country_codes = ["%s%s" % (a, b) for a, b in itertools.product("ABCDEFGHIJ", "ABCDEFGHIJ")][:countries_num]
+        centers = dict((country, (rng.uniform(-50, 60), rng.uniform(-150, 150))) for country in country_codes)
+        for city_index in xrange(cities_num):
+            country = country_codes[city_index % countries_num]
+            lat, lng = centers[country]
+            self.cities.append({
+                "name": "City%s" % city_index,
+                "country": country,
+                "lat": lat + rng.uniform(-4, 4),
+                "lng": lng + rng.uniform(-4, 4)
+            })
+        self.city_index = dict((("%s|%s" % (city["name"], city["country"])).lower(), city) for city in self.cities)
+
+        # One facility per city, and an IXP in every fifth city with a /22 peering LAN in 185.0.0.0/8
+        self.ixps = dict()
+        for city_index, city in enumerate(self.cities):
+            if city_index % 5 == 0:
+                ix_id = len(self.ixps) + 1
+                self.ixps[ix_id] = {
+                    "city": city,
+                    "ixlan_id": ix_id,
+                    "prefix_start": (185 << 24) + (ix_id << 10),
+                    "members": list()
+                }
+
+        # ASNs start at 64512 and originate 20.0.0.0/16, 20.1.0.0/16, ...
+        self.asns = dict()
+        for asn_index in xrange(asns_num):
+            asn = 64512 + asn_index
+            asn_cities = rng.sample(self.cities, rng.randint(1, 6))
+            self.asns[asn] = {
+                "cities": asn_cities,
+                "prefix_start": (20 << 24) + (asn_index << 16),
+                "ixps": list()
+            }
+            for city in asn_cities:
+                city_ixps = [ix_id for ix_id, ixp in self.ixps.iteritems() if ixp["city"] is city]
+                for ix_id in city_ixps:
+                    ixp = self.ixps[ix_id]
+                    member_ip = ixp["prefix_start"] + len(ixp["members"]) + 1
+                    if len(ixp["members"]) < 1000:
+                        ixp["members"].append((asn, member_ip))
+                        self.asns[asn]["ixps"].append(ix_id)
+
+        # Probes are placed within ~20 km of a city, in one of the ASNs or in an access network without targets
+        self.probes = list()
+        asn_list = sorted(self.asns)
+        for probe_id in xrange(1, probes_num + 1):
+            city = rng.choice(self.cities)
+            probe_asn = rng.choice(asn_list) if rng.random() < 0.5 else 4200000000 + rng.randint(0, 5000)
+            self.probes.append({
+                "id": probe_id,
+                "asn_v4": probe_asn,
+                "country_code": city["country"],
+                "status": 1,
+                "geometry": {
+                    "type": "Point",
+                    "coordinates": [city["lng"] + rng.uniform(-0.15, 0.15), city["lat"] + rng.uniform(-0.15, 0.15)]
+                }
+            })
+        self.probes_by_id = dict((probe["id"], probe) for probe in self.probes)
+
+        # Every ASN has links with a few other ASNs and with the access networks of some probes
+        self.relationships = set()
+        probe_asns = sorted(set(probe["asn_v4"] for probe in self.probes))
+        for asn in asn_list:
+            for neighbor in rng.sample(asn_list, 3) + rng.sample(probe_asns, 3):
+                if neighbor != asn:
+                    self.relationships.add((min(asn, neighbor), max(asn, neighbor), rng.choice((-1, 0))))
+
+    def target_city(self, target_ip):
+        """
+        :return: the city where a target IP of the world is located
+        """
+        target_int = sum(int(octet) << (8 * (3 - index)) for index, octet in enumerate(target_ip.split(".")))
+        for ixp in self.ixps.itervalues():
+            if ixp["prefix_start"] <= target_int < ixp["prefix_start"] + 1024:
+                return ixp["city"]
+        asn = 64512 + ((target_int - (20 << 24)) >> 16)
+        if asn not in self.asns:
+            return None
+        asn_cities = self.asns[asn]["cities"]
+        # The addresses of a /30 link subnet are in the same city
+        return asn_cities[((target_int >> 2) * 2654435761) % len(asn_cities)]
+
+    def targets(self, targets_num, asns_num):
+        """
+        :param targets_num: the number of target IPs
+        :param asns_num: the number of ASNs across which the targets are spread
+        :return: a list of target IPs
+        """
+        asn_list = sorted(self.asns)[:asns_num]
+        targets = list()
+        for index in xrange(targets_num):
+            asn = asn_list[index % len(asn_list)]
+            targets.append(int_to_ip(self.asns[asn]["prefix_start"] + 1 + index // len(asn_list)))
+        return targets
+
+    def write_ipasn(self, ipasn_file):
+        with open(ipasn_file, "w") as fout:
+            fout.write("; IP-ASN32-DAT file\n")
+            for asn in sorted(self.asns):
+                fout.write("%s/16\t%s\n" % (int_to_ip(self.asns[asn]["prefix_start"]), asn))
+
+    def write_relationships(self, relationships_file):
+        fout = bz2.BZ2File(relationships_file, "w")
+        fout.write("# synthetic AS relationships\n")
+        for asn1, asn2, relationship in sorted(self.relationships):
+            fout.write("%s|%s|%s\n" % (asn1, asn2, relationship))
+        fout.close()
+
+    # The PeeringDB API responses
+    def peeringdb_response(self, path, query):
+        parts = path.strip("/").split("/")
+        if parts[0] == "api":
+            parts = parts[1:]
+        endpoint = parts[0]
+        if endpoint == "netfac":
+            asns = [int(query["local_asn"][0])] if "local_asn" in query else sorted(self.asns)
+            return [{"local_asn": asn, "fac_id": self.cities.index(city) + 1, "city": city["name"],
+                     "country": city["country"]}
+                    for asn in asns for city in self.asns.get(asn, {"cities": []})["cities"]]
+        if endpoint == "netixlan":
+            members = [(asn, ip, ix_id) for ix_id, ixp in self.ixps.iteritems() for asn, ip in ixp["members"]]
+            if "asn" in query:
+                members = [member for member in members if member[0] == int(query["asn"][0])]
+            return [{"asn": asn, "ipaddr4": int_to_ip(ip), "ix_id": ix_id, "name": "IX%s" % ix_id}
+                    for asn, ip, ix_id in members]
+        if endpoint == "ix" and len(parts) > 1:
+            ixp = self.ixps[int(parts[1])]
+            city = ixp["city"]
+            return [{"id": int(parts[1]), "city": city["name"], "country": city["country"],
+                     "fac_set": [{"city": city["name"], "country": city["country"]}]}]
+        if endpoint == "ix":
+            return [{"id": ix_id, "city": ixp["city"]["name"], "country": ixp["city"]["country"]}
+                    for ix_id, ixp in self.ixps.iteritems()]
+        if endpoint == "ixfac":
+            return [{"ix_id": ix_id, "city": ixp["city"]["name"], "country": ixp["city"]["country"]}
+                    for ix_id, ixp in self.ixps.iteritems()]
+        if endpoint == "ixlan":
+            return [{"id": ixp["ixlan_id"], "ix_id": ix_id} for ix_id, ixp in self.ixps.iteritems()]
+        if endpoint == "ixpfx":
+            return [{"prefix": "%s/22" % int_to_ip(ixp["prefix_start"]), "ixlan_id": ixp["ixlan_id"]}
+                    for ixp in self.ixps.itervalues()]
+        return None
+
+
+class FixturePeeringDBServer(object):
+    """
+    A local HTTP server with the PeeringDB API endpoints of a SyntheticWorld
+    """
+
+    def __init__(self, world, latency_ms=0):
+        """
+        :param world: the SyntheticWorld
+        :param latency_ms: the delay of every response, to simulate the network
+        """
+        server_world = world
+        delay = latency_ms / 1000.0
+        self.requests = 0
+        server = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlparse(self.path)
+                data = server_world.peeringdb_response(url.path, parse_qs(url.query))
+                server.requests += 1
+                if delay > 0:
+                    sleep(delay)
+                if data is None:
+                    body = dumps({"data": [], "meta": {"error": "Not found"}})
+                    self.send_response(404)
+                else:
+                    body = dumps({"data": data, "meta": {}})
+                    self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+            daemon_threads = True
+
+        self.httpd = Server(("127.0.0.1", 0), Handler)
+        self.base_url = "http://127.0.0.1:%s/api/" % self.httpd.server_address[1]
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.daemon = True
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class FakeLocation(object):
+    def __init__(self, raw):
+        self.raw = raw
+
+
+class FakeGeocoder(object):
+    """
+    Answers the geocode and reverse queries of the GeoEncoder in the format of the Google Maps API
+    """
+
+    def __init__(self, world, latency_ms=0):
+        self.world = world
+        self.delay = latency_ms / 1000.0
+        self.queries = 0
+
+    def geocode(self, query, timeout=None, language=None):
+        self.queries += 1
+        if self.delay > 0:
+            sleep(self.delay)
+        city = self.world.city_index.get(query.lower())
+        if city is None:
+            return None
+        return FakeLocation({
+            "geometry": {"location": {"lat": city["lat"], "lng": city["lng"]}},
+            "address_components": [
+                {"long_name": city["name"], "short_name": city["name"], "types": ["locality", "political"]},
+                {"long_name": city["country"], "short_name": city["country"], "types": ["country", "political"]}
+            ]
+        })
+
+    def reverse(self, query, exactly_one=True, language=None):
+        self.queries += 1
+        if self.delay > 0:
+            sleep(self.delay)
+        lat, lng = [float(value) for value in query.split(",")]
+        city = min(self.world.cities, key=lambda c: haversine_km(lat, lng, c["lat"], c["lng"]))
+        return FakeLocation({
+            "address_components": [
+                {"long_name": city["name"], "short_name": city["name"], "types": ["locality", "political"]},
+                {"long_name": "County", "short_name": "County", "types": ["administrative_area_level_2"]},
+                {"long_name": city["country"], "short_name": city["country"], "types": ["country", "political"]}
+            ]
+        })
+
+
+class FakeAtlas(Atlas):
+    """
+    An Atlas client whose probe listings come from a SyntheticWorld, and whose ping results are synthesized from
+    the distance between each probe and the true location of the target
+    """
+
+    def __init__(self, world, create_latency_ms=0, result_latency_ms=0, loss=0.05, seed=1, dead_probes=0.0):
+        Atlas.__init__(self, "fake-key")
+        self.world = world
+        self.create_delay = create_latency_ms / 1000.0
+        self.result_delay = result_latency_ms / 1000.0
+        self.loss = loss
+        self.rng = random.Random(seed)
+        # Probes that are listed as connected but never reply
+        dead_rng = random.Random(seed)
+        self.dead_probes = set(probe["id"] for probe in world.probes if dead_rng.random() < dead_probes)
+        self.measurement_ids = itertools.count(1)
+        self.measurements = dict()
+
+    def request_probes(self, **filters):
+        probes = self.world.probes
+        if "asn_v4" in filters:
+            probes = [probe for probe in probes if probe["asn_v4"] == int(filters["asn_v4"])]
+        if "country_code" in filters:
+            probes = [probe for probe in probes if probe["country_code"] == filters["country_code"]]
+        return probes
+
+    def create_measurement(self, measurement, source):
+        if self.create_delay > 0:
+            sleep(self.create_delay)
+        definition = measurement.build_api_struct()
+        measurement_id = next(self.measurement_ids)
+        probe_ids = [int(probe_id) for probe_id in source.value.split(",")]
+        self.measurements[measurement_id] = (definition["type"], definition["target"], definition.get("packets", 3),
+                                             probe_ids)
+        return True, {"measurements": [measurement_id]}
+
+    def synthetic_rtt(self, probe, city):
+        lng, lat = probe["geometry"]["coordinates"]
+        distance_rtt = haversine_km(lat, lng, city["lat"], city["lng"]) / FIBER_KM_PER_MS
+        return BASE_RTT_MS + distance_rtt * (1 + self.rng.random() * 0.3)
+
+    def stream_results(self, measurement_id, on_result=None):
+        if self.result_delay > 0:
+            sleep(self.result_delay)
+        measurement_type, target_ip, packets_num, probe_ids = self.measurements.pop(measurement_id)
+        city = self.world.target_city(target_ip)
+        for probe_id in probe_ids:
+            probe = self.world.probes_by_id.get(probe_id)
+            if probe is None or city is None or probe_id in self.dead_probes or self.rng.random() < self.loss:
+                continue
+            if measurement_type == "traceroute":
+                (on_result or self.on_result_response)({
+                    "msm_id": measurement_id,
+                    "prb_id": probe_id,
+                    "type": "traceroute",
+                    "af": 4,
+                    "timestamp": int(time()),
+                    "result": self.traceroute_hops(probe, target_ip, packets_num)
+                })
+                continue
+            self.on_result_response({
+                "msm_id": measurement_id,
+                "prb_id": probe_id,
+                "timestamp": int(time()),
+                "sent": packets_num,
+                "rcvd": packets_num,
+                "result": [{"rtt": self.synthetic_rtt(probe, city)} for _ in xrange(packets_num)]
+            })
+
+    def traceroute_hops(self, probe, target_ip, packets_num):
+        """
+        Synthesizes the hops of a traceroute: the gateway of the probe in a private prefix, an interface in the /24 of
+        the target, the other end of the target's /30 link and finally the target. Every hop replies with the RTT to
+        its true city.
+        """
+        target_int = sum(int(octet) << (8 * (3 - index)) for index, octet in enumerate(target_ip.split(".")))
+        hop_ips = ["10.%s.%s.1" % (probe["id"] >> 8 & 255, probe["id"] & 255),
+                   int_to_ip((target_int & ~255) + 9), int_to_ip(target_int ^ 3), target_ip]
+        hops = list()
+        for hop_number, hop_ip in enumerate(hop_ips, 1):
+            hop_city = self.world.target_city(hop_ip)
+            if hop_city is None:
+                replies = [{"from": hop_ip, "rtt": 0.5 + self.rng.random()} for _ in xrange(packets_num)]
+            else:
+                replies = [{"from": hop_ip, "rtt": self.synthetic_rtt(probe, hop_city)} for _ in xrange(packets_num)]
+            hops.append({"hop": hop_number, "result": replies})
+        return hops
+
+
+class ReplayAtlas(Atlas):
+    """
+    An Atlas client whose pings are answered from the RTTs observed in past measurements, i.e. an RttStore filled by
+    ingest-atlas-results.py. The probe listings come from the Atlas API, or from its cassettes. Probes that have no
+    observed RTT to the target don't reply.
+    """
+
+    def __init__(self, rtt_store, cassette_store=None, min_timestamp=0):
+        """
+        :param rtt_store: the RttStore with the observed RTTs
+        :param cassette_store: the CassetteStore that serves the probe listings, or None to query the Atlas API
+        :param min_timestamp: the RTTs observed before this UNIX timestamp are ignored
+        """
+        Atlas.__init__(self, "replay-key", cassette_store)
+        self.rtt_store = rtt_store
+        self.min_timestamp = min_timestamp
+        self.measurement_ids = itertools.count(1)
+        self.measurements = dict()
+
+    def create_measurement(self, measurement, source):
+        definition = measurement.build_api_struct()
+        measurement_id = next(self.measurement_ids)
+        probe_ids = [int(probe_id) for probe_id in source.value.split(",")]
+        self.measurements[measurement_id] = (definition["type"], definition["target"], definition.get("packets", 3),
+                                             probe_ids)
+        return True, {"measurements": [measurement_id]}
+
+    def stream_results(self, measurement_id, on_result=None):
+        measurement_type, target_ip, packets_num, probe_ids = self.measurements.pop(measurement_id)
+        if measurement_type != "ping":
+            return
+        observed_rtts = dict(self.rtt_store.lookup(ip_to_int(target_ip), self.min_timestamp))
+        for probe_id in probe_ids:
+            if probe_id not in observed_rtts:
+                continue
+            self.on_result_response({
+                "msm_id": measurement_id,
+                "prb_id": probe_id,
+                "timestamp": int(time()),
+                "sent": packets_num,
+                "rcvd": packets_num,
+                "result": [{"rtt": observed_rtts[probe_id]} for _ in xrange(packets_num)]
+            })
+
+
+def make_workspace(world, targets, workspace_dir, peeringdb_url):
+    """
+    Writes the input files of a benchmark run and returns the matching configuration and command-line arguments
+    :param world: the SyntheticWorld
+    :param targets: the list of target IPs
+    :param workspace_dir: the directory of the files
+    :param peeringdb_url: the base URL of the fixture PeeringDB server
+    :return: a tuple with the configuration dictionary and the argument list of the main script
+    """
+    if not os.path.isdir(workspace_dir):
+        os.makedirs(workspace_dir)
+    ipasn_file = os.path.join(workspace_dir, "ipasn.dat")
+    relationships_file = os.path.join(workspace_dir, "relationships.txt.bz2")
+    targets_file = os.path.join(workspace_dir, "targets.txt")
+    world.write_ipasn(ipasn_file)
+    world.write_relationships(relationships_file)
+    with open(targets_file, "w") as fout:
+        for target_ip in targets:
+            fout.write(target_ip + "\n")
+
+    config = arg_parser.read_config()
+    config["FilePaths"].update({
+        "maxmind_db": os.path.join(workspace_dir, "missing.mmdb"),
+        "city_coordinates": os.path.join(workspace_dir, "city_coordinates.txt"),
+        "location_index": os.path.join(workspace_dir, "location_index.txt"),
+        "probes_locations": os.path.join(workspace_dir, "probes_locations.txt"),
+        "failed_locations": os.path.join(workspace_dir, "failed_locations.txt"),
+        "probe_health": os.path.join(workspace_dir, "probe_health.txt"),
+        "rtt_store": os.path.join(workspace_dir, "rtt_store"),
+        "search_spaces": os.path.join(workspace_dir, "search_spaces"),
+        "ixp_lan_table": os.path.join(workspace_dir, "ixp_lan_table")
+    })
+    config["PeeringDB"]["base_url"] = peeringdb_url
+    config["PingParameters"]["random_seed"] = str(world.seed)
+    config["Metrics"]["snapshot_file"] = ""
+    config["Pipeline"]["report_seconds"] = "0"
+    config["Output"]["results_db"] = ""
+    argv = ["-f", targets_file, "-a", ipasn_file, "-r", relationships_file,
+            "-o", os.path.join(workspace_dir, "output.tsv")]
+    return config, argv
+
+
+def install_fakes(pipeline, world, atlas_api=None, geocoder=None):
+    """
+    Replaces the Atlas client and the Google Maps geolocator of a GeolocationPipeline with the fakes
+    """
+    pipeline.resources["atlas_api"] = atlas_api or FakeAtlas(world)
+    pipeline.geo_encoder.gmap_geolocator = geocoder or FakeGeocoder(world)
@@ -0,0 +1,274 @@
+# coding=latin-1
+"""
+Replays the geolocation offline for every combination of the probe selection parameters, and reports the accuracy,
+the measurements, the Atlas credits and an estimate of the wall-clock time of each combination, so that the
+parameters can be tuned without spending credits. The combinations run in parallel, one per core.
+
+Usage: python benchmarks/simulate_parameters.py [--model synthetic|stored] [--jobs N]
+                                                [--probes-per-city 3,5,10] [--search-radius-km 20,40,80]
+                                                [--chunk-size 50,100] [--early-stop-rtt 1,2,3]
+                                                [--verify-max-rtt 3,5,8]
+
+Models:
+  synthetic  The targets of a SyntheticWorld, with RTTs synthesized from the distance between the probe and the true
+             location of the target, as in bench_end_to_end.py
+  stored     A historical target file (-f) whose pings are answered from the RTTs of an RTT store (--observations),
+             filled by ingest-atlas-results.py. PeeringDB, the geocoding and the probe listings are served from the
+             cassettes of the configuration, so record them with a live run first. The accuracy is only reported
+             with a ground truth file (--truth) of `IP lat lng` lines.
+A parameter that is not given keeps the value of the configuration. Must be run from the repository root so that
+config/config.ini is found.
+"""
+import os
+import sys
+import glob
+import shutil
+import logging
+import argparse
+import tempfile
+import itertools
+import multiprocessing
+from time import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import arg_parser
+import target_reader
+from Metrics import METRICS
+from RttStore import RttStore
+from GeolocationPipeline import GeolocationPipeline
+from fakes import SyntheticWorld, FixturePeeringDBServer, FakeAtlas, ReplayAtlas, make_workspace, install_fakes, \
+    haversine_km
+
+# The swept parameters: the command-line option, and the section and key of the configuration
+PARAMETERS = [
+    ("probes_per_city", "PingParameters", "probes_per_city"),
+    ("search_radius_km", "PingParameters", "search_radius_km"),
+    ("chunk_size", "PingParameters", "chunk_size"),
+    ("early_stop_rtt", "PingParameters", "early_stop_rtt"),
+    ("verify_max_rtt", "Clustering", "verify_max_rtt")
+]
+
+# The state of a worker process, set by init_worker
+worker = dict()
+
+
+def init_worker(args, world, truth):
+    """
+    Prepares a worker process: the fixture PeeringDB server of the synthetic model, or the RTT store of the stored
+    model. The output of the pipeline is silenced, except for critical errors.
+    """
+    worker["args"] = args
+    worker["world"] = world
+    worker["truth"] = truth
+    if args.model == "synthetic":
+        worker["peeringdb_server"] = FixturePeeringDBServer(world).__enter__()
+    else:
+        worker["observations"] = RttStore(args.observations).load()
+    sys.stdout = open(os.devnull, "w")
+    logging.disable(logging.ERROR)
+
+
+def read_truth(truth_file):
+    """
+    :return: a dictionary that maps the IPs of a ground truth file to their (lat, lng) tuple
+    """
+    truth = dict()
+    with open(truth_file) as fin:
+        for line in fin:
+            lf = line.replace(",", " ").split()
+            if len(lf) >= 3 and not lf[0].startswith("#"):
+                truth[lf[0]] = (float(lf[1]), float(lf[2]))
+    return truth
+
+
+def read_locations(output_file):
+    """
+    :return: a dictionary that maps the IPs of a TSV geolocation output to their (lat, lng) tuple
+    """
+    locations = dict()
+    with open(output_file) as fin:
+        for line in fin:
+            lf = line.rstrip("\n").split("\t")
+            if len(lf) >= 7 and not line.startswith("#"):
+                try:
+                    locations[lf[0]] = (float(lf[5]), float(lf[6]))
+                except ValueError:
+                    continue
+    return locations
+
+
+def make_stored_workspace(args, workspace_dir):
+    """
+    Points the files that the pipeline writes to a workspace, so that the simulations neither read the results of
+    each other nor modify the files of the configuration
+    :return: a tuple with the configuration dictionary and the argument list of the main script
+    """
+    config = arg_parser.read_config()
+    for path_key in ("city_coordinates", "location_index", "probes_locations", "failed_locations"):
+        workspace_file = os.path.join(workspace_dir, os.path.basename(config["FilePaths"][path_key]))
+        if os.path.isfile(config["FilePaths"][path_key]):
+            shutil.copy(config["FilePaths"][path_key], workspace_file)
+        config["FilePaths"][path_key] = workspace_file
+    # The IXP LAN table is rebuilt in place when it is stale, so every simulation uses its own copy
+    ixp_lan_table = os.path.join(workspace_dir, "ixp_lan_table")
+    if os.path.isdir(config["FilePaths"]["ixp_lan_table"]):
+        shutil.copytree(config["FilePaths"]["ixp_lan_table"], ixp_lan_table)
+    config["FilePaths"]["ixp_lan_table"] = ixp_lan_table
+    config["FilePaths"]["probe_health"] = os.path.join(workspace_dir, "probe_health.txt")
+    config["FilePaths"]["rtt_store"] = os.path.join(workspace_dir, "rtt_store")
+    config["Cassettes"]["mode"] = "replay"
+    config["Metrics"]["snapshot_file"] = ""
+    config["Pipeline"]["report_seconds"] = "0"
+    config["Output"]["results_db"] = ""
+    argv = ["-f", args.file, "-a", args.ipasn, "-r", args.relations, "-o", os.path.join(workspace_dir, "output.tsv")]
+    return config, argv
+
+
+def simulate(combination):
+    """
+    Geolocates the targets with one combination of parameters in a fresh workspace
+    :param combination: a tuple with the values of PARAMETERS
+    :return: a dictionary with the statistics of the run
+    """
+    args, world, truth = worker["args"], worker["world"], worker["truth"]
+    workspace_dir = tempfile.mkdtemp(prefix="simulate_")
+    try:
+        if args.model == "synthetic":
+            config, argv = make_workspace(world, worker["targets"], workspace_dir,
+                                          worker["peeringdb_server"].base_url)
+        else:
+            config, argv = make_stored_workspace(args, workspace_dir)
+        for (_, section, key), value in zip(PARAMETERS, combination):
+            config[section][key] = value
+        config["Traceroute"]["probes"] = "0"
+        METRICS.reset()
+        start = time()
+        pipeline = GeolocationPipeline(config, arg_parser.parse_arguments(argv))
+        if args.model == "synthetic":
+            install_fakes(pipeline, world, FakeAtlas(world, dead_probes=args.dead_probes))
+        else:
+            pipeline.resources["atlas_api"] = ReplayAtlas(worker["observations"], pipeline.cassette_store)
+        pipeline.run()
+        pipeline.close()
+        elapsed = time() - start
+
+        counters = METRICS.snapshot()["counters"]
+        measurements = counters.get('atlas_measurements{result="created"}', 0)
+        locations = read_locations(os.path.join(workspace_dir, "output.tsv"))
+        errors = sorted(haversine_km(lat, lng, truth[ip][0], truth[ip][1])
+                        for ip, (lat, lng) in locations.iteritems() if ip in truth)
+        return {
+            "combination": combination,
+            "targets": worker["targets_num"],
+            "located": len(locations),
+            "accuracy": float(sum(1 for error in errors if error <= args.accuracy_km)) / len(truth)
+            if len(truth) > 0 else None,
+            "median_error_km": errors[len(errors) // 2] if len(errors) > 0 else None,
+            "measurements": measurements,
+            "credits": pipeline.atlas_budget.status()["credits"],
+            "elapsed": elapsed,
+            "estimated_seconds": elapsed + measurements * args.measurement_seconds
+        }
+    except BaseException as e:
+        # SystemExit is caught too, since the Atlas client exits on measurement errors
+        return {"combination": combination, "error": "%s: %s" % (type(e).__name__, str(e))}
+    finally:
+        shutil.rmtree(workspace_dir)
+
+
+def report(results, output_file):
+    columns = [option for option, _, _ in PARAMETERS]
+    print "\n%s" % "  ".join("%16s" % column for column in columns + ["accuracy", "median err km", "located",
+                                                                        "measurements", "credits", "est. hours"])
+    lines = list()
+    for result in results:
+        values = list(result["combination"])
+        if "error" in result:
+            print "%s  error: %s" % ("  ".join("%16s" % value for value in values), result["error"])
+            continue
+        values += [
+            "%.3f" % result["accuracy"] if result["accuracy"] is not None else "n/a",
+            "%.1f" % result["median_error_km"] if result["median_error_km"] is not None else "n/a",
+            "%.3f" % (float(result["located"]) / max(result["targets"], 1)),
+            result["measurements"],
+            result["credits"],
+            "%.2f" % (result["estimated_seconds"] / 3600)
+        ]
+        print "  ".join("%16s" % value for value in values)
+        lines.append("\t".join(str(value) for value in values))
+    if output_file is not None:
+        with open(output_file, "w") as fout:
+            fout.write("#%s\n" % "\t".join(columns + ["accuracy", "median_error_km", "located", "measurements",
+                                                        "credits", "estimated_hours"]))
+            fout.write("".join(line + "\n" for line in lines))
+
+
+parser = argparse.ArgumentParser(description="Sweeps the probe selection parameters with offline replays")
+parser.add_argument('--model', choices=("synthetic", "stored"), default="synthetic",
+                    help="Synthesize the targets and RTTs, or replay a target file against stored RTTs")
+parser.add_argument('--jobs', type=int, default=multiprocessing.cpu_count(),
+                    help="The number of combinations simulated in parallel")
+for option, section, key in PARAMETERS:
+    parser.add_argument('--%s' % option.replace("_", "-"), type=str,
+                        help="Comma-separated values of %s in the [%s] configuration section" % (key, section))
+parser.add_argument('--accuracy-km', type=float, default=40,
+                    help="A target is located accurately within this distance of its true location")
+parser.add_argument('--measurement-seconds', type=float, default=30,
+                    help="The time that a live Atlas measurement takes, for the estimate of the wall-clock time")
+parser.add_argument('-o', '--output', type=str, help="Also write the results to this TSV file")
+synthetic_group = parser.add_argument_group("synthetic model")
+synthetic_group.add_argument('--seed', type=int, default=1, help="The seed of the synthetic world")
+synthetic_group.add_argument('--targets', type=int, default=1000, help="The number of target IPs")
+synthetic_group.add_argument('--asns', type=int, default=50, help="The number of ASNs of the targets")
+synthetic_group.add_argument('--dead-probes', type=float, default=0,
+                             help="The fraction of the probes that never reply to measurements")
+stored_group = parser.add_argument_group("stored model")
+stored_group.add_argument('-f', '--file', type=str, help="The historical target file")
+stored_group.add_argument('-a', '--ipasn', type=str, help="The pyasn database of the targets")
+stored_group.add_argument('-r', '--relations', type=str, help="The AS relationships in CAIDA format")
+stored_group.add_argument('--observations', type=str,
+                          help="The RTT store that answers the pings (defaults to the rtt_store file path of the "
+                               "configuration)")
+stored_group.add_argument('--truth', type=str, help="A file with the true `IP lat lng` of the targets")
+args = parser.parse_args()
+
+config = arg_parser.read_config()
+values = list()
+for option, section, key in PARAMETERS:
+    option_values = getattr(args, option)
+    values.append(option_values.split(",") if option_values is not None else [config[section][key]])
+combinations = list(itertools.product(*values))
+
+world = None
+truth = dict()
+if args.model == "synthetic":
+    start = time()
+    world = SyntheticWorld(args.seed)
+    print "Synthetic world: %s cities, %s IXPs, %s ASNs, %s probes (%.1f sec)" % (
+        len(world.cities), len(world.ixps), len(world.asns), len(world.probes), time() - start)
+    worker["targets"] = world.targets(args.targets, args.asns)
+    truth = dict((target_ip, (world.target_city(target_ip)["lat"], world.target_city(target_ip)["lng"]))
+                 for target_ip in worker["targets"])
+    worker["targets_num"] = len(worker["targets"])
+else:
+    if args.file is None or args.ipasn is None or args.relations is None:
+        parser.error("the stored model requires the target file (-f), the pyasn database (-a) and the AS "
+                     "relationships (-r)")
+    if args.observations is None:
+        args.observations = config["FilePaths"]["rtt_store"]
+    if len(glob.glob(os.path.join(args.observations, "*.npy"))) == 0:
+        parser.error("the RTT store `%s` is empty, fill it with ingest-atlas-results.py" % args.observations)
+    if args.truth is not None:
+        truth = read_truth(args.truth)
+    worker["targets_num"] = sum(last - first + 1 for first, last in target_reader.iter_target_ranges(None, args.file))
+
+print "Simulating %s combinations of %s with %s jobs" % (
+    len(combinations), ", ".join(option for option, _, _ in PARAMETERS), min(args.jobs, len(combinations)))
+start = time()
+pool = multiprocessing.Pool(max(1, min(args.jobs, len(combinations))), init_worker, (args, world, truth))
+try:
+    results = pool.map(simulate, combinations, chunksize=1)
+finally:
+    pool.terminate()
+print "Simulated in %.1f sec" % (time() - start)
+report(results, args.output)
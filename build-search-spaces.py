@@ -0,0 +1,28 @@
+# coding=latin-1
+import argparse
+from time import time
+# My modules
+import arg_parser
+from GeolocationPipeline import GeolocationPipeline
+
+'''
+Builds the search space artifact: the geocoded PeeringDB locations of every ASN and the Atlas probes around each
+location and in each ASN. The geolocation reads the search space of an ASN from the artifact instead of querying
+PeeringDB, geocoding the locations and searching their probes. Rebuild it when it is older than the max_age_hours
+of the configuration, e.g. from a daily cron job.
+'''
+parser = argparse.ArgumentParser(description="Precomputes the candidate locations and probes of every PeeringDB ASN")
+parser.add_argument('-o', '--output',
+                    type=str,
+                    help="The directory of the artifact (defaults to the search_spaces file path of the "
+                         "configuration)")
+args = parser.parse_args()
+
+config = arg_parser.read_config()
+artifact_dir = args.output if args.output is not None else config["FilePaths"]["search_spaces"]
+start = time()
+asns_num = GeolocationPipeline(config, None).compile_search_spaces(artifact_dir)
+if asns_num is None:
+    print "Error: Could not build the search space artifact"
+else:
+    print "Wrote the search spaces of %s ASNs to `%s` in %.1f sec" % (asns_num, artifact_dir, time() - start)
@@ -0,0 +1,78 @@
+# coding=latin-1
+import os
+import sys
+import shutil
+import argparse
+import tempfile
+from time import time
+# My modules
+import arg_parser
+from ResultsDatabase import ResultsDatabase, COMPILED_FORMATS
+
+'''
+Compiles a geolocation output file into the results database: sorted ranges of integer IPs with interned records,
+stored as numpy arrays that are loaded with mmap. Other systems look up the results with ResultsDatabase.lookup and
+ResultsDatabase.lookup_many instead of reading the output. The database keeps track of how far it has read the
+output, so running the script again only adds the new results. The geolocation updates the database of the
+results_db setting of the configuration at the end of every run.
+'''
+parser = argparse.ArgumentParser(description="Compiles the geolocation output into a database for fast lookups")
+parser.add_argument('output',
+                    help="The geolocation output file")
+parser.add_argument('-d', '--database',
+                    type=str,
+                    help="The directory of the database (defaults to the results_db setting of the configuration)")
+parser.add_argument('--format',
+                    choices=COMPILED_FORMATS,
+                    help="The format of the output file (defaults to the output format of the configuration)")
+parser.add_argument('--full',
+                    action="store_true",
+                    help="Rebuild the database from the whole output instead of adding the new results")
+parser.add_argument('--verify',
+                    action="store_true",
+                    help="Also rebuild the database from the whole output in a temporary directory and check that it "
+                         "has the same results")
+parser.add_argument('-l', '--lookup',
+                    nargs="+",
+                    help="Print the results of these IPs from the compiled database")
+args = parser.parse_args()
+
+config = arg_parser.read_config()
+database_dir = args.database if args.database is not None else config["Output"]["results_db"].strip()
+if database_dir == "":
+    parser.error("the database directory is required, with -d/--database or the results_db setting")
+output_format = args.format if args.format is not None else config["Output"]["format"]
+
+start = time()
+results_database = ResultsDatabase(database_dir).load()
+try:
+    read_results = results_database.compile(args.output, output_format, args.full)
+except (IOError, ValueError) as e:
+    parser.error(str(e))
+if read_results is None:
+    print "Error: Could not write the results database `%s`" % database_dir
+else:
+    print "Added %s results to `%s` in %.1f sec: %s IPs in %s ranges, %s distinct records" % (
+        read_results, database_dir, time() - start, results_database.ips_num(), len(results_database),
+        results_database.metadata["records"])
+
+if args.verify and read_results is not None:
+    verify_dir = tempfile.mkdtemp(prefix="results_db_")
+    try:
+        rebuilt_database = ResultsDatabase(os.path.join(verify_dir, "database"))
+        rebuilt_database.compile(args.output, output_format, full=True)
+        if not results_database.has_same_results(rebuilt_database):
+            print "Error: The database `%s` differs from a full rebuild of `%s`" % (database_dir, args.output)
+            sys.exit(-1)
+        print "The database has the same results as a full rebuild"
+    finally:
+        shutil.rmtree(verify_dir)
+
+for ip in args.lookup or ():
+    result = results_database.lookup(ip)
+    if result is None:
+        print "%s\tnot found" % ip
+    else:
+        print "%s\t%s\t%s\t%s\t%s\t%s\t%s" % (ip, result["asn"], result["city"].encode("utf-8"),
+                                              result["country"].encode("utf-8"), result["lat"], result["lng"],
+                                              result["min_rtt"])
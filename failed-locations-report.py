@@ -0,0 +1,52 @@
+# coding=latin-1
+import argparse
+from datetime import datetime
+from time import time
+# My modules
+from GeoEncoder import GeoEncoder
+import arg_parser
+
+'''
+Lists the PeeringDB locations that repeatedly fail to geocode. Each of them can be fixed by appending a manual
+override to the coordinates file, in the format: location_id<tab>lat<tab>lng<tab>City<tab>Country
+'''
+parser = argparse.ArgumentParser(description="Reports the locations that repeatedly failed to geocode")
+parser.add_argument('-m', '--min-attempts',
+                    type=int,
+                    default=2,
+                    help="The minimum number of failed attempts for a location to be reported")
+args = parser.parse_args()
+
+config = arg_parser.read_config()
+geo_encoder = GeoEncoder(
+    config["ApiKeys"]["gmap_key"],
+    config["FilePaths"]["maxmind_db"],
+    config["FilePaths"]["city_coordinates"],
+    config["FilePaths"]["probes_locations"],
+    config["FilePaths"]["worldcities_population"],
+    config["FilePaths"]["failed_locations"],
+    config["GeocodeParameters"]["failed_retry_hours"],
+    config["GeocodeParameters"]["failed_retry_max_hours"]
+)
+cached_location_coordinates = geo_encoder.read_location_coordinates()
+failed_locations = geo_encoder.read_failed_locations()
+
+now = time()
+print "# Location\tAttempts\tReason\tFirst failed\tLast failed\tRetry after"
+for location_id, failure in geo_encoder.report_failed_locations(failed_locations, args.min_attempts):
+    # Locations that have been overridden in the coordinates file are no longer a problem
+    if location_id in cached_location_coordinates:
+        continue
+    retry_after = datetime.utcfromtimestamp(failure["retry_after"])
+    if failure["retry_after"] <= now:
+        retry_after = "now"
+    print "%s\t%s\t%s\t%s\t%s\t%s" % (
+        location_id,
+        failure["attempts"],
+        failure["reason"],
+        datetime.utcfromtimestamp(failure["first_failed"]),
+        datetime.utcfromtimestamp(failure["last_failed"]),
+        retry_after
+    )
+print "# Add overrides to `%s` as: location_id<tab>lat<tab>lng<tab>City<tab>Country" % \
+      config["FilePaths"]["city_coordinates"]
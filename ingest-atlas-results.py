@@ -0,0 +1,67 @@
+# coding=latin-1
+import argparse
+# My modules
+import arg_parser
+import target_reader
+from RttStore import RttStore
+from atlas_archive import TargetRanges, BorderInterfaces, ingest_archive
+
+'''
+Adds the ping and traceroute RTTs of local RIPE Atlas result dumps (JSON lines, optionally compressed with gzip or
+bzip2) to the RTT store. Every traceroute hop that replied gives an RTT from the probe to the hop's interface. The
+geolocation uses the stored RTTs to locate the targets with a very low RTT to a known probe, and to prune the
+candidate locations of the others, before any new measurement is created.
+'''
+parser = argparse.ArgumentParser(description="Ingests Atlas ping and traceroute result dumps into the local RTT store")
+parser.add_argument('archives',
+                    nargs="+",
+                    help="The Atlas result dumps, `-` to read a dump from the standard input")
+parser.add_argument('-f', '--file',
+                    type=str,
+                    help="Only ingest the RTTs of the IPs, prefixes or ranges in this file, in the format of the "
+                         "targets file of the geolocation")
+parser.add_argument('-a', '--ipasn',
+                    type=str,
+                    help="The pyasn database that maps the traceroute hops to the ASNs of --asns")
+parser.add_argument('--asns',
+                    type=str,
+                    help="Comma-separated ASNs whose interfaces on the traceroute paths are kept besides the targets")
+parser.add_argument('--ixp',
+                    action="store_true",
+                    help="Keep the traceroute hops on IXP peering LANs, according to the IXP LAN table")
+parser.add_argument('-o', '--output',
+                    type=str,
+                    help="The directory of the RTT store (defaults to the rtt_store file path of the configuration)")
+args = parser.parse_args()
+
+config = arg_parser.read_config()
+store_dir = args.output if args.output is not None else config["FilePaths"]["rtt_store"]
+rtt_store = RttStore(store_dir).load()
+target_ranges = None
+if args.file is not None:
+    target_ranges = TargetRanges(target_reader.iter_target_ranges(None, args.file))
+    print "Filtering the results to %s target ranges" % len(target_ranges)
+border_interfaces = None
+if args.asns is not None or args.ixp:
+    from PeeringDB import IxpLanTable
+    asndb = arg_parser.read_asn_database(args.ipasn) if args.ipasn is not None else None
+    asns = [int(asn) for asn in args.asns.split(",")] if args.asns is not None else []
+    if len(asns) > 0 and asndb is None:
+        parser.error("--asns requires the pyasn database of -a/--ipasn")
+    ixp_lan_table = IxpLanTable(config["FilePaths"]["ixp_lan_table"]).load() if args.ixp else None
+    border_interfaces = BorderInterfaces(asndb, asns, ixp_lan_table)
+
+total_added = 0
+for archive_file in args.archives:
+    try:
+        read_rtts, added_rtts = ingest_archive(archive_file, rtt_store, target_ranges, border_interfaces)
+    except (IOError, EOFError) as e:
+        print "Error: Could not read the archive `%s`: %s" % (archive_file, str(e))
+        continue
+    total_added += added_rtts
+    print "%s: %s RTTs, %s RTTs of targets and border interfaces" % (archive_file, read_rtts, added_rtts)
+
+stored_rows = len(rtt_store)
+if total_added > 0 and rtt_store.save():
+    print "The RTT store `%s` has %s (target, probe) RTTs, %s new" % (store_dir, len(rtt_store),
+                                                                     len(rtt_store) - stored_rows)
@@ -0,0 +1,110 @@
+import socket
+import struct
+import numpy as np
+
+
+def ip_to_int(ip):
+    """
+    Converts a dotted IPv4 address to its integer representation
+    :param ip: the IPv4 address string
+    :return: the address as an unsigned 32-bit integer
+    """
+    return struct.unpack("!I", socket.inet_aton(ip))[0]
+
+
+def int_to_ip(value):
+    """
+    Converts the integer representation of an IPv4 address to the dotted format
+    :param value: the address as an unsigned 32-bit integer
+    :return: the IPv4 address string
+    """
+    return socket.inet_ntoa(struct.pack("!I", int(value)))
+
+
+def ips_to_array(ips):
+    """
+    Converts an iterable of IPv4 addresses (dotted strings or integers) to a numpy array of unsigned 32-bit integers
+    :param ips: the IPv4 addresses
+    :return: a numpy uint32 array, in the order of the input
+    """
+    return np.fromiter((ip if isinstance(ip, (int, long, np.integer)) else ip_to_int(ip) for ip in ips),
+                       dtype=np.uint32)
+
+
+def sorted_contains(sorted_array, values):
+    """
+    Tests the membership of values in a sorted array with a binary search
+    :param sorted_array: a sorted numpy array
+    :param values: a numpy array with the values to test
+    :return: a boolean numpy array which is True for the values found in :sorted_array
+    """
+    if len(sorted_array) == 0:
+        return np.zeros(len(values), dtype=bool)
+    positions = np.searchsorted(sorted_array, values)
+    positions[positions == len(sorted_array)] = 0
+    return sorted_array[positions] == values
+
+
+def prefix_to_range(prefix):
+    """
+    Converts an IPv4 prefix to the range of integer addresses it covers
+    :param prefix: the prefix in CIDR notation (e.g. 192.0.2.0/24), or a single address
+    :return: a tuple with the first and the last address of the prefix as integers
+    """
+    if "/" in prefix:
+        address, length = prefix.split("/", 1)
+        length = int(length)
+        if length < 0 or length > 32:
+            raise ValueError("Invalid prefix length in `%s`" % prefix)
+    else:
+        address, length = prefix, 32
+    host_bits = 32 - length
+    first = (ip_to_int(address) >> host_bits) << host_bits
+    return first, first + (1 << host_bits) - 1
+
+
+class CompactIPSet(object):
+    """
+    A set of IPv4 addresses stored as sorted runs of unsigned 32-bit integers. New runs are merged with the previous
+    ones when they grow to a similar size (like a log-structured merge tree), so the set costs 4 bytes per address
+    and a membership test is a binary search in a handful of runs.
+    """
+
+    def __init__(self):
+        self.runs = list()
+
+    def add_new(self, values):
+        """
+        Adds a batch of addresses to the set
+        :param values: a numpy array of integer addresses
+        :return: the sorted numpy array of the addresses that were not in the set before
+        """
+        values = np.unique(np.asarray(values, dtype=np.uint32))
+        for run in self.runs:
+            values = values[~sorted_contains(run, values)]
+        if len(values) > 0:
+            self.runs.append(values)
+            while len(self.runs) > 1 and len(self.runs[-2]) <= 2 * len(self.runs[-1]):
+                last_run = self.runs.pop()
+                self.runs[-1] = np.union1d(self.runs[-1], last_run).astype(np.uint32)
+        return values
+
+    def contains(self, values):
+        """
+        Tests the membership of a batch of addresses
+        :param values: a numpy array of integer addresses
+        :return: a boolean numpy array which is True for the addresses in the set
+        """
+        values = np.asarray(values, dtype=np.uint32)
+        found = np.zeros(len(values), dtype=bool)
+        for run in self.runs:
+            found |= sorted_contains(run, values)
+        return found
+
+    def __contains__(self, ip):
+        if not isinstance(ip, (int, long, np.integer)):
+            ip = ip_to_int(ip)
+        return bool(self.contains(np.array([ip], dtype=np.uint32))[0])
+
+    def __len__(self):
+        return sum(len(run) for run in self.runs)
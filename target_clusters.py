@@ -0,0 +1,83 @@
+import logging
+import socket
+from ip_utils import ip_to_int
+
+logging.basicConfig()
+logger = logging.getLogger("TargetClusters")
+
+
+def read_alias_sets(alias_file):
+    """
+    Reads the sets of IPs that belong to the same router (e.g. the output of an alias resolution tool). Every line of
+    the file is an alias set, with the IPs separated by whitespace or commas. Lines starting with # are ignored.
+    :param alias_file: the path to the file
+    :return: a dictionary that maps each integer IP to the index of its alias set
+    """
+    alias_sets = dict()
+    try:
+        with open(alias_file) as fin:
+            for line_counter, line in enumerate(fin, 1):
+                if line.startswith("#"):
+                    continue
+                alias_ips = line.replace(",", " ").split()
+                try:
+                    alias_ips = [ip_to_int(ip) for ip in alias_ips]
+                except socket.error:
+                    logger.warning("Skipping line %s in the alias file `%s` because it contains an invalid IP." %
+                                   (line_counter, alias_file))
+                    continue
+                for ip in alias_ips:
+                    alias_sets[ip] = line_counter
+    except IOError as e:
+        logger.error("Could not read the alias file `%s`: %s" % (alias_file, str(e)))
+    return alias_sets
+
+
+def cluster_targets(target_ips, prefix_length=32, alias_sets=None):
+    """
+    Groups the targets that are probably co-located: targets in the same prefix of the given length (e.g. the two
+    ends of a /30 or /31 link subnet) and targets in the same alias set. Clusters are merged transitively.
+    :param target_ips: the list of target IP strings
+    :param prefix_length: the length of the prefixes that group targets, 32 to group only by alias sets
+    :param alias_sets: the dictionary returned by read_alias_sets, or None
+    :return: a list of clusters, each a list of target IP strings whose first IP is the representative of the
+    cluster. The clusters and their members keep the order of :target_ips.
+    """
+    prefix_length = max(0, min(32, int(prefix_length)))
+    host_bits = 32 - prefix_length
+    parents = range(len(target_ips))
+
+    def find(index):
+        while parents[index] != index:
+            parents[index] = parents[parents[index]]
+            index = parents[index]
+        return index
+
+    def union(index, other_index):
+        root, other_root = find(index), find(other_index)
+        if root != other_root:
+            parents[max(root, other_root)] = min(root, other_root)
+
+    first_index = dict()
+    for index, target_ip in enumerate(target_ips):
+        int_ip = ip_to_int(target_ip)
+        keys = list()
+        if host_bits > 0:
+            keys.append(("prefix", int_ip >> host_bits))
+        if alias_sets is not None and int_ip in alias_sets:
+            keys.append(("alias", alias_sets[int_ip]))
+        for key in keys:
+            if key in first_index:
+                union(first_index[key], index)
+            else:
+                first_index[key] = index
+
+    clusters = dict()
+    cluster_order = list()
+    for index, target_ip in enumerate(target_ips):
+        root = find(index)
+        if root not in clusters:
+            clusters[root] = list()
+            cluster_order.append(root)
+        clusters[root].append(target_ip)
+    return [clusters[root] for root in cluster_order]
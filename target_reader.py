@@ -0,0 +1,126 @@
+import logging
+import socket
+import sys
+import gzip
+import bz2
+import numpy as np
+from ip_utils import ip_to_int, prefix_to_range, CompactIPSet
+
+logging.basicConfig()
+logger = logging.getLogger("TargetReader")
+
+
+def open_targets_file(target_file):
+    """
+    Opens a file with geolocation targets, which can be compressed with gzip or bzip2
+    :param target_file: the path to the file, or `-` to read the targets from the standard input
+    :return: a file object
+    """
+    if target_file == "-":
+        return sys.stdin
+    elif target_file.endswith(".gz"):
+        return gzip.open(target_file)
+    elif target_file.endswith(".bz2"):
+        return bz2.BZ2File(target_file)
+    return open(target_file)
+
+
+def parse_target(target):
+    """
+    Parses a geolocation target, which can be an IPv4 address, a prefix in CIDR notation (192.0.2.0/24) or a range
+    of addresses (192.0.2.1-192.0.2.10)
+    :param target: the target string
+    :return: a tuple with the first and last address of the target as integers, or None if the target is invalid
+    """
+    try:
+        if "-" in target:
+            first, last = target.split("-", 1)
+            if first.count(".") != 3 or last.count(".") != 3:
+                return None
+            first, last = ip_to_int(first.strip()), ip_to_int(last.strip())
+            if first > last:
+                return None
+            return first, last
+        if target.split("/", 1)[0].count(".") != 3:
+            return None
+        return prefix_to_range(target)
+    except (ValueError, socket.error):
+        return None
+
+
+def iter_target_ranges(target_ip, target_file):
+    """
+    Reads the geolocation targets lazily and yields the range of addresses of each valid target
+    :param target_ip: the value of the -i/--ip user argument
+    :param target_file: the value of the -f/--file user argument
+    :return: a generator of (first, last) integer address tuples
+    """
+    if target_ip is not None:
+        target_range = parse_target(target_ip.strip())
+        if target_range is None:
+            logger.critical("The provided -i/--ip argument `%s` is not a valid IPv4 address or prefix." % target_ip)
+        else:
+            yield target_range
+    elif target_file is not None:
+        try:
+            fin = open_targets_file(target_file)
+            line_counter = 0
+            for line in fin:
+                line_counter += 1
+                if line.startswith("#"):
+                    continue
+                lf = line.split()
+                if len(lf) == 0:
+                    continue
+                target_range = parse_target(lf[0])
+                if target_range is None:
+                    logger.warning("Skipping line %s in the `%s` file because "
+                                   "it is not a valid IPv4 address or prefix." % (line_counter, target_file))
+                else:
+                    yield target_range
+            if fin is not sys.stdin:
+                fin.close()
+        except IOError as e:
+            logger.critical("Failed to read the file `%s` provided by the -f/--file argument. Error: %s" %
+                            (target_file, str(e)))
+
+
+def iter_target_batches(target_ranges, batch_size=100000, seen_ips=None):
+    """
+    Expands the target ranges to addresses and yields them in deduplicated batches, so the geolocation can start
+    before the whole input has been read
+    :param target_ranges: an iterable of (first, last) integer address tuples
+    :param batch_size: the maximum number of addresses per batch
+    :param seen_ips: a CompactIPSet with the addresses that have already been yielded
+    :return: a generator of sorted numpy uint32 arrays with the addresses that have not been yielded before
+    """
+    if seen_ips is None:
+        seen_ips = CompactIPSet()
+    # Single addresses are collected in a list, and prefixes or ranges are expanded to numpy arrays
+    pending_addresses = list()
+    pending_ranges = list()
+    pending_size = 0
+    for first, last in target_ranges:
+        while first <= last:
+            if first == last:
+                pending_addresses.append(first)
+                pending_size += 1
+                first += 1
+            else:
+                range_last = min(last, first + batch_size - pending_size - 1)
+                pending_ranges.append(np.arange(first, range_last + 1, dtype=np.uint32))
+                pending_size += range_last - first + 1
+                first = range_last + 1
+            if pending_size >= batch_size:
+                pending_ranges.append(np.array(pending_addresses, dtype=np.uint32))
+                batch = seen_ips.add_new(np.concatenate(pending_ranges))
+                pending_addresses = list()
+                pending_ranges = list()
+                pending_size = 0
+                if len(batch) > 0:
+                    yield batch
+    if pending_size > 0:
+        pending_ranges.append(np.array(pending_addresses, dtype=np.uint32))
+        batch = seen_ips.add_new(np.concatenate(pending_ranges))
+        if len(batch) > 0:
+            yield batch
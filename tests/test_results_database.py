@@ -0,0 +1,78 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from ip_utils import int_to_ip, ip_to_int
+from ResultsDatabase import ResultsDatabase
+
+
+def output_line(ip, city, timestamp, min_rtt=1.5):
+    return "\t".join([ip, "3320", city, "Hessen", "DE", "50.11", "8.68", str(min_rtt), city, str(timestamp)]) + "\n"
+
+
+class ResultsDatabaseTest(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.output_file = os.path.join(self.work_dir, "output.tsv")
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def append(self, lines):
+        with open(self.output_file, "a") as fout:
+            fout.write("".join(lines))
+
+    def compile(self, name, full=False):
+        database = ResultsDatabase(os.path.join(self.work_dir, name)).load()
+        self.assertIsNotNone(database.compile(self.output_file, full=full))
+        return database
+
+    def assert_same_as_full_build(self, database):
+        full_database = self.compile("full", full=True)
+        self.assertTrue(database.has_same_results(full_database))
+        for expanded, full_expanded in zip(database.expand(), full_database.expand()):
+            self.assertTrue(np.array_equal(expanded, full_expanded))
+        # The reloaded database answers like the one in memory
+        reloaded = ResultsDatabase(database.database_dir).load()
+        self.assertTrue(reloaded.has_same_results(full_database))
+
+    def test_one_range_per_prefix(self):
+        base = ip_to_int("10.0.0.0")
+        self.append(output_line(int_to_ip(base + host), "Frankfurt", 1000 + host) for host in xrange(256))
+        database = self.compile("incremental")
+        self.assertEqual(len(database), 1)
+        self.assertEqual(database.lookup("10.0.0.7")["timestamp"], 1007)
+        self.assertEqual(database.lookup("10.0.0.255")["timestamp"], 1255)
+
+    def test_incremental_compilation_equals_full_build(self):
+        self.append(output_line("10.0.0.%d" % host, "Frankfurt", 100 + host) for host in xrange(10))
+        database = self.compile("incremental")
+        self.assertEqual(len(database), 1)
+
+        # An updated IP in the middle of the range, a new IP after it and a disjoint one
+        self.append([output_line("10.0.0.4", "Frankfurt", 200), output_line("10.0.0.10", "Frankfurt", 201),
+                     output_line("10.0.1.1", "Offenbach", 202, min_rtt=2.5)])
+        self.assertEqual(database.compile(self.output_file), 3)
+        self.assertEqual(len(database), 2)
+        self.assertEqual(database.lookup("10.0.0.3")["timestamp"], 103)
+        self.assertEqual(database.lookup("10.0.0.4")["timestamp"], 200)
+        self.assertEqual(database.lookup("10.0.0.5")["timestamp"], 105)
+        self.assertEqual(database.lookup("10.0.0.10")["timestamp"], 201)
+        self.assertEqual(database.lookup("10.0.1.1")["city"], "Offenbach")
+        self.assert_same_as_full_build(database)
+
+        # A new result of an IP splits its range
+        self.append([output_line("10.0.0.6", "Offenbach", 300, min_rtt=2.5)])
+        self.assertEqual(database.compile(self.output_file), 1)
+        self.assertEqual(len(database), 4)
+        self.assertEqual(database.lookup("10.0.0.6")["city"], "Offenbach")
+        self.assertEqual(database.lookup("10.0.0.7")["timestamp"], 107)
+        self.assert_same_as_full_build(database)
+
+
+if __name__ == "__main__":
+    unittest.main()